@@ -0,0 +1,573 @@
+"""Serves the bot on an asyncio event loop.
+
+The threaded runtime handles every update on a thread of a pool, which
+blocks while the handler waits for Telegram or Redis, so the number of chats
+served at once is the size of the pool. Here updates are handled by tasks
+of one event loop, which make their requests with asynchronous clients: the
+Bot API with AsyncBotApi over tornado's HTTP client, Redis with redis.asyncio
+(see AsyncRedisPersistence and stats.AsyncRedisStorage). A chat waiting for a
+reply only costs its task.
+
+The handlers are the same coroutines the threaded runtime runs, see
+runtime.py, and so are the handlers of python-telegram-bot routing updates
+to them: AsyncDispatcher checks updates against them like its Dispatcher and
+ConversationHandler do. Updates of one chat are handled one at a time and in
+the order they arrived, like ChatOrderedDispatcher handles them. Blocking
+work, like loading a conversation, runs on an executor.
+"""
+
+from collections import defaultdict, deque
+from concurrent.futures import Executor
+from typing import (Any, Callable, Coroutine, DefaultDict, Deque, Dict,
+                    Hashable, List, Optional, Sequence, Set, Tuple)
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import time
+
+from telegram import (
+    InputFile,
+    InputMediaPhoto,
+    Message,
+    TelegramObject,
+    Update,
+)
+from telegram.ext import ConversationHandler, Handler
+from telegram.utils.helpers import DefaultValue
+from telegram.vendor.ptb_urllib3.urllib3.filepost import \
+    encode_multipart_formdata
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.simple_httpclient import HTTPTimeoutError
+import telegram.error
+import tornado.web
+
+from bot_redis_persistence import AsyncRedisPersistence
+from chat_dispatcher import update_chat_id
+from monitoring import MetricsHandler, TELEGRAM_API_LATENCY
+from rate_limiter import (
+    LIMITED_ENDPOINTS,
+    MAX_FLOOD_RETRIES,
+    MAX_RETRY_AFTER_SEC,
+    OutboundLimiter,
+    outbound_stats,
+)
+from runtime import BotApi
+
+API_URL = "https://api.telegram.org/bot"
+CONNECT_TIMEOUT_SEC = 5
+REQUEST_TIMEOUT_SEC = 10
+# Seconds getUpdates waits for updates when polling.
+POLL_TIMEOUT_SEC = 30
+POLL_RETRY_SEC = (1, 2, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+
+def _media_dict(media: InputMediaPhoto) -> Dict[str, Any]:
+    # Parameters left to the defaults of a bot, which there are none of.
+    return {
+        key: value
+        for key, value in media.to_dict().items()
+        if not isinstance(value, DefaultValue)
+    }
+
+
+def encode_request(data: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+    """Returns the body and headers of a Bot API request: JSON, or multipart
+    form data when it uploads files, like python-telegram-bot sends them.
+    Parameters which are None are left out."""
+    fields: Dict[str, Any] = {}
+    files = False
+    for key, value in data.items():
+        value = DefaultValue.get_value(value)
+        if value is None:
+            continue
+        if isinstance(value, InputFile):
+            fields[key] = value.field_tuple
+            files = True
+        elif key == "media":
+            for item in value:
+                if isinstance(item.media, InputFile):
+                    fields[item.media.attach] = item.media.field_tuple
+                    files = True
+            fields[key] = [_media_dict(item) for item in value]
+        elif isinstance(value, TelegramObject):
+            fields[key] = value.to_dict()
+        elif isinstance(value, list):
+            fields[key] = [
+                item.to_dict() if isinstance(item, TelegramObject) else item
+                for item in value
+            ]
+        else:
+            fields[key] = value
+    if not files:
+        return json.dumps(fields).encode("utf-8"), {
+            "Content-Type": "application/json"
+        }
+    body, content_type = encode_multipart_formdata({
+        key: value if isinstance(value, tuple) else
+        json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+        for key, value in fields.items()
+    })
+    return body, {"Content-Type": content_type}
+
+
+# Errors of failed requests by their HTTP status, like python-telegram-bot
+# raises them.
+ERRORS_BY_STATUS = {
+    400: telegram.error.BadRequest,
+    401: telegram.error.Unauthorized,
+    403: telegram.error.Unauthorized,
+    404: lambda message: telegram.error.InvalidToken(),
+    409: telegram.error.Conflict,
+}
+
+
+def parse_response(status: int, body: bytes) -> Any:
+    """Returns the result of a Bot API response, or raises its error like
+    python-telegram-bot does."""
+    try:
+        data = json.loads(body.decode("utf-8", "replace"))
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        if 200 <= status <= 299:
+            raise telegram.error.TelegramError("Invalid server response")
+        data = {}
+    parameters = data.get("parameters") or {}
+    if parameters.get("migrate_to_chat_id"):
+        raise telegram.error.ChatMigrated(parameters["migrate_to_chat_id"])
+    if parameters.get("retry_after"):
+        raise telegram.error.RetryAfter(parameters["retry_after"])
+    if 200 <= status <= 299:
+        return data["result"] if data.get("ok") else data.get("description")
+    message = data.get("description") or "Unknown HTTPError"
+    error = ERRORS_BY_STATUS.get(status)
+    if error is None:
+        raise telegram.error.NetworkError(f"{message} ({status})")
+    raise error(message)
+
+
+class AsyncBotApi(BotApi):
+    """BotApi of the asyncio runtime, making its requests with tornado's
+    asynchronous HTTP client, at most max_connections at a time. Requests to
+    chats wait for the OutboundLimiter and are retried on RetryAfter like
+    RateLimitedBot retries them. Created on the event loop, and only used
+    from it."""
+
+    def __init__(self,
+                 token: str,
+                 limiter: OutboundLimiter,
+                 executor: Executor,
+                 max_connections: int = 100,
+                 base_url: str = API_URL):
+        self.limiter = limiter
+        self.executor = executor
+        self._url = f"{base_url}{token}"
+        self._http = AsyncHTTPClient(force_instance=True,
+                                     max_clients=max_connections)
+        self.sent = 0
+        self.total_send_sec = 0.0
+        self._background_pending = 0
+        # Channel traffic is sent one call at a time, in order.
+        self._sends_lock = asyncio.Lock()
+        self._runs_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def _request(self, method: str, data: Dict[str, Any],
+                       timeout: float) -> Any:
+        body, headers = encode_request(data)
+        request = HTTPRequest(f"{self._url}/{method}",
+                              method="POST",
+                              body=body,
+                              headers=headers,
+                              connect_timeout=CONNECT_TIMEOUT_SEC,
+                              request_timeout=timeout)
+        try:
+            response = await self._http.fetch(request, raise_error=False)
+        except HTTPTimeoutError as e:
+            raise telegram.error.TimedOut() from e
+        except (HTTPClientError, OSError) as e:
+            raise telegram.error.NetworkError(f"HTTP error {e}") from e
+        return parse_response(response.code, response.body or b"")
+
+    async def post(self,
+                   method: str,
+                   data: Dict[str, Any],
+                   timeout: float = REQUEST_TIMEOUT_SEC) -> Any:
+        """Makes a Bot API request and returns its result."""
+        chat_id = data.get("chat_id")
+        if chat_id is None or not method.startswith(LIMITED_ENDPOINTS):
+            with TELEGRAM_API_LATENCY.labels(method).time():
+                return await self._request(method, data, timeout)
+
+        for attempt in itertools.count():
+            await self.limiter.acquire_async(chat_id)
+            start = time.monotonic()
+            try:
+                return await self._request(method, data, timeout)
+            except telegram.error.RetryAfter as e:
+                if attempt >= MAX_FLOOD_RETRIES or \
+                        e.retry_after > MAX_RETRY_AFTER_SEC:
+                    raise
+                logger.warning(f"Flood control on {method} to {chat_id}, "
+                               f"retrying in {e.retry_after}s")
+                self.limiter.pause(chat_id, e.retry_after)
+            finally:
+                elapsed = time.monotonic() - start
+                TELEGRAM_API_LATENCY.labels(method).observe(elapsed)
+                self.sent += 1
+                self.total_send_sec += elapsed
+
+    async def send_message(self,
+                           chat_id,
+                           text,
+                           parse_mode=None,
+                           reply_markup=None,
+                           entities=None):
+        return Message.de_json(
+            await self.post(
+                "sendMessage", {
+                    "chat_id": chat_id,
+                    "text": text,
+                    "parse_mode": parse_mode,
+                    "reply_markup": reply_markup,
+                    "entities": entities,
+                }), None)
+
+    async def send_photo(self, chat_id, photo, reply_markup=None):
+        return Message.de_json(
+            await self.post(
+                "sendPhoto", {
+                    "chat_id":
+                    chat_id,
+                    "photo":
+                    InputFile(photo) if isinstance(photo, bytes) else photo,
+                    "reply_markup":
+                    reply_markup,
+                }), None)
+
+    async def send_media_group(self, chat_id: int,
+                               media: Sequence[InputMediaPhoto]):
+        return Message.de_list(
+            await self.post("sendMediaGroup", {
+                "chat_id": chat_id,
+                "media": list(media),
+            }), None)
+
+    async def send_venue(self,
+                         chat_id,
+                         latitude,
+                         longitude,
+                         title,
+                         address,
+                         google_place_id=None,
+                         reply_markup=None):
+        return Message.de_json(
+            await self.post(
+                "sendVenue", {
+                    "chat_id": chat_id,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "title": title,
+                    "address": address,
+                    "google_place_id": google_place_id,
+                    "reply_markup": reply_markup,
+                }), None)
+
+    async def forward_message(self, chat_id, from_chat_id, message_id):
+        return Message.de_json(
+            await self.post(
+                "forwardMessage", {
+                    "chat_id": chat_id,
+                    "from_chat_id": from_chat_id,
+                    "message_id": message_id,
+                }), None)
+
+    async def answer_callback_query(self,
+                                    callback_query_id,
+                                    text=None,
+                                    show_alert=False):
+        return await self.post(
+            "answerCallbackQuery", {
+                "callback_query_id": callback_query_id,
+                "text": text,
+                "show_alert": show_alert,
+            })
+
+    async def get_updates(self, offset: Optional[int],
+                          timeout: int) -> List[Update]:
+        return Update.de_list(
+            await self.post("getUpdates", {
+                "offset": offset,
+                "timeout": timeout
+            },
+                            timeout=timeout + REQUEST_TIMEOUT_SEC), None)
+
+    async def set_webhook(self, url: str) -> bool:
+        return await self.post("setWebhook", {"url": url})
+
+    async def delete_webhook(self) -> bool:
+        return await self.post("deleteWebhook", {})
+
+    def _track(self, coroutine: Coroutine) -> asyncio.Task:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def send_in_background(self, send, *args):
+
+        async def run():
+            try:
+                async with self._sends_lock:
+                    await send(*args)
+            except Exception as e:
+                logger.error("Background send failed", exc_info=e)
+            finally:
+                self._background_pending -= 1
+
+        self._background_pending += 1
+        return self._track(run())
+
+    def run_in_background(self, coroutine):
+
+        async def run():
+            try:
+                async with self._runs_lock:
+                    await coroutine
+            except Exception as e:
+                logger.error("Background run failed", exc_info=e)
+
+        return self._track(run())
+
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args))
+
+    def outbound_stats(self):
+        return outbound_stats(self.limiter, self.sent, self.total_send_sec,
+                              self._background_pending)
+
+    async def close(self):
+        """Waits for the work in the background and closes the client."""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+        self._http.close()
+
+
+class AsyncContext:
+    """What a handler gets with an update in the asyncio runtime, the part of
+    CallbackContext the handlers use."""
+
+    def __init__(self, api: BotApi, user_data: Dict):
+        self.api = api
+        self.user_data = user_data
+        self.error: Optional[Exception] = None
+
+
+def _matches(handler: Handler, update: Update) -> bool:
+    check = handler.check_update(update)
+    return check is not None and check is not False
+
+
+def conversation_route(conversation: ConversationHandler,
+                       state: Optional[object],
+                       update: Update) -> Optional[Handler]:
+    """Returns the handler of a ConversationHandler an update in state goes
+    to, the one its check_update would pick, or None."""
+    if state is None or conversation.allow_reentry:
+        for entry_point in conversation.entry_points:
+            if _matches(entry_point, update):
+                return entry_point
+        if state is None:
+            return None
+    for handler in itertools.chain(conversation.states.get(state, []),
+                                   conversation.fallbacks):
+        if _matches(handler, update):
+            return handler
+    return None
+
+
+class AsyncDispatcher:
+    """Handles updates with the handlers of python-telegram-bot whose
+    callbacks are coroutines: the first handler matching an update handles
+    it. Updates of one chat are handled one at a time and in order, of
+    different chats concurrently. ConversationHandlers are routed like they
+    route updates on their own, per chat and user, and their states are kept
+    in the persistence, or in memory without one."""
+
+    def __init__(self,
+                 api: BotApi,
+                 context_class: Callable[[BotApi, Dict], AsyncContext],
+                 persistence: Optional[AsyncRedisPersistence] = None):
+        self.api = api
+        self.context_class = context_class
+        self.persistence = persistence
+        self.handlers: List[Handler] = []
+        self.error_handlers: List[Callable[..., Coroutine]] = []
+        self.user_data: DefaultDict[int, Dict] = defaultdict(dict)
+        self.conversations: DefaultDict[str, Dict[Tuple[int, int],
+                                                  object]] = defaultdict(dict)
+        # Updates waiting for the one being handled in their chat. A chat is
+        # present while one of its updates is handled.
+        self._chat_queues: Dict[Hashable, Deque[Update]] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.pending = 0
+
+    def add_handler(self, handler: Handler):
+        self.handlers.append(handler)
+
+    def add_error_handler(self, callback: Callable[..., Coroutine]):
+        self.error_handlers.append(callback)
+
+    def process_update(self, update: Update):
+        """Schedules the handling of an update."""
+        self.pending += 1
+        self._idle.clear()
+        chat_id = update_chat_id(update)
+        if chat_id is not None:
+            queue = self._chat_queues.get(chat_id)
+            if queue is not None:
+                queue.append(update)
+                return
+            self._chat_queues[chat_id] = deque()
+        asyncio.ensure_future(self._run(chat_id, update))
+
+    async def _run(self, chat_id: Optional[int], update: Update):
+        while True:
+            try:
+                await self.handle_update(update)
+            except Exception as e:
+                logger.error(f"Handling an update of {chat_id} failed",
+                             exc_info=e)
+            self.pending -= 1
+            queue = self._chat_queues.get(chat_id)
+            if not queue:
+                self._chat_queues.pop(chat_id, None)
+                if not self.pending:
+                    self._idle.set()
+                return
+            update = queue.popleft()
+
+    async def handle_update(self, update: Update):
+        user = update.effective_user
+        user_data = {} if user is None else self.user_data[user.id]
+        if user is not None and self.persistence is not None:
+            await self.persistence.load_user_data(user.id, user_data)
+        context = self.context_class(self.api, user_data)
+        try:
+            for handler in self.handlers:
+                if await self._dispatch(handler, update, context):
+                    break
+        except Exception as e:
+            context.error = e
+            for error_handler in self.error_handlers:
+                try:
+                    await error_handler(update, context)
+                except Exception as error_handler_error:
+                    logger.error("Error handler failed",
+                                 exc_info=error_handler_error)
+        if user is not None and self.persistence is not None:
+            self.persistence.update_user_data(user.id, user_data)
+            await self.persistence.commit()
+
+    async def _dispatch(self, handler: Handler, update: Update,
+                        context: AsyncContext) -> bool:
+        """Handles the update if the handler matches it."""
+        if not isinstance(handler, ConversationHandler):
+            if not _matches(handler, update):
+                return False
+            await handler.callback(update, context)
+            return True
+
+        if update.effective_chat is None or update.effective_user is None:
+            return False
+        key = (update.effective_chat.id, update.effective_user.id)
+        state = await self._conversation_state(handler.name, key)
+        route = conversation_route(handler, state, update)
+        if route is None:
+            return False
+        new_state = await route.callback(update, context)
+        if new_state == ConversationHandler.END:
+            new_state = None
+        elif new_state is None:
+            return True
+        if self.persistence is not None:
+            self.persistence.update_conversation(handler.name, key,
+                                                 new_state)
+        elif new_state is None:
+            self.conversations[handler.name].pop(key, None)
+        else:
+            self.conversations[handler.name][key] = new_state
+        return True
+
+    async def _conversation_state(self, name: str,
+                                  key: Tuple[int, int]) -> Optional[object]:
+        if self.persistence is not None:
+            return await self.persistence.load_conversation(name, key)
+        return self.conversations[name].get(key)
+
+    async def wait(self):
+        """Waits until all updates processed so far were handled."""
+        await self._idle.wait()
+
+    def update_stats(self) -> str:
+        return (f"Updates in progress or queued: {self.pending}, "
+                f"in {len(self._chat_queues)} chats")
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+
+    def initialize(self, dispatcher: AsyncDispatcher):
+        self.dispatcher = dispatcher
+
+    def post(self):
+        try:
+            update = Update.de_json(json.loads(self.request.body), None)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        # Telegram is answered right away, the update is handled meanwhile.
+        self.dispatcher.process_update(update)
+
+
+def serve_webhook(dispatcher: AsyncDispatcher, port: int,
+                  url_path: Optional[str],
+                  metrics_path: Optional[str]) -> HTTPServer:
+    """Starts a server handing the updates Telegram posts to url_path, if it
+    is set, to the dispatcher, and serving the metrics at metrics_path if it
+    is set."""
+    handlers = []
+    if url_path:
+        handlers.append(
+            (url_path, WebhookHandler, dict(dispatcher=dispatcher)))
+    if metrics_path:
+        handlers.append((metrics_path, MetricsHandler))
+    server = HTTPServer(tornado.web.Application(handlers))
+    server.listen(port)
+    return server
+
+
+async def poll(api: AsyncBotApi, dispatcher: AsyncDispatcher):
+    """Hands updates fetched with long polling to the dispatcher until
+    cancelled."""
+    await api.delete_webhook()
+    offset = None
+    failures = 0
+    while True:
+        try:
+            updates = await api.get_updates(offset, POLL_TIMEOUT_SEC)
+        except telegram.error.TelegramError as e:
+            retry_sec = POLL_RETRY_SEC[min(failures, len(POLL_RETRY_SEC) - 1)]
+            failures += 1
+            logger.warning(f"Polling failed, retrying in {retry_sec}s: {e}")
+            await asyncio.sleep(retry_sec)
+            continue
+        failures = 0
+        for update in updates:
+            offset = update.update_id + 1
+            dispatcher.process_update(update)
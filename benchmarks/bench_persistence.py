@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Measures RedisPersistence startup and update cost for many stored users.
+
+The state is seeded in the whole-state format older versions of
+bot_redis_persistence wrote, so the same run works against any revision:
+
+    $ python -m benchmarks.bench_persistence --users 100000
+
+Redis is emulated in-process with fakeredis, so the numbers include no
+network round trips.
+"""
+
+from cryptography.fernet import Fernet
+from telegram import Chat, Message, User
+import argparse
+import datetime
+import fakeredis
+import pickle
+import random
+import resource
+import time
+import tracemalloc
+
+import bot_redis_persistence
+
+CONVERSATION_NAME = "main"
+LEGACY_REDIS_KEY = "TelegramBotPersistence"
+NODES = ["/start", "Страховка", "Пермит S", "Жилье", "Работа", "Школа"]
+
+
+def synthetic_user_data(user_id: int, with_feedback: bool):
+    feedback = []
+    if with_feedback:
+        chat = Chat(user_id, Chat.PRIVATE)
+        feedback.append(
+            Message(message_id=user_id,
+                    date=datetime.datetime(2022, 4, 1),
+                    chat=chat,
+                    from_user=User(user_id, "User", False),
+                    text="Спасибо за бота!"))
+    nav_stack = [NODES[0]] + random.sample(NODES[1:], 2)
+    return {
+        "current_node": nav_stack[-1],
+        "nav_stack": nav_stack,
+        "feedback": feedback,
+    }
+
+
+def seed(rd, key: bytes, users: int, feedback_share: float):
+    user_data = {
+        user_id: synthetic_user_data(user_id,
+                                     random.random() < feedback_share)
+        for user_id in range(users)
+    }
+    data = {
+        "conversations": {
+            CONVERSATION_NAME: {(user_id, user_id): 0
+                                for user_id in range(users)}
+        },
+        "user_data": user_data,
+        "chat_data": {},
+        "bot_data": {},
+    }
+    rd.set(LEGACY_REDIS_KEY, Fernet(key).encrypt(pickle.dumps(data)))
+
+
+def start(rd, key: bytes):
+    """Performs the persistence calls telegram.ext.Dispatcher does on
+    creation."""
+    persistence = bot_redis_persistence.RedisPersistence(rd, key)
+    user_data = persistence.get_user_data()
+    persistence.get_chat_data()
+    persistence.get_bot_data()
+    persistence.get_conversations(CONVERSATION_NAME)
+    return persistence, user_data
+
+
+def handle_updates(persistence, user_data, users: int, updates: int):
+    """Performs the persistence calls telegram.ext.Dispatcher does around a
+    handler that navigates to another node."""
+    for _ in range(updates):
+        user_id = random.randrange(users)
+        persistence.refresh_user_data(user_id, user_data[user_id])
+        data = user_data[user_id]
+        node = random.choice(NODES)
+        data["current_node"] = node
+        data.setdefault("nav_stack", [NODES[0]]).append(node)
+        persistence.update_user_data(user_id, data)
+        persistence.update_conversation(CONVERSATION_NAME, (user_id, user_id),
+                                        0)
+    persistence.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--feedback-share",
+                        type=float,
+                        default=0.01,
+                        help="share of users with pending feedback messages")
+    parser.add_argument("--memory",
+                        action="store_true",
+                        help="trace peak Python memory instead of timing")
+    args = parser.parse_args()
+
+    random.seed(1)
+    key = Fernet.generate_key()
+    rd = fakeredis.FakeRedis()
+    seed(rd, key, args.users, args.feedback_share)
+
+    # The first start may convert the seeded state to the current format.
+    t0 = time.perf_counter()
+    start(rd, key)[0].flush()
+    print(f"first startup: {time.perf_counter() - t0:.3f} s")
+
+    if args.memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    persistence, user_data = start(rd, key)
+    t1 = time.perf_counter()
+    if args.memory:
+        startup_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+    handle_updates(persistence, user_data, args.users, args.updates)
+    t2 = time.perf_counter()
+    if args.memory:
+        update_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"startup peak traced memory: {startup_peak / 2**20:.1f} MiB")
+        print(f"update peak traced memory: {update_peak / 2**20:.1f} MiB")
+    else:
+        print(f"startup: {t1 - t0:.3f} s")
+        print(f"update: {(t2 - t1) / args.updates * 1000:.2f} ms/update")
+    print(f"process peak RSS (incl. seeding): "
+          f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Measures the time to get the conversation and its search index ready.
+
+Every sample runs in a fresh interpreter, like a dyno boot. A cold start has
+no search index snapshot, a warm start loads the snapshot the previous run
+saved, and an artifact start loads a compiled conversation artifact instead
+of parsing the textproto. --python-protobuf measures with the pure Python
+protobuf implementation:
+
+    $ python -m benchmarks.bench_startup --runs 3
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CONVERSATION_FILE = "conversation_tree.textproto"
+
+
+def start_once(snapshot_dir: str, query: str, artifact: str) -> dict:
+    t0 = time.perf_counter()
+    import google.protobuf.text_format as text_format
+    import proto.conversation_pb2 as conversation_proto
+    from conversation_artifact import load_artifact
+    from conversation_data import ConversationData
+    from conversation_loader import content_hash
+    from morpho_index import MorphoIndex
+    t_import = time.perf_counter()
+    with open(CONVERSATION_FILE, "r") as f:
+        textproto = f.read()
+    if artifact:
+        # The index is part of the artifact, so it is loaded with it.
+        loaded = load_artifact(artifact, content_hash(textproto))
+        conversation, index = loaded.conversation, loaded.morpho_index
+        ConversationData(conversation)
+        t_parse = time.perf_counter()
+    else:
+        conversation = text_format.Parse(textproto,
+                                         conversation_proto.Conversation())
+        ConversationData(conversation)
+        t_parse = time.perf_counter()
+        index = MorphoIndex.load_or_build(conversation, textproto,
+                                          snapshot_dir)
+    t_index = time.perf_counter()
+    index.search(query)
+    t_query = time.perf_counter()
+    return {
+        "import": t_import - t0,
+        "parse": t_parse - t_import,
+        "index": t_index - t_parse,
+        "first query": t_query - t_index,
+        "total": t_query - t0,
+    }
+
+
+def sample(snapshot_dir: str,
+           query: str,
+           artifact: str = "",
+           python_protobuf: bool = False) -> dict:
+    env = dict(os.environ)
+    if python_protobuf:
+        env["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
+    output = subprocess.check_output([
+        sys.executable, "-m", "benchmarks.bench_startup", "--child",
+        snapshot_dir, "--query", query, "--artifact", artifact
+    ],
+                                     env=env)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def report(label: str, samples):
+    print(f"{label}:")
+    for phase in samples[0]:
+        values = [s[phase] for s in samples]
+        print(f"  {phase:>12}: {statistics.median(values) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--query", default="медицинская страховка")
+    parser.add_argument("--python-protobuf", action="store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--artifact", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(start_once(args.child, args.query, args.artifact)))
+        return
+
+    from conversation_artifact import write_artifact
+    with open(CONVERSATION_FILE, "r") as f:
+        textproto = f.read()
+    cold, warm, compiled = [], [], []
+    for _ in range(args.runs):
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            artifact = os.path.join(snapshot_dir, "conversation.bin")
+            write_artifact(artifact, textproto)
+            cold.append(
+                sample(snapshot_dir, args.query, "", args.python_protobuf))
+            warm.append(
+                sample(snapshot_dir, args.query, "", args.python_protobuf))
+            compiled.append(
+                sample(snapshot_dir, args.query, artifact,
+                       args.python_protobuf))
+        finally:
+            shutil.rmtree(snapshot_dir)
+    report("cold start", cold)
+    report("warm start", warm)
+    report("artifact start", compiled)
+
+
+if __name__ == "__main__":
+    main()
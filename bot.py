@@ -1,10 +1,27 @@
 #!/usr/bin/env python
 
-from collections import deque
 from conversation_data import ConversationData
-from bot_redis_persistence import RedisPersistence
-from functools import reduce
-from morpho_index import MorphoIndex
+from bot_redis_persistence import AsyncRedisPersistence, RedisPersistence
+from chat_dispatcher import ChatOrderedDispatcher
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, reduce
+from morpho_index import (
+    BREADCRUMB_SEPARATOR,
+    MorphoIndex,
+    load_morph_analyzers,
+    word_tags_cache_stats,
+)
+from photo_cache import PhotoCache
+from queue import Queue
+from replicas import ChatLocks, ReloadBroadcaster, ReplicaDispatcher
+from rate_limiter import (
+    CHANNEL_PRIORITY,
+    USER_PRIORITY,
+    OutboundLimiter,
+    RateLimitedBot,
+)
+from runtime import BotApi, ThreadedBotApi, resolved, sync_handler
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -17,22 +34,36 @@ from telegram import (
 from telegram.ext import (
     CallbackContext,
     CallbackQueryHandler,
+    ContextTypes,
     ConversationHandler,
     Filters,
+    JobQueue,
     MessageHandler,
     Updater,
 )
+from telegram.utils.request import Request
+from typing import Callable, Coroutine, List, Optional, Tuple
 from urllib.parse import urlparse
+import asyncio
+import async_runtime
 import bot_messages
 import config
+import conversation_artifact
+import conversation_loader
+import datetime
+import delivery
 import error_handler
 import google.protobuf.text_format as text_format
 import logging
+import monitoring
 import proto.conversation_pb2 as conversation_proto
 import redis
-import ssl
+import redis.asyncio
+import signal
 import telegram.error
-import urllib.request
+import threading
+import time
+import urllib.error
 import stats
 
 logging.basicConfig(
@@ -41,8 +72,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 bot_stats: stats.Stats = None
-morpho_index: MorphoIndex = None
-convo_data: ConversationData = None
+
+# Everything derived from one version of the conversation. Snapshots are never
+# modified after they are published, a reload publishes a new one.
+ConversationSnapshot = namedtuple(
+    "ConversationSnapshot", ["convo_data", "morpho_index", "content_hash"])
+conversation_snapshot: ConversationSnapshot = None
+conversation_source = conversation_loader.ConversationLoader(
+    config.CONVERSATION_MODEL_URL,
+    config.CACHE_DIR,
+    fallback_url=config.CONVERSATION_MODEL_LOCAL_URL)
+# Reloads run one at a time, off the dispatcher's worker threads.
+reload_executor = ThreadPoolExecutor(max_workers=1,
+                                     thread_name_prefix="ConversationReloader")
+# Set when running as one of several replicas.
+reload_broadcaster = None
+# Told to the admin when the conversation could not be fetched, by the source
+# used instead.
+USED_INSTEAD_OF_FETCHED = {
+    conversation_loader.FROM_CACHE: "Используется сохранённая копия.",
+    conversation_loader.FROM_FALLBACK:
+    "Используется копия диалога, встроенная в бота.",
+}
 
 CHOOSING, START_FEEDBACK, COLLECT_FEEDBACK, ADMIN_MENU, SEARCH_FAILED = \
     range(5)
@@ -50,208 +101,355 @@ TOP_N_SEARCH_RESULTS = 3
 
 START_NODE = "/start"
 
-PHOTO_CACHE = {}
-BOT_PERSISTENCE_DATABASE, BOT_METRICS_DATABASE = range(2)
-
+PHOTO_DIR = "photo"
+# Updater workers, for handlers run asynchronously. The Updater default.
+UPDATE_WORKERS = 4
 
-def redis_instance(redis_db: int):
+BOT_PERSISTENCE_DATABASE, BOT_METRICS_DATABASE = range(2)
+# Update handlers, Updater workers and the threads writing sessions, sending
+# in the background, reloading and listening for reloads.
+REDIS_MAX_CONNECTIONS = config.REDIS_MAX_CONNECTIONS or \
+    config.CONCURRENT_UPDATES + UPDATE_WORKERS + 4
+redis_clients = {}
+redis_clients_lock = threading.Lock()
+async_redis_clients = {}
+
+
+def redis_pool_options(redis_db: int) -> dict:
+    """Returns the options of the connection pool of a Redis database: up
+    to REDIS_MAX_CONNECTIONS connections, which are kept alive and checked
+    before use when they have been idle."""
     url = urlparse(config.REDIS_URL)
-    use_ssl = url.scheme == 'rediss'
     logger.info(
-        f"Enabling Redis-based bot persistence.\n"
-        f"Redis on: {url.hostname}:{url.port}\nUse SSL: {use_ssl}"
-    )
-    return redis.Redis(
-        db=redis_db,
-        host=url.hostname,
-        port=url.port,
-        username=url.username,
-        password=url.password,
-        ssl=use_ssl,
-        ssl_cert_reqs=None,
-    )
-
-
-def redis_persistence():
-    encryption_key_bytes = None
+        f"Connecting to Redis database {redis_db} on "
+        f"{url.hostname}:{url.port}, "
+        f"use SSL: {url.scheme == 'rediss'}, "
+        f"max connections: {REDIS_MAX_CONNECTIONS}")
+    ssl_options = {"ssl_cert_reqs": None} \
+        if url.scheme == "rediss" else {}
+    return dict(db=redis_db,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=config.REDIS_POOL_TIMEOUT_SEC,
+                socket_timeout=config.REDIS_SOCKET_TIMEOUT_SEC,
+                socket_connect_timeout=config.REDIS_SOCKET_TIMEOUT_SEC,
+                socket_keepalive=True,
+                retry_on_timeout=True,
+                health_check_interval=config.REDIS_HEALTH_CHECK_INTERVAL_SEC,
+                **ssl_options)
+
+
+def redis_instance(redis_db: int) -> redis.Redis:
+    """Returns the client of a Redis database. Clients are shared, each has
+    its own connection pool."""
+    with redis_clients_lock:
+        client = redis_clients.get(redis_db)
+        if client is not None:
+            return client
+        pool = redis.BlockingConnectionPool.from_url(
+            config.REDIS_URL, **redis_pool_options(redis_db))
+        client = redis_clients[redis_db] = redis.Redis(connection_pool=pool)
+        return client
+
+
+def async_redis_instance(redis_db: int) -> redis.asyncio.Redis:
+    """Returns the asyncio client of a Redis database, for the asyncio
+    runtime. Clients are shared by the tasks of its event loop, which wait
+    for a connection of the pool."""
+    client = async_redis_clients.get(redis_db)
+    if client is not None:
+        return client
+    pool = redis.asyncio.BlockingConnectionPool.from_url(
+        config.REDIS_URL, **redis_pool_options(redis_db))
+    client = async_redis_clients[redis_db] = redis.asyncio.Redis(
+        connection_pool=pool)
+    return client
+
+
+def encryption_key() -> Optional[bytes]:
     if config.BOT_STATE_ENCRYPTION_KEY is None:
         logger.error(
             "*** EMPTY BOT_STATE_ENCRYPTION_KEY *** "
             "YOU SHOULD NEVER SEE THIS IN PROD ***"
         )
-    else:
-        encryption_key_bytes = config.BOT_STATE_ENCRYPTION_KEY.encode()
-    rd = redis_instance(BOT_PERSISTENCE_DATABASE)
-    return RedisPersistence(rd, encryption_key_bytes)
-
+        return None
+    return config.BOT_STATE_ENCRYPTION_KEY.encode()
 
-persistence = redis_persistence() if config.PERSIST_SESSIONS else None
 
-
-def handle_error(update: object, context: CallbackContext):
-    error_handler.handle_error(update, context)
+def redis_persistence():
+    encryption_key_bytes = encryption_key()
+    rd = redis_instance(BOT_PERSISTENCE_DATABASE)
+    if config.MULTI_REPLICA:
+        return RedisPersistence(rd, encryption_key_bytes, versioned=True)
+    return RedisPersistence(
+        rd,
+        encryption_key_bytes,
+        write_behind_interval=config.SESSION_WRITE_BEHIND_MS / 1000,
+        max_pending_writes=config.SESSION_WRITE_BEHIND_MAX_PENDING)
+
+
+def async_redis_persistence() -> AsyncRedisPersistence:
+    return AsyncRedisPersistence(
+        async_redis_instance(BOT_PERSISTENCE_DATABASE),
+        encryption_key(),
+        write_behind_interval=config.SESSION_WRITE_BEHIND_MS / 1000,
+        max_pending_writes=config.SESSION_WRITE_BEHIND_MAX_PENDING)
+
+
+# The asyncio runtime creates its clients on its event loop, see
+# run_async_bot.
+persistence = redis_persistence() \
+    if config.PERSIST_SESSIONS and not config.ASYNC_RUNTIME else None
+photo_cache = PhotoCache(
+    PHOTO_DIR,
+    redis_instance(BOT_PERSISTENCE_DATABASE)
+    if config.PERSIST_SESSIONS and not config.ASYNC_RUNTIME else None)
+
+
+async def handle_error(update: object, context: CallbackContext):
+    await error_handler.handle_error(update, context)
     reset_user_state(context)
 
 
-def back_choice(update: Update, context: CallbackContext) -> int:
+@monitoring.time_handler("back_choice")
+async def back_choice(update: Update, context: CallbackContext) -> int:
     user_data = context.user_data
     user_data["nav_stack"] = user_data["nav_stack"][:-1] \
         if len(user_data["nav_stack"]) > 1 else user_data["nav_stack"]
 
     new_node_name = user_data["nav_stack"][-1]
     user_data["current_node"] = new_node_name
-    update_state_and_send_conversation(update, context,
-                                       context.user_data["current_node"])
+    await update_state_and_send_conversation(
+        update, context, context.user_data["current_node"])
     return CHOOSING
 
 
-def start(update: Update, context: CallbackContext) -> int:
+async def start(update: Update, context: CallbackContext) -> int:
     reset_user_state(context)
-    update_state_and_send_conversation(update, context,
-                                       context.user_data["current_node"])
+    await update_state_and_send_conversation(
+        update, context, context.user_data["current_node"])
     return CHOOSING
 
 
-def show_admin_menu(update: Update, context: CallbackContext) -> int:
+async def show_admin_menu(update: Update, context: CallbackContext) -> int:
     keyboard_opts = [
         [bot_messages.RELOAD],
         [bot_messages.STATISTICS],
         [bot_messages.START_OVER],
     ]
-    update.message.reply_text(bot_messages.ADMIN_PROMPT,
-                              parse_mode=ParseMode.HTML,
-                              reply_markup=ReplyKeyboardMarkup(keyboard_opts))
+    await context.api.send_message(
+        update.message.chat_id,
+        bot_messages.ADMIN_PROMPT,
+        parse_mode=ParseMode.HTML,
+        reply_markup=ReplyKeyboardMarkup(keyboard_opts))
     return ADMIN_MENU
 
 
-def show_stats(update: Update, context: CallbackContext) -> int:
+async def show_stats(update: Update, context: CallbackContext) -> int:
     keyboard_opts = [[bot_messages.START_OVER]]
-    update.message.reply_text(bot_stats.compute(),
-                              parse_mode=ParseMode.HTML,
-                              reply_markup=ReplyKeyboardMarkup(keyboard_opts))
+    await context.api.send_message(
+        update.message.chat_id,
+        await bot_stats.compute(),
+        parse_mode=ParseMode.HTML,
+        reply_markup=ReplyKeyboardMarkup(keyboard_opts))
 
-    return show_admin_menu(update, context)
+    return await show_admin_menu(update, context)
 
 
-def pull_conversation():
+def pull_conversation() -> conversation_loader.FetchResult:
     logger.info(
         f"Loading conversation model from {config.CONVERSATION_MODEL_URL}")
-    try:
-        with urllib.request.urlopen(config.CONVERSATION_MODEL_URL,
-                                    context=ssl.create_default_context()) as f:
-            return f.read().decode("utf-8")
-    except urllib.error.URLError as e:
-        logger.error(
-            f"Failed to load conversation from "
-            f"{config.CONVERSATION_MODEL_URL}",
-            exc_info=e)
-        raise e
+    return conversation_source.fetch()
 
 
-def reload_conversation(update: Update, context: CallbackContext) -> int:
+async def reload_conversation(update: Update,
+                              context: CallbackContext) -> int:
     username = update.message.from_user.username
 
     logger.info(f"Reloading conversation from {config.CONVERSATION_MODEL_URL}")
+    await context.api.send_message(update.message.chat_id,
+                                   "Загружаю диалог...")
+    context.api.run_in_background(
+        reload_conversation_in_background(context.api,
+                                          update.message.chat_id, username))
+    return await show_admin_menu(update, context)
+
+
+async def reload_conversation_in_background(api: BotApi, chat_id: int,
+                                            username: str):
+    """Fetches the conversation and publishes it, replying to the admin's
+    chat once done. Updates keep being handled with the loaded conversation
+    meanwhile."""
     try:
-        convo_buffer = pull_conversation()
-        reset_bot_data(convo_buffer, update)
+        fetched = await api.run_blocking(pull_conversation)
+        if fetched.error is not None:
+            await api.send_message(
+                chat_id,
+                f"Ошибка загрузки диалога:\n{fetched.error}\n"
+                f"{USED_INSTEAD_OF_FETCHED[fetched.source]}",
+                reply_markup=ReplyKeyboardMarkup([[bot_messages.START_OVER]],
+                                                 one_time_keyboard=True))
+        if fetched.content_hash == conversation_snapshot.content_hash:
+            logger.info(f"Conversation has not changed ({username})")
+            await api.send_message(chat_id, "Диалог не изменился.")
+            return
+        report = await api.run_blocking(reset_bot_data, fetched.textproto)
         bot_stats.conversation_reloaded(username)
         logger.info(f"Conversation reload successful ({username})")
+        if reload_broadcaster is not None:
+            reload_broadcaster.publish(fetched.content_hash)
+        await api.send_message(chat_id, report)
     except urllib.error.URLError as e:
-        update.message.reply_text(f"Ошибка загрузки диалога:\n{e}",
-                                  reply_markup=ReplyKeyboardMarkup(
-                                      [[bot_messages.START_OVER]],
-                                      one_time_keyboard=True))
-        start(update, context)
-
-    return show_admin_menu(update, context)
-
-
-def reset_bot_data(conversation_textproto: str, update: Update = None):
-    global convo_data, morpho_index
-    conversation = text_format.Parse(conversation_textproto,
-                                     conversation_proto.Conversation())
-    morpho_index = MorphoIndex(conversation)
-
-    convo_data = ConversationData(conversation)
-    if update:
-        update.message.reply_text("Диалог успешно перезагружен.")
-
-
-def handle_answer(answer, update: Update):
-    message = update.message \
-            if update.message else update.callback_query.message
-    if len(answer.text) > 0:
-        message.reply_text(answer.text, parse_mode=ParseMode.HTML)
-    elif len(answer.links.text) > 0:
-        links = answer.links
-        buttons = []
-        for url in links.url:
-            buttons.append([InlineKeyboardButton(url.label, url=url.url)])
-        reply_markup = InlineKeyboardMarkup(buttons)
-        message.reply_text(
-            links.text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup,
-        )
-    elif len(answer.venue.title) > 0:
-        message.reply_venue(latitude=answer.venue.lat,
-                            longitude=answer.venue.lon,
-                            title=answer.venue.title,
-                            address=answer.venue.address,
-                            google_place_id=answer.venue.google_place_id)
-    elif len(answer.photo) > 0:
-        photob = None
-        if answer.photo in PHOTO_CACHE:
-            photob = PHOTO_CACHE[answer.photo]
-        with open("photo/%s" % answer.photo, "rb") as photo_file:
-            photob = photo_file.read()
-            PHOTO_CACHE[answer.photo] = photob
-        message.reply_photo(photob)
+        await api.send_message(chat_id,
+                               f"Ошибка загрузки диалога:\n{e}",
+                               reply_markup=ReplyKeyboardMarkup(
+                                   [[bot_messages.START_OVER]],
+                                   one_time_keyboard=True))
+    except Exception as e:
+        logger.error("Conversation reload failed", exc_info=e)
+        await api.send_message(chat_id,
+                               f"Ошибка перезагрузки диалога:\n{e}")
+
+
+def reload_announced_conversation(content_hash: str):
+    """Reloads the conversation after another replica has reloaded it."""
+    try:
+        if content_hash == conversation_snapshot.content_hash:
+            return
+        fetched = pull_conversation()
+        if fetched.content_hash != content_hash:
+            logger.warning(f"Fetched conversation {fetched.content_hash} "
+                           f"differs from the one reloaded by another "
+                           f"replica, {content_hash}")
+        if fetched.content_hash != conversation_snapshot.content_hash:
+            reset_bot_data(fetched.textproto)
+    except Exception as e:
+        logger.error("Reload of the conversation announced by another "
+                     "replica failed",
+                     exc_info=e)
+
+
+def reset_bot_data(conversation_textproto: str) -> str:
+    """Loads a conversation and publishes it as the current snapshot. Parts of
+    the previously loaded conversation that have not changed are reused.
+
+    Returns:
+        str: a report of the reload for the admin.
+    """
+    global conversation_snapshot
+    start_time = time.perf_counter()
+    previous = conversation_snapshot or ConversationSnapshot(None, None, None)
+    content_hash = conversation_loader.content_hash(conversation_textproto)
+    artifact = conversation_artifact.load_artifact(
+        config.CONVERSATION_ARTIFACT, content_hash)
+    if artifact:
+        conversation = artifact.conversation
+        new_morpho_index = artifact.morpho_index
+    else:
+        conversation = text_format.Parse(conversation_textproto,
+                                         conversation_proto.Conversation())
+        new_morpho_index = MorphoIndex.load_or_build(
+            conversation,
+            conversation_textproto,
+            config.CACHE_DIR,
+            previous=previous.morpho_index)
+    snapshot = ConversationSnapshot(
+        convo_data=ConversationData(conversation,
+                                    previous=previous.convo_data),
+        morpho_index=new_morpho_index,
+        content_hash=content_hash)
+    # A single reference swap: an update sees either the old or the new
+    # snapshot as a whole.
+    conversation_snapshot = snapshot
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    monitoring.RELOAD_DURATION.observe(elapsed_ms / 1000)
+    convo_data = snapshot.convo_data
+    changed_count = len(convo_data.changed_node_names)
+    removed_count = len(convo_data.removed_node_names)
+    logger.info(f"Conversation loaded in {elapsed_ms:.0f} ms: "
+                f"{changed_count} of {len(convo_data)} nodes new or changed, "
+                f"{removed_count} removed, "
+                f"{snapshot.morpho_index.reindexed_node_count} re-indexed")
+    return (f"Диалог успешно перезагружен за {elapsed_ms:.0f} мс.\n"
+            f"Новых или изменённых узлов: {changed_count} "
+            f"из {len(convo_data)}, удалённых: {removed_count}.")
+
+
+class BotContext(CallbackContext):
+    """Callback context holding the conversation snapshot that was current
+    when handling of the update started, so all handlers of an update see
+    the same conversation even if a reload is published meanwhile, and the
+    BotApi of the threaded runtime."""
+
+    def __init__(self, dispatcher):
+        super().__init__(dispatcher)
+        self.conversation: ConversationSnapshot = conversation_snapshot
+        self.api = ThreadedBotApi(dispatcher.bot, reload_executor)
+
+
+class AsyncBotContext(async_runtime.AsyncContext):
+    """BotContext of the asyncio runtime."""
+
+    def __init__(self, api: BotApi, user_data: dict):
+        super().__init__(api, user_data)
+        self.conversation: ConversationSnapshot = conversation_snapshot
 
 
 def is_admin_user(username: str):
     return username in config.ADMIN_USERS
 
 
-def choice(update: Update, context: CallbackContext) -> int:
+@monitoring.time_handler("choice")
+async def choice(update: Update, context: BotContext) -> int:
     if not update.message:
         return CHOOSING
 
     user_data = context.user_data
     requested_node_name = update.message.text
+    convo_data = context.conversation.convo_data
     if convo_data.node_by_name(requested_node_name) is None:
-        return search(update, context, requested_node_name)
+        return await search(update, context, requested_node_name)
     display_node_name = requested_node_name
     keyboard_node_name = user_data["current_node"]
-    update_state_and_send_conversation(update, context, keyboard_node_name,
-                                       display_node_name)
+    await update_state_and_send_conversation(update, context,
+                                             keyboard_node_name,
+                                             display_node_name)
     return CHOOSING
 
 
-def search(update: Update, context: CallbackContext, search_terms: str):
-    search_results = morpho_index.search(search_terms)
+@monitoring.time_handler("search")
+async def search(update: Update, context: BotContext, search_terms: str):
+    convo_data = context.conversation.convo_data
+    morpho_index = context.conversation.morpho_index
+    with monitoring.SEARCH_LATENCY.time():
+        search_results, matching_nodes = morpho_index.search_top_k(
+            search_terms, TOP_N_SEARCH_RESULTS)
+    monitoring.SEARCH_RESULTS.observe(matching_nodes)
     user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
     if search_results:
-        bot_stats.collect_search(user_id, search_terms, len(search_results))
-        if len(search_results) == 1:
+        bot_stats.collect_search(user_id, search_terms, matching_nodes)
+        if matching_nodes == 1:
             display_node_name = search_results[0][0]
-            update.message.reply_text(
+            await context.api.send_message(
+                chat_id,
                 bot_messages.SINGLE_SEARCH_RESULT_HEADER_TEMPLATE.format(
                     display_node_name))
-            update_state_and_send_conversation(
+            await update_state_and_send_conversation(
                 update, context, context.user_data["current_node"],
                 display_node_name)
         else:
             buttons = []
-            for result in search_results[:TOP_N_SEARCH_RESULTS]:
+            for result in search_results:
                 buttons.append([
-                    InlineKeyboardButton(text=result.node_label,
-                                         callback_data=hash(result.node_name))
+                    InlineKeyboardButton(
+                        text=result.node_label,
+                        callback_data=convo_data.callback_data(
+                            result.node_name))
                 ])
             reply_markup = InlineKeyboardMarkup(buttons)
-            update.message.reply_text(bot_messages.SEARCH_RESULT_HEADER,
-                                      reply_markup=reply_markup)
+            await context.api.send_message(chat_id,
+                                           bot_messages.SEARCH_RESULT_HEADER,
+                                           reply_markup=reply_markup)
         return CHOOSING
     else:
         logger.info(f"Freetext search yielded nothing: [{search_terms}]")
@@ -261,40 +459,70 @@ def search(update: Update, context: CallbackContext, search_terms: str):
             keyboard_options.append([bot_messages.FEEDBACK])
         keyboard_options.extend([[bot_messages.BACK],
                                  [bot_messages.START_OVER]])
-        update.message.reply_text(
+        await context.api.send_message(
+            chat_id,
             bot_messages.EMPTY_SEARCH_RESULTS,
             reply_markup=ReplyKeyboardMarkup(keyboard_options,
                                              one_time_keyboard=True))
         return SEARCH_FAILED
 
 
-def search_failed_back(update: Update, context: CallbackContext) -> int:
-    update_state_and_send_conversation(update, context,
-                                       context.user_data["current_node"])
+async def search_failed_back(update: Update,
+                             context: CallbackContext) -> int:
+    await update_state_and_send_conversation(
+        update, context, context.user_data["current_node"])
     return CHOOSING
 
 
-def search_again(update: Update, context: CallbackContext) -> int:
-    return search(update, context, update.message.text)
+async def search_again(update: Update, context: CallbackContext) -> int:
+    return await search(update, context, update.message.text)
+
 
+def node_by_button_label(convo_data: ConversationData,
+                         callback_query: telegram.CallbackQuery):
+    """Finds the node of a pressed search result button by its label.
 
-def on_button(update: Update, context: CallbackContext):
-    new_node = convo_data.node_by_hash(update.callback_query.data)
+    Used for buttons sent before the conversation was changed or with an
+    older callback data format.
+    """
+    if callback_query.message is None or \
+            callback_query.message.reply_markup is None:
+        return None
+    for row in callback_query.message.reply_markup.inline_keyboard:
+        for button in row:
+            if button.callback_data == callback_query.data:
+                node_name = button.text.rsplit(BREADCRUMB_SEPARATOR, 1)[-1]
+                return convo_data.node_by_name(node_name)
+    return None
+
+
+@monitoring.time_handler("on_button")
+async def on_button(update: Update, context: BotContext):
+    convo_data = context.conversation.convo_data
+    callback_query = update.callback_query
+    new_node = convo_data.node_by_callback_data(callback_query.data)
+    if new_node is None:
+        new_node = node_by_button_label(convo_data, callback_query)
     if new_node is None:
+        await context.api.answer_callback_query(
+            callback_query.id,
+            bot_messages.SEARCH_RESULT_OUTDATED,
+            show_alert=True)
         return
     current_node = context.user_data["current_node"]
     context.user_data["current_node"] = new_node.name
-    update.callback_query.answer()
-    update.callback_query.message.reply_text(f"<b>{new_node.name}</b>",
-                                             parse_mode=ParseMode.HTML)
-    update_state_and_send_conversation(update, context, current_node,
-                                       new_node.name)
-
-
-def update_state_and_send_conversation(update: Update,
-                                       context: CallbackContext,
-                                       keyboard_node_name: str,
-                                       display_node_name: str = None):
+    await context.api.answer_callback_query(callback_query.id)
+    await context.api.send_message(callback_query.message.chat_id,
+                                   f"<b>{new_node.name}</b>",
+                                   parse_mode=ParseMode.HTML)
+    await update_state_and_send_conversation(update, context, current_node,
+                                             new_node.name)
+
+
+async def update_state_and_send_conversation(update: Update,
+                                             context: BotContext,
+                                             keyboard_node_name: str,
+                                             display_node_name: str = None):
     """Sends a conversation node contents with a keyboard attached.
 
     In case display_node_name does not have keyboard options, the code will
@@ -310,6 +538,7 @@ def update_state_and_send_conversation(update: Update,
     if display_node_name is None:
         display_node_name = keyboard_node_name
 
+    convo_data = context.conversation.convo_data
     user_data = context.user_data
     if convo_data.keyboard_by_name(display_node_name) is not None:
         try:
@@ -325,73 +554,49 @@ def update_state_and_send_conversation(update: Update,
         if update.message else update.callback_query.from_user
     bot_stats.collect_interaction(from_user.id, display_node_name)
 
+    message = update.message \
+        if update.message else update.callback_query.message
     display_node = convo_data.node_by_name(display_node_name)
     if not display_node:
         current_keyboard = ReplyKeyboardMarkup([[bot_messages.START_OVER]],
                                                one_time_keyboard=True)
-        update.message.reply_text(bot_messages.DATA_REFRESHED,
-                                  reply_markup=current_keyboard)
+        await context.api.send_message(message.chat_id,
+                                       bot_messages.DATA_REFRESHED,
+                                       reply_markup=current_keyboard)
         return
 
-    nav_stack_depth = len(user_data["nav_stack"])
-    current_keyboard = build_keyboard_options(
+    current_keyboard = convo_data.keyboard_markup(
         keyboard_node_name,
-        nav_stack_depth,
-        show_feedback_button=nav_stack_depth <= 1,
-        show_admin_button=(nav_stack_depth <= 1
-                           and is_admin_user(from_user.username)))
-
-    for answer in display_node.answer[:-1]:
-        handle_answer(answer, update)
-    last_answer = display_node.answer[-1]
-    message = update.message \
-        if update.message else update.callback_query.message
-    if len(last_answer.text) == 0:
-        handle_answer(last_answer, update)
-        message.reply_text(bot_messages.PROMPT_REPLY,
-                           reply_markup=current_keyboard)
-    else:
-        message.reply_text(last_answer.text,
-                           parse_mode=ParseMode.HTML,
-                           reply_markup=current_keyboard)
-
-
-def build_keyboard_options(keyboard_options_node_name: str = None,
-                           nav_stack_depth: int = 0,
-                           show_feedback_button: bool = False,
-                           show_admin_button: bool = False):
-    current_keyboard_options = deque()
-    if keyboard_options_node_name is not None:
-        current_keyboard_options.extend(
-            convo_data.keyboard_by_name(keyboard_options_node_name))
-    if show_admin_button:
-        current_keyboard_options.appendleft([bot_messages.ADMIN])
-    if show_feedback_button and config.FEEDBACK_CHANNEL_ID is not None:
-        current_keyboard_options.append([bot_messages.FEEDBACK])
-    if nav_stack_depth >= 2:
-        current_keyboard_options.append([bot_messages.BACK])
-    if nav_stack_depth > 2:
-        current_keyboard_options.append([bot_messages.START_OVER])
-    return ReplyKeyboardMarkup(current_keyboard_options,
-                               one_time_keyboard=True)
-
-
-def start_feedback(update: Update, context: CallbackContext):
+        len(user_data["nav_stack"]),
+        show_admin_button=is_admin_user(from_user.username),
+        feedback_enabled=config.FEEDBACK_CHANNEL_ID is not None)
+
+    await delivery.deliver(
+        context.api, message.chat_id,
+        delivery.plan(display_node.answers, current_keyboard,
+                      bot_messages.PROMPT_REPLY), photo_cache)
+
+
+async def start_feedback(update: Update, context: CallbackContext):
     if config.FEEDBACK_CHANNEL_ID is None:
-        return start(update, context)
+        return await start(update, context)
     keyboard_options = [bot_messages.START_OVER]
-    update.message.reply_text(bot_messages.PROMPT_FEEDBACK,
-                              reply_markup=ReplyKeyboardMarkup(
-                                  [keyboard_options], one_time_keyboard=True))
+    await context.api.send_message(update.message.chat_id,
+                                   bot_messages.PROMPT_FEEDBACK,
+                                   reply_markup=ReplyKeyboardMarkup(
+                                       [keyboard_options],
+                                       one_time_keyboard=True))
     return COLLECT_FEEDBACK
 
 
-def collect_feedback(update: Update, context: CallbackContext):
+async def collect_feedback(update: Update, context: CallbackContext):
     if config.FEEDBACK_CHANNEL_ID is None:
-        return start(update, context)
+        return await start(update, context)
     if context.user_data["feedback"] is None:
         context.user_data["feedback"] = []
-    context.user_data["feedback"].append(update.message)
+    # Only the ids are kept, the message is forwarded from the user's chat.
+    context.user_data["feedback"].append(
+        (update.message.chat_id, update.message.message_id))
 
     keyboard_options = []
     if len(context.user_data["feedback"]) > 0:
@@ -399,113 +604,139 @@ def collect_feedback(update: Update, context: CallbackContext):
             bot_messages.SEND_FEEDBACK, bot_messages.SEND_FEEDBACK_ANONYMOUSLY
         ])
     keyboard_options.append([bot_messages.START_OVER])
-    update.message.reply_text(bot_messages.CONTINUE_FEEDBACK,
-                              reply_markup=ReplyKeyboardMarkup(
-                                  keyboard_options, one_time_keyboard=True))
+    await context.api.send_message(update.message.chat_id,
+                                   bot_messages.CONTINUE_FEEDBACK,
+                                   reply_markup=ReplyKeyboardMarkup(
+                                       keyboard_options,
+                                       one_time_keyboard=True))
     return COLLECT_FEEDBACK
 
 
-def send_feedback(update: Update, context: CallbackContext):
-    if config.FEEDBACK_CHANNEL_ID is None:
-        return start(update, context)
-    if len(context.user_data["feedback"]) == 0:
-        return start(update, context)
-
+async def forward_feedback(api: BotApi, author: Optional[User],
+                           feedback: List[Tuple[int, int]]):
+    """Forwards feedback messages, as (chat_id, message_id), to the feedback
+    channel. The author is mentioned unless the feedback is anonymous."""
     try:
-        if update.message.text is not None and \
-                update.message.text != bot_messages.SEND_FEEDBACK_ANONYMOUSLY:
-            effective_user_name = update.effective_user.name
-            text = f"Feedback from {effective_user_name}"
-            context.bot.send_message(
-                chat_id=config.FEEDBACK_CHANNEL_ID,
-                text=text,
-                entities=[
-                    MessageEntity(offset=0,
-                                  length=len(text),
-                                  type="text_mention",
-                                  user=User(update.effective_user.id,
-                                            effective_user_name, False))
-                ])
-        for msg in context.user_data["feedback"]:
-            msg.forward(config.FEEDBACK_CHANNEL_ID)
+        if author is not None:
+            text = f"Feedback from {author.name}"
+            await api.send_message(config.FEEDBACK_CHANNEL_ID,
+                                   text,
+                                   entities=[
+                                       MessageEntity(offset=0,
+                                                     length=len(text),
+                                                     type="text_mention",
+                                                     user=User(
+                                                         author.id,
+                                                         author.name, False))
+                                   ])
+        for chat_id, message_id in feedback:
+            await api.forward_message(config.FEEDBACK_CHANNEL_ID,
+                                      from_chat_id=chat_id,
+                                      message_id=message_id)
     except telegram.error.TelegramError as e:
         logger.warning("Error when trying to forward feedback to channel %s",
                        config.FEEDBACK_CHANNEL_ID,
                        exc_info=e)
 
-    bot_stats.collect_interaction(update.message.from_user.id, "Send Feedback")
 
-    context.user_data["feedback"] = []
-    update.message.reply_text(bot_messages.THANK_FOR_FEEDBACK)
-    return start(update, context)
+async def send_feedback(update: Update, context: CallbackContext):
+    if config.FEEDBACK_CHANNEL_ID is None:
+        return await start(update, context)
+    if len(context.user_data["feedback"]) == 0:
+        return await start(update, context)
 
+    anonymous = update.message.text is None or \
+        update.message.text == bot_messages.SEND_FEEDBACK_ANONYMOUSLY
+    context.api.send_in_background(
+        forward_feedback, context.api,
+        None if anonymous else update.effective_user,
+        list(context.user_data["feedback"]))
+
+    bot_stats.collect_interaction(update.message.from_user.id, "Send Feedback")
 
-def conversation_handler(persistent: bool):
+    context.user_data["feedback"] = []
+    await context.api.send_message(update.message.chat_id,
+                                   bot_messages.THANK_FOR_FEEDBACK)
+    return await start(update, context)
+
+
+def conversation_handler(
+        persistent: bool,
+        as_callback: Callable[[Callable[..., Coroutine]],
+                              Callable] = sync_handler
+) -> ConversationHandler:
+    """Returns the handler of the conversation. as_callback makes a callback
+    of the dispatcher from a handler coroutine, it runs the coroutine on the
+    threads of the threaded runtime by default."""
     is_admin_filter = reduce(
         lambda a, b: a | b,
         [Filters.user(username=username) for username in config.ADMIN_USERS])
     return ConversationHandler(
         entry_points=[
-            MessageHandler(Filters.chat_type.private & Filters.all, start)
+            MessageHandler(Filters.chat_type.private & Filters.all,
+                           as_callback(start))
         ],
         states={
             CHOOSING: [
                 MessageHandler(
                     Filters.chat_type.private
-                    & Filters.regex(f"^{bot_messages.BACK}$"), back_choice),
+                    & Filters.regex(f"^{bot_messages.BACK}$"),
+                    as_callback(back_choice)),
                 MessageHandler(
                     Filters.chat_type.private
                     & Filters.regex(f"^{bot_messages.FEEDBACK}$"),
-                    start_feedback),
+                    as_callback(start_feedback)),
                 MessageHandler(
                     Filters.chat_type.private
                     & is_admin_filter
                     & Filters.regex(f"^{bot_messages.ADMIN}$"),
-                    show_admin_menu),
+                    as_callback(show_admin_menu)),
                 MessageHandler(
                     Filters.chat_type.private & Filters.text
-                    & ~Filters.regex(f"^{bot_messages.START_OVER}$"), choice),
+                    & ~Filters.regex(f"^{bot_messages.START_OVER}$"),
+                    as_callback(choice)),
             ],
             COLLECT_FEEDBACK: [
                 MessageHandler(
                     Filters.chat_type.private & Filters.regex(
                         f"^{bot_messages.SEND_FEEDBACK}|"
                         f"{bot_messages.SEND_FEEDBACK_ANONYMOUSLY}$"
-                    ), send_feedback),
+                    ), as_callback(send_feedback)),
                 MessageHandler(
                     Filters.chat_type.private & Filters.all
                     & ~Filters.regex(f"^{bot_messages.START_OVER}$"),
-                    collect_feedback),
+                    as_callback(collect_feedback)),
             ],
             SEARCH_FAILED: [
                 MessageHandler(
                     Filters.chat_type.private
                     & Filters.regex(f"^{bot_messages.FEEDBACK}$"),
-                    start_feedback),
+                    as_callback(start_feedback)),
                 MessageHandler(
                     Filters.chat_type.private
                     & Filters.regex(f"^{bot_messages.BACK}$"),
-                    search_failed_back),
+                    as_callback(search_failed_back)),
                 MessageHandler(
                     Filters.chat_type.private & Filters.all
                     & ~Filters.regex(f"^{bot_messages.START_OVER}$"),
-                    search_again),
+                    as_callback(search_again)),
             ],
             ADMIN_MENU: [
                 MessageHandler(
                     Filters.chat_type.private
                     & Filters.regex(f"^{bot_messages.STATISTICS}$"),
-                    show_stats),
+                    as_callback(show_stats)),
                 MessageHandler(
                     Filters.chat_type.private
                     & Filters.regex(f"^{bot_messages.RELOAD}$"),
-                    reload_conversation),
+                    as_callback(reload_conversation)),
             ],
         },
         fallbacks=[
             MessageHandler(
                 Filters.chat_type.private
-                & Filters.regex(f"^{bot_messages.START_OVER}$"), start),
+                & Filters.regex(f"^{bot_messages.START_OVER}$"),
+                as_callback(start)),
         ],
         name="main",
         persistent=persistent,
@@ -513,10 +744,31 @@ def conversation_handler(persistent: bool):
 
 
 def init_stats():
+    """Creates the metrics of the bot. The asyncio runtime calls it on its
+    event loop, its storage and aggregator run there."""
     global bot_stats
-    storage = stats.RedisStorage(redis_instance(BOT_METRICS_DATABASE)) \
-        if config.PERSIST_METRICS else stats.MemStorage()
-    bot_stats = stats.Stats(storage)
+    retention = datetime.timedelta(days=config.METRICS_RETENTION_DAYS)
+    if not config.PERSIST_METRICS:
+        storage = stats.MemStorage(retention)
+    elif config.ASYNC_RUNTIME:
+        storage = stats.AsyncRedisStorage(
+            async_redis_instance(BOT_METRICS_DATABASE), retention)
+    else:
+        storage = stats.RedisStorage(redis_instance(BOT_METRICS_DATABASE),
+                                     retention)
+    aggregator = None
+    if config.METRICS_QUEUE_SIZE:
+        aggregator_class = stats.AsyncMetricsAggregator \
+            if config.ASYNC_RUNTIME else stats.MetricsAggregator
+        aggregator = aggregator_class(
+            storage,
+            flush_interval=config.METRICS_FLUSH_INTERVAL_MS / 1000,
+            flush_events=config.METRICS_FLUSH_EVENTS,
+            max_pending=config.METRICS_QUEUE_SIZE)
+    bot_stats = stats.Stats(storage, aggregator)
+    bot_stats.add_info_provider(word_tags_cache_stats)
+    if aggregator is not None:
+        bot_stats.add_info_provider(aggregator.stats)
 
 
 def reset_user_state(context: CallbackContext):
@@ -525,15 +777,55 @@ def reset_user_state(context: CallbackContext):
     context.user_data["feedback"] = []
 
 
+def start_reload_broadcaster(rd: redis.Redis):
+    global reload_broadcaster
+    reload_broadcaster = ReloadBroadcaster(
+        rd, lambda content_hash: reload_executor.submit(
+            reload_announced_conversation, content_hash))
+    reload_broadcaster.start()
+
+
 def start_bot():
-    updater = Updater(token=config.API_KEY,
-                      persistence=persistence,
-                      use_context=True)
-    dispatcher = updater.dispatcher
+    # The Updater needs UPDATE_WORKERS + 4 connections, the update handler
+    # threads and the background sender of RateLimitedBot one each.
+    bot = RateLimitedBot(
+        config.API_KEY,
+        OutboundLimiter(),
+        request=Request(con_pool_size=UPDATE_WORKERS + 5 +
+                        config.CONCURRENT_UPDATES))
+    bot_stats.add_info_provider(bot.outbound_stats)
+    dispatcher_class = ChatOrderedDispatcher
+    if config.MULTI_REPLICA:
+        dispatcher_class = partial(ReplicaDispatcher,
+                                   chat_locks=ChatLocks(persistence.redis))
+        start_reload_broadcaster(persistence.redis)
+        bot_stats.add_info_provider(persistence.write_stats)
+    dispatcher = dispatcher_class(
+        bot,
+        Queue(),
+        job_queue=JobQueue(),
+        workers=UPDATE_WORKERS,
+        persistence=persistence,
+        context_types=ContextTypes(context=BotContext),
+        concurrent_updates=config.CONCURRENT_UPDATES,
+        # Metrics stored synchronously are written in one round trip per
+        # update.
+        update_scope=bot_stats.batch)
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    bot_stats.add_info_provider(dispatcher.update_stats)
+    monitoring.track_queue("updates", dispatcher.update_queue.qsize)
+    monitoring.track_queue("chat_updates",
+                           lambda: dispatcher.chat_executor.pending)
+    for priority, name in ((USER_PRIORITY, "outbound_users"),
+                           (CHANNEL_PRIORITY, "outbound_channels")):
+        monitoring.track_queue(name,
+                               partial(bot.limiter.queue_depth, priority))
+    # Updater defaults to 4 workers, which it rejects with a dispatcher.
+    updater = Updater(dispatcher=dispatcher, workers=None)
 
     dispatcher.add_handler(conversation_handler(persistence is not None))
-    dispatcher.add_handler(CallbackQueryHandler(on_button))
-    dispatcher.add_error_handler(handle_error)
+    dispatcher.add_handler(CallbackQueryHandler(sync_handler(on_button)))
+    dispatcher.add_error_handler(sync_handler(handle_error))
 
     if config.USE_WEBHOOK:
         logger.log(logging.INFO, f"Starting webhook at port {config.PORT}")
@@ -545,13 +837,96 @@ def start_bot():
         )
     else:
         updater.start_polling()
+    if config.METRICS_PATH:
+        monitoring.serve(updater, config.METRICS_PATH, config.PORT)
 
     updater.idle()
+    bot_stats.stop()
+
+
+async def run_async_bot():
+    """Serves the bot on the running event loop until SIGINT or SIGTERM."""
+    global persistence
+    init_stats()
+    if config.PERSIST_SESSIONS:
+        persistence = async_redis_persistence()
+        await persistence.migrate_legacy_state()
+        persistence.start()
+        photo_cache.redis = async_redis_instance(BOT_PERSISTENCE_DATABASE)
+    api = async_runtime.AsyncBotApi(
+        config.API_KEY,
+        OutboundLimiter(),
+        reload_executor,
+        max_connections=config.ASYNC_MAX_CONNECTIONS)
+    bot_stats.add_info_provider(api.outbound_stats)
+    dispatcher = async_runtime.AsyncDispatcher(api, AsyncBotContext,
+                                               persistence)
+    bot_stats.add_info_provider(dispatcher.update_stats)
+    monitoring.track_queue("chat_updates", lambda: dispatcher.pending)
+    for priority, name in ((USER_PRIORITY, "outbound_users"),
+                           (CHANNEL_PRIORITY, "outbound_channels")):
+        monitoring.track_queue(name,
+                               partial(api.limiter.queue_depth, priority))
+    dispatcher.add_handler(
+        conversation_handler(persistence is not None,
+                             as_callback=lambda handler: handler))
+    dispatcher.add_handler(CallbackQueryHandler(on_button))
+    dispatcher.add_error_handler(handle_error)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    server = polling = None
+    if config.USE_WEBHOOK:
+        logger.info(f"Starting webhook at port {config.PORT}")
+        server = async_runtime.serve_webhook(dispatcher, config.PORT,
+                                             f"/{config.API_KEY}",
+                                             config.METRICS_PATH)
+        await api.set_webhook(f"{config.WEBHOOK_URL}/{config.API_KEY}")
+    else:
+        polling = asyncio.ensure_future(async_runtime.poll(api, dispatcher))
+        if config.METRICS_PATH:
+            server = async_runtime.serve_webhook(dispatcher, config.PORT,
+                                                 None, config.METRICS_PATH)
+    await stopped.wait()
+
+    if polling is not None:
+        polling.cancel()
+    if server is not None:
+        server.stop()
+    await dispatcher.wait()
+    await api.close()
+    await resolved(bot_stats.stop())
+    if persistence is not None:
+        await persistence.close()
+
+
+def check_config():
+    if config.ASYNC_RUNTIME and config.MULTI_REPLICA:
+        raise ValueError("ASYNC_RUNTIME serves the bot from one process, "
+                         "MULTI_REPLICA is not supported with it")
+    if config.ASYNC_RUNTIME and config.PERSIST_METRICS and \
+            not config.METRICS_QUEUE_SIZE:
+        raise ValueError("ASYNC_RUNTIME stores metrics in Redis from the "
+                         "queue, METRICS_QUEUE_SIZE must not be 0")
+    if config.MULTI_REPLICA and persistence is None:
+        raise ValueError("MULTI_REPLICA needs PERSIST_SESSIONS, replicas "
+                         "share the sessions in Redis")
 
 
 def main():
+    check_config()
     logger.info(f"Admin users: {config.ADMIN_USERS}")
-    reset_bot_data(pull_conversation())
+    # Dictionaries are only needed for queries when the search index is loaded
+    # from a snapshot, so load them while the bot starts.
+    threading.Thread(target=load_morph_analyzers,
+                     name="MorphAnalyzerLoader",
+                     daemon=True).start()
+    reset_bot_data(pull_conversation().textproto)
+    if config.ASYNC_RUNTIME:
+        asyncio.run(run_async_bot())
+        return
     init_stats()
     start_bot()
 
@@ -13,6 +13,8 @@ EMPTY_SEARCH_RESULTS = (
     "нам об этом, нажав кнопку \"Оставить отзыв боту\".")
 ERROR_OCCURRED = "Извините, произошла ошибка. Попробуйте начать сначала."
 FEEDBACK = "Оставить отзыв боту"
+SEARCH_RESULT_OUTDATED = (
+    "Эта статья больше не доступна. Пожалуйста, повторите поиск.")
 SEARCH_RESULT_HEADER = "По вашему запросу найдены статьи:"
 PROMPT_FEEDBACK = "Пишите свой отзыв прямо тут."
 PROMPT_REPLY = "Выберите пункт"
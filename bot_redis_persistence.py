@@ -1,16 +1,36 @@
+import asyncio
+import hashlib
+import hmac
+import json
 import logging
 import pickle
+import session_codec
+import threading
 from collections import defaultdict
-from copy import deepcopy
 from cryptography.fernet import Fernet
 from typing import Any, DefaultDict, Dict, Optional, Tuple
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 
 from telegram.ext import BasePersistence
 from telegram.ext.utils.types import ConversationDict
 
+from monitoring import (REDIS_LATENCY, SESSION_WRITE_CONFLICTS,
+                        SESSION_WRITES_DROPPED)
+
 logger = logging.getLogger(__name__)
 
+LEGACY_REDIS_KEY = 'TelegramBotPersistence'
+REDIS_KEY_PREFIX = 'TelegramBotPersistence:'
+USER_DATA_KEY = f'{REDIS_KEY_PREFIX}user_data'
+CONVERSATIONS_KEY_PREFIX = f'{REDIS_KEY_PREFIX}conversations:'
+MIGRATED_LEGACY_KEY = f'{REDIS_KEY_PREFIX}legacy_backup'
+# Followed by a hash key and a field name in versioned mode.
+VERSION_KEY_PREFIX = f'{REDIS_KEY_PREFIX}version:'
+# A versioned write that keeps conflicting with other processes is dropped
+# after this many attempts.
+MAX_VERSIONED_WRITE_ATTEMPTS = 3
+
 
 class RedisPersistence(BasePersistence):
     '''
@@ -19,142 +39,642 @@ class RedisPersistence(BasePersistence):
         ConversationDict import package fixed, and the serialized state
         encrypted. Package fix posted in
         https://github.com/Mortafix/RedisPersistence/pull/2.
+
+        The state is sharded: every user and conversation key is stored as
+        its own encrypted field of a Redis hash, so an update only writes the
+        entry that has changed. User data is loaded lazily, when the
+        dispatcher refreshes it before handling an update. Hash field names
+        are keyed HMACs of the ids, so no plain user ids are stored in Redis
+        when encryption is enabled. Values are encoded with
+        :mod:`session_codec`; chat_data and bot_data are not used by the bot
+        and are not stored.
+
+        Writes are synchronous by default. With :attr:`on_flush` they are
+        deferred until :meth:`flush`. With :attr:`write_behind_interval` set,
+        changed entries are collected and written by a background thread in
+        one pipelined round trip every `write_behind_interval` seconds, or as
+        soon as `max_pending_writes` entries are pending. A crash loses at most
+        that window of updates; :meth:`flush` writes everything on shutdown.
+
+        With :attr:`versioned`, several bot processes can share the state.
+        Every entry has a version counter in Redis, entries of a user are
+        read again before each of their updates (see :meth:`forget`) and
+        written right away with WATCH/MULTI, only if the entry still has the
+        version that was read. A write that would overwrite a newer version
+        is counted in :attr:`conflicts`, and what it changed since the entry
+        was read is applied to the newer version and written again. When that
+        keeps conflicting, the write is dropped and counted in
+        :attr:`dropped_writes`.
     '''
 
-    def __init__(self, redis: Redis, key: bytes, on_flush: bool = False):
+    def __init__(self,
+                 redis: Redis,
+                 key: bytes,
+                 on_flush: bool = False,
+                 write_behind_interval: Optional[float] = None,
+                 max_pending_writes: int = 500,
+                 versioned: bool = False):
+        if versioned and (on_flush or write_behind_interval):
+            raise ValueError('Versioned writes can not be deferred')
         super().__init__(store_user_data=True,
-                         store_chat_data=True,
-                         store_bot_data=True)
+                         store_chat_data=False,
+                         store_bot_data=False)
         self.redis: Redis = redis
         self.on_flush = on_flush
-        self.user_data: Optional[DefaultDict[int, Dict]] = None
-        self.chat_data: Optional[DefaultDict[int, Dict]] = None
-        self.bot_data: Optional[Dict] = None
-        self.conversations: Optional[Dict[str, Dict[Tuple, Any]]] = None
+        # Encoded last persisted value of every user touched by this process.
+        # Bytes are immutable, so they can be compared against and handed out
+        # as fresh objects without deep copies.
+        self.user_data: Dict[int, bytes] = {}
+        self.conversations: Dict[str, Dict[Tuple, Any]] = {}
         self.fernet = Fernet(key) if key else None
+        self._field_key = key
+        self._legacy_checked = False
+        # Latest not yet written serialized value by (Redis key, entry id).
+        # Repeated updates of an entry coalesce into a single write.
+        self._pending: Dict[Tuple[str, Any], Optional[bytes]] = {}
+        self._pending_lock = threading.Lock()
+        self.write_behind_interval = write_behind_interval
+        self.max_pending_writes = max_pending_writes
+        self.versioned = versioned
+        # Version of every entry as last read or written, by (Redis key,
+        # field name).
+        self._versions: Dict[Tuple[str, str], int] = {}
+        # Serialized value of every entry as last read or written, what a
+        # conflicting write changed is found against it.
+        self._base_values: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._lazy_conversations: Dict[str, _LazyConversationDict] = {}
+        self.conflicts = 0
+        self.dropped_writes = 0
+        self._counts_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        if write_behind_interval:
+            self._writer = threading.Thread(target=self._write_behind_loop,
+                                            name="RedisPersistenceWriter",
+                                            daemon=True)
+            self._writer.start()
+
+    def _encrypt(self, data_bytes: bytes) -> bytes:
+        return self.fernet.encrypt(data_bytes) if self.fernet else data_bytes
 
-    def load_redis(self) -> None:
+    def _decrypt(self, data_bytes: bytes) -> bytes:
+        return self.fernet.decrypt(data_bytes) if self.fernet else data_bytes
+
+    def _field(self, value: Any) -> str:
+        '''Returns a hash field name for a user id or a conversation key.'''
+        field = json.dumps(value)
+        if not self._field_key:
+            return field
+        return hmac.new(self._field_key, field.encode(),
+                        hashlib.sha256).hexdigest()
+
+    def _conversation_field(self, key: Tuple[int, ...]) -> str:
+        return self._field(list(key))
+
+    def _migrate_legacy_state(self) -> None:
+        '''Splits a whole-state blob written by older versions of this class
+        into per-entry hash fields. The blob is kept under a backup key.'''
+        if self._legacy_checked:
+            return
+        self._legacy_checked = True
         try:
-            data_bytes = self.redis.get('TelegramBotPersistence')
-            if data_bytes:
-                if self.fernet:
-                    data_bytes = self.fernet.decrypt(data_bytes)
-                data = pickle.loads(data_bytes)
-                self.user_data = defaultdict(dict, data['user_data'])
-                self.chat_data = defaultdict(dict, data['chat_data'])
-                # For backwards compatibility with inputs without bot data
-                self.bot_data = data.get('bot_data', {})
-                self.conversations = data['conversations']
+            data_bytes = self.redis.get(LEGACY_REDIS_KEY)
+            if not data_bytes:
                 return
+            pipeline = self.redis.pipeline()
+            users = self._queue_legacy_migration(pipeline, data_bytes)
+            pipeline.execute()
+            logger.info("Migrated bot state of %d users to sharded storage.",
+                        users)
         except Exception as exc:
-            logger.error("Failed to load bot state from Redis, discarding.",
+            logger.error("Failed to migrate bot state from Redis, discarding.",
                          exc_info=exc)
-        # Set defaults in case of an exception or a missing pickle.
-        self.conversations = dict()
-        self.user_data = defaultdict(dict)
-        self.chat_data = defaultdict(dict)
-        self.bot_data = {}
 
-    def dump_redis(self) -> None:
-        data = {
-            'conversations': self.conversations,
-            'user_data': self.user_data,
-            'chat_data': self.chat_data,
-            'bot_data': self.bot_data,
-        }
-        pickle_data = pickle.dumps(data)
-        data_bytes = self.fernet.encrypt(
-            pickle_data) if self.fernet else pickle_data
-        self.redis.set('TelegramBotPersistence', data_bytes)
+    def _queue_legacy_migration(self, pipeline, data_bytes: bytes) -> int:
+        '''Queues the writes migrating the blob, returns its number of
+        users.'''
+        data = pickle.loads(self._decrypt(data_bytes))
+        for user_id, user_data in data['user_data'].items():
+            pipeline.hset(
+                USER_DATA_KEY, self._field(user_id),
+                self._encrypt(session_codec.encode_user_data(user_data)))
+        for name, conversation in data['conversations'].items():
+            for key, state in conversation.items():
+                if state is None:
+                    continue
+                pipeline.hset(
+                    f'{CONVERSATIONS_KEY_PREFIX}{name}',
+                    self._conversation_field(key),
+                    self._encrypt(
+                        session_codec.encode_conversation_state(key, state)))
+        pipeline.rename(LEGACY_REDIS_KEY, MIGRATED_LEGACY_KEY)
+        return len(data['user_data'])
+
+    def _entry_field(self, hash_key: str, entry_id: Any) -> str:
+        if hash_key.startswith(CONVERSATIONS_KEY_PREFIX):
+            return self._conversation_field(entry_id)
+        return self._field(entry_id)
+
+    def _load_entry(self, hash_key: str, entry_id: Any) -> Optional[bytes]:
+        '''Returns the serialized entry stored in Redis, if any.'''
+        field = self._entry_field(hash_key, entry_id)
+        try:
+            with REDIS_LATENCY.labels("session_load").time():
+                if self.versioned:
+                    pipeline = self.redis.pipeline(transaction=False)
+                    pipeline.hget(hash_key, field)
+                    pipeline.get(f'{VERSION_KEY_PREFIX}{hash_key}:{field}')
+                    data_bytes, version = pipeline.execute()
+                    self._versions[(hash_key, field)] = int(version or 0)
+                else:
+                    data_bytes = self.redis.hget(hash_key, field)
+            value = self._decrypt(data_bytes) if data_bytes else None
+            if self.versioned:
+                self._base_values[(hash_key, field)] = value
+            return value
+        except Exception as exc:
+            logger.error("Failed to load %s entry from Redis, discarding.",
+                         hash_key,
+                         exc_info=exc)
+        return None
 
     def get_user_data(self) -> DefaultDict[int, Dict[Any, Any]]:
         '''
-            Returns the user_data from the pickle on Redis if it exists or
-            an empty :obj:`defaultdict`.
+            Returns an empty :obj:`defaultdict`. Data of individual users is
+            loaded lazily by :meth:`refresh_user_data`.
         '''
-        if self.user_data is None:
-            self.load_redis()
-        return deepcopy(self.user_data)  # type: ignore[arg-type]
+        self._migrate_legacy_state()
+        return defaultdict(dict)
 
     def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
         '''
-            Returns the chat_data from the pickle on Redis if it exists or
-            an empty :obj:`defaultdict`.
+            chat_data is not stored. Returns an empty :obj:`defaultdict`.
         '''
-        if self.chat_data is None:
-            self.load_redis()
-        return deepcopy(self.chat_data)  # type: ignore[arg-type]
+        return defaultdict(dict)
 
     def get_bot_data(self) -> Dict[Any, Any]:
         '''
-            Returns the bot_data from the pickle on Redis if it exists or
-            an empty :obj:`dict`.
+            bot_data is not stored. Returns an empty :obj:`dict`.
         '''
-        if self.bot_data is None:
-            self.load_redis()
-        return deepcopy(self.bot_data)  # type: ignore[arg-type]
+        return {}
 
     def get_conversations(self, name: str) -> ConversationDict:
         '''
-            Returns the conversations from the pickle on Redis if it exsists or
-            an empty dict.
+            Returns a dict of the handler's conversations, which loads the
+            state of a conversation from Redis on first access.
+        '''
+        self._migrate_legacy_state()
+        self.conversations.setdefault(name, {})
+        conversations = _LazyConversationDict(
+            lambda key: self._load_conversation(name, key))
+        self._lazy_conversations[name] = conversations
+        return conversations
+
+    def _load_conversation(self, name: str,
+                           key: Tuple[int, ...]) -> Optional[object]:
+        return self._loaded_conversation(
+            name, key,
+            self._load_entry(f'{CONVERSATIONS_KEY_PREFIX}{name}', key))
+
+    def _loaded_conversation(self, name: str, key: Tuple[int, ...],
+                             data_bytes: Optional[bytes]) -> Optional[object]:
+        '''Records the state of a conversation loaded from Redis and returns
+        it.'''
+        state = None
+        if data_bytes:
+            try:
+                state = session_codec.decode_conversation_state(
+                    data_bytes)[1]
+            except Exception as exc:
+                logger.error(
+                    "Failed to load conversation from Redis, discarding.",
+                    exc_info=exc)
+        self.conversations.setdefault(name, {})[key] = state
+        return state
+
+    def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        '''
+            Loads the data of a single user from Redis on first access.
         '''
-        if self.conversations is None:
-            self.load_redis()
-        return self.conversations.get(name,
-                                      {}).copy()  # type: ignore[union-attr]
+        if user_id in self.user_data:
+            return
+        self._loaded_user_data(user_id, user_data,
+                               self._load_entry(USER_DATA_KEY, user_id))
+
+    def _loaded_user_data(self, user_id: int, user_data: Dict,
+                          stored: Optional[bytes]) -> None:
+        '''Records the data of a user loaded from Redis and puts it in
+        user_data.'''
+        self.user_data[user_id] = stored or session_codec.encode_user_data({})
+        if self.versioned:
+            # Another process may have changed what this one has in memory.
+            user_data.clear()
+        if stored:
+            try:
+                user_data.update(session_codec.decode_user_data(stored))
+            except Exception as exc:
+                logger.error("Failed to decode user data, discarding.",
+                             exc_info=exc)
 
     def update_conversation(self, name: str, key: Tuple[int, ...],
                             new_state: Optional[object]) -> None:
         '''
-            Will update the conversations for the given handler and depending
-            on :attr:`on_flush` save the pickle on Redis.
+            Will update the conversations for the given handler and schedule
+            the entry to be saved on Redis.
         '''
-        if self.conversations is None:
-            self.conversations = dict()
         if self.conversations.setdefault(name, {}).get(key) == new_state:
             return
         self.conversations[name][key] = new_state
-        if not self.on_flush:
-            self.dump_redis()
+        self._schedule_write(
+            (CONVERSATIONS_KEY_PREFIX + name, key),
+            None if new_state is None else
+            session_codec.encode_conversation_state(key, new_state))
 
     def update_user_data(self, user_id: int, data: Dict) -> None:
         '''
-            Will update the user_data and depending on :attr:`on_flush` save
-            the pickle on Redis.
+            Will update the user_data and schedule the entry to be saved on
+            Redis.
         '''
-        if self.user_data is None:
-            self.user_data = defaultdict(dict)
-        if self.user_data.get(user_id) == data:
+        if user_id not in self.user_data and not data:
+            # Never loaded, so there is nothing new to store.
             return
-        self.user_data[user_id] = data
-        if not self.on_flush:
-            self.dump_redis()
+        data_bytes = session_codec.encode_user_data(data)
+        if self.user_data.get(user_id) == data_bytes:
+            return
+        self.user_data[user_id] = data_bytes
+        self._schedule_write((USER_DATA_KEY, user_id), data_bytes)
 
     def update_chat_data(self, chat_id: int, data: Dict) -> None:
-        '''
-            Will update the chat_data and depending on :attr:`on_flush` save
-            the pickle on Redis.
-        '''
-        if self.chat_data is None:
-            self.chat_data = defaultdict(dict)
-        if self.chat_data.get(chat_id) == data:
-            return
-        self.chat_data[chat_id] = data
-        if not self.on_flush:
-            self.dump_redis()
+        '''chat_data is not stored.'''
 
     def update_bot_data(self, data: Dict) -> None:
-        '''
-            Will update the bot_data and depending on :attr:`on_flush` save the
-            pickle on Redis.
-        '''
-        if self.bot_data == data:
+        '''bot_data is not stored.'''
+
+    def _schedule_write(self, entry: Tuple[str, Any],
+                        value: Optional[bytes]) -> None:
+        '''Records the latest value of an entry. Depending on the mode, the
+        entry is written right away, by the write-behind thread or on
+        :meth:`flush`.'''
+        if self.versioned:
+            self._write_versioned(entry, value)
             return
-        self.bot_data = data.copy()
-        if not self.on_flush:
+        with self._pending_lock:
+            self._pending[entry] = value
+            pending_count = len(self._pending)
+        if self._writer is not None:
+            if pending_count >= self.max_pending_writes:
+                self._wakeup.set()
+        elif not self.on_flush:
             self.dump_redis()
 
+    def _write_command(self, pipeline, entry: Tuple[str, Any],
+                       value: Optional[bytes]) -> None:
+        hash_key, entry_id = entry
+        if hash_key.startswith(CONVERSATIONS_KEY_PREFIX):
+            if value is None:
+                pipeline.hdel(hash_key, self._conversation_field(entry_id))
+            else:
+                pipeline.hset(hash_key, self._conversation_field(entry_id),
+                              self._encrypt(value))
+        else:
+            pipeline.hset(hash_key, self._field(entry_id),
+                          self._encrypt(value))
+
+    def _write_versioned(self, entry: Tuple[str, Any],
+                         value: Optional[bytes]) -> None:
+        hash_key, entry_id = entry
+        field = self._entry_field(hash_key, entry_id)
+        for _ in range(MAX_VERSIONED_WRITE_ATTEMPTS):
+            if self._write_version(entry, field, value):
+                self._base_values[(hash_key, field)] = value
+                return
+            with self._counts_lock:
+                self.conflicts += 1
+            SESSION_WRITE_CONFLICTS.inc()
+            logger.warning("Entry of %s was changed by another process, "
+                           "applying this write to the newer version.",
+                           hash_key)
+            base = self._base_values.get((hash_key, field))
+            newer = self._load_entry(hash_key, entry_id)
+            value = _rebase(hash_key, base, value, newer)
+            self._remember_entry(hash_key, entry_id, value)
+            if value == newer:
+                return
+        with self._counts_lock:
+            self.dropped_writes += 1
+        SESSION_WRITES_DROPPED.inc()
+        logger.error("Entry of %s kept being changed by other processes, "
+                     "dropping this write.", hash_key)
+        self._forget_entry(hash_key, entry_id)
+
+    def _write_version(self, entry: Tuple[str, Any], field: str,
+                       value: Optional[bytes]) -> bool:
+        '''Writes the entry as the next version of the one last read or
+        written. Returns False if another process wrote it meanwhile.'''
+        hash_key, _ = entry
+        version_key = f'{VERSION_KEY_PREFIX}{hash_key}:{field}'
+        expected = self._versions.get((hash_key, field), 0)
+
+        def write(pipeline) -> bool:
+            if int(pipeline.get(version_key) or 0) != expected:
+                return False
+            pipeline.multi()
+            self._write_command(pipeline, entry, value)
+            pipeline.set(version_key, expected + 1)
+            return True
+
+        with REDIS_LATENCY.labels("session_write").time():
+            written = self.redis.transaction(write,
+                                             version_key,
+                                             value_from_callable=True)
+        if written:
+            self._versions[(hash_key, field)] = expected + 1
+        return written
+
+    def _remember_entry(self, hash_key: str, entry_id: Any,
+                        value: Optional[bytes]) -> None:
+        '''Records a serialized entry as persisted.'''
+        if hash_key == USER_DATA_KEY:
+            self.user_data[entry_id] = value
+            return
+        name = hash_key[len(CONVERSATIONS_KEY_PREFIX):]
+        self.conversations.setdefault(name, {})[entry_id] = \
+            None if value is None else \
+            session_codec.decode_conversation_state(value)[1]
+
+    def write_stats(self) -> str:
+        return (f"Session write conflicts: {self.conflicts}, "
+                f"dropped: {self.dropped_writes}")
+
+    def _forget_entry(self, hash_key: str, entry_id: Any) -> None:
+        if hash_key == USER_DATA_KEY:
+            self.user_data.pop(entry_id, None)
+            return
+        name = hash_key[len(CONVERSATIONS_KEY_PREFIX):]
+        self.conversations.get(name, {}).pop(entry_id, None)
+        lazy_conversations = self._lazy_conversations.get(name)
+        if lazy_conversations is not None:
+            lazy_conversations.forget(entry_id)
+
+    def forget(self, chat_id: int, user_id: Optional[int]) -> None:
+        '''Drops what is in memory of a user and their conversations in a
+        chat, so it is read again from Redis. Called before an update is
+        handled in versioned mode.'''
+        if user_id is not None:
+            self._forget_entry(USER_DATA_KEY, user_id)
+        for name in self._lazy_conversations:
+            self._forget_entry(f'{CONVERSATIONS_KEY_PREFIX}{name}',
+                               (chat_id, user_id))
+
+    def dump_redis(self) -> None:
+        '''Writes the entries changed since the last dump in one
+        pipeline. Entries that fail to be written are kept pending unless they
+        have been updated in the meantime.'''
+        pending = self._take_pending()
+        if not pending:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for entry, value in pending.items():
+                self._write_command(pipeline, entry, value)
+            with REDIS_LATENCY.labels("session_write").time():
+                pipeline.execute()
+        except Exception:
+            self._restore_pending(pending)
+            raise
+
+    def _take_pending(self) -> Dict[Tuple[str, Any], Optional[bytes]]:
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def _restore_pending(
+            self, pending: Dict[Tuple[str, Any], Optional[bytes]]) -> None:
+        with self._pending_lock:
+            for entry, value in pending.items():
+                self._pending.setdefault(entry, value)
+
+    def _write_behind_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.write_behind_interval)
+            self._wakeup.clear()
+            try:
+                self.dump_redis()
+            except Exception as exc:
+                logger.error("Failed to write bot state to Redis, retrying.",
+                             exc_info=exc)
+
     def flush(self) -> None:
-        '''Will save all data in memory to pickle on Redis.'''
+        '''Stops the write-behind thread and saves all pending data to
+        Redis.'''
+        if self._writer is not None:
+            self._stopped.set()
+            self._wakeup.set()
+            self._writer.join()
+            self._writer = None
         self.dump_redis()
+
+
+class AsyncRedisPersistence(RedisPersistence):
+    '''
+        RedisPersistence of the asyncio runtime, on a redis.asyncio client.
+        Entries are keyed, encoded and encrypted the same way, so the state
+        is kept when the bot switches between the runtimes.
+
+        The dispatcher of the asyncio runtime loads the entries of an update
+        with :meth:`load_user_data` and :meth:`load_conversation` before
+        handling it, and awaits :meth:`commit` after recording what changed
+        with :meth:`update_user_data` and :meth:`update_conversation`. The
+        changed entries are written then, in one pipelined round trip, or,
+        with :attr:`write_behind_interval` set, by a task of the event loop
+        started by :meth:`start`, like the write-behind thread of
+        RedisPersistence writes them. Versioned writes are not supported.
+    '''
+
+    def __init__(self,
+                 redis: AsyncRedis,
+                 key: bytes,
+                 write_behind_interval: Optional[float] = None,
+                 max_pending_writes: int = 500):
+        # Deferred like on_flush, the writes are sent by commit or the task.
+        super().__init__(redis,
+                         key,
+                         on_flush=True,
+                         max_pending_writes=max_pending_writes)
+        self.write_behind_interval = write_behind_interval
+        self._writer_task: Optional[asyncio.Task] = None
+        self._writer_stopped = False
+        self._pending_full = asyncio.Event()
+
+    async def migrate_legacy_state(self) -> None:
+        '''Migrates the state written by older versions, see
+        RedisPersistence._migrate_legacy_state.'''
+        if self._legacy_checked:
+            return
+        self._legacy_checked = True
+        try:
+            data_bytes = await self.redis.get(LEGACY_REDIS_KEY)
+            if not data_bytes:
+                return
+            pipeline = self.redis.pipeline()
+            users = self._queue_legacy_migration(pipeline, data_bytes)
+            await pipeline.execute()
+            logger.info("Migrated bot state of %d users to sharded storage.",
+                        users)
+        except Exception as exc:
+            logger.error("Failed to migrate bot state from Redis, discarding.",
+                         exc_info=exc)
+
+    async def _load_entry_async(self, hash_key: str,
+                                entry_id: Any) -> Optional[bytes]:
+        field = self._entry_field(hash_key, entry_id)
+        try:
+            with REDIS_LATENCY.labels("session_load").time():
+                data_bytes = await self.redis.hget(hash_key, field)
+            return self._decrypt(data_bytes) if data_bytes else None
+        except Exception as exc:
+            logger.error("Failed to load %s entry from Redis, discarding.",
+                         hash_key,
+                         exc_info=exc)
+        return None
+
+    async def load_user_data(self, user_id: int, user_data: Dict) -> None:
+        '''Loads the data of a user into user_data on first access, like
+        refresh_user_data.'''
+        if user_id in self.user_data:
+            return
+        self._loaded_user_data(
+            user_id, user_data, await
+            self._load_entry_async(USER_DATA_KEY, user_id))
+
+    async def load_conversation(self, name: str,
+                                key: Tuple[int, ...]) -> Optional[object]:
+        '''Returns the state of a conversation, loaded on first access.'''
+        conversations = self.conversations.setdefault(name, {})
+        if key in conversations:
+            return conversations[key]
+        return self._loaded_conversation(
+            name, key, await
+            self._load_entry_async(f'{CONVERSATIONS_KEY_PREFIX}{name}', key))
+
+    def _schedule_write(self, entry: Tuple[str, Any],
+                        value: Optional[bytes]) -> None:
+        super()._schedule_write(entry, value)
+        if self.write_behind_interval and \
+                len(self._pending) >= self.max_pending_writes:
+            self._pending_full.set()
+
+    async def commit(self) -> None:
+        '''Writes the entries an update changed, unless they are written
+        behind.'''
+        if not self.write_behind_interval:
+            await self.dump_redis_async()
+
+    async def dump_redis_async(self) -> None:
+        '''Writes the entries changed since the last dump, like
+        dump_redis.'''
+        pending = self._take_pending()
+        if not pending:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for entry, value in pending.items():
+                self._write_command(pipeline, entry, value)
+            with REDIS_LATENCY.labels("session_write").time():
+                await pipeline.execute()
+        except Exception:
+            self._restore_pending(pending)
+            raise
+
+    def start(self) -> None:
+        '''Starts the task writing behind, when write_behind_interval is
+        set.'''
+        if self.write_behind_interval:
+            self._writer_task = asyncio.ensure_future(
+                self._write_behind_loop_async())
+
+    async def _write_behind_loop_async(self) -> None:
+        while not self._writer_stopped:
+            try:
+                await asyncio.wait_for(self._pending_full.wait(),
+                                       self.write_behind_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._pending_full.clear()
+            try:
+                await self.dump_redis_async()
+            except Exception as exc:
+                logger.error("Failed to write bot state to Redis, retrying.",
+                             exc_info=exc)
+
+    async def close(self) -> None:
+        '''Stops the task writing behind and saves all pending data to
+        Redis.'''
+        if self._writer_task is not None:
+            self._writer_stopped = True
+            self._pending_full.set()
+            await self._writer_task
+            self._writer_task = None
+        await self.dump_redis_async()
+
+
+def _rebase(hash_key: str, base: Optional[bytes], value: Optional[bytes],
+            newer: Optional[bytes]) -> Optional[bytes]:
+    '''Returns the newer serialized value of an entry with what value changed
+    of base applied to it.'''
+    if hash_key != USER_DATA_KEY:
+        # A conversation state is a single value.
+        return value if value != base else newer
+    base_data = session_codec.decode_user_data(base) if base else {}
+    data = session_codec.decode_user_data(value)
+    rebased = session_codec.decode_user_data(newer) if newer else {}
+    for key in base_data.keys() | data.keys():
+        if key in data and data[key] != base_data.get(key):
+            rebased[key] = data[key]
+        elif key not in data:
+            rebased.pop(key, None)
+    return session_codec.encode_user_data(rebased)
+
+
+class _LazyConversationDict(dict):
+    '''Conversation states of a handler, loaded one key at a time.
+
+    :class:`telegram.ext.ConversationHandler` only reads its conversations
+    with :meth:`get` and ``in``, so a state is fetched the first time its key
+    is looked up instead of all states being read on startup.
+    '''
+
+    def __init__(self, loader):
+        super().__init__()
+        self._loader = loader
+        self._loaded = set()
+
+    def _ensure_loaded(self, key) -> None:
+        if key in self._loaded:
+            return
+        self._loaded.add(key)
+        if not super().__contains__(key):
+            state = self._loader(key)
+            if state is not None:
+                super().__setitem__(key, state)
+
+    def forget(self, key) -> None:
+        self._loaded.discard(key)
+        super().pop(key, None)
+
+    def __setitem__(self, key, value) -> None:
+        self._loaded.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key) -> None:
+        self._loaded.add(key)
+        super().__delitem__(key)
+
+    def get(self, key, default=None):
+        self._ensure_loaded(key)
+        return super().get(key, default)
+
+    def __contains__(self, key) -> bool:
+        self._ensure_loaded(key)
+        return super().__contains__(key)
@@ -0,0 +1,128 @@
+"""Handles updates of different chats concurrently.
+
+The Dispatcher of python-telegram-bot handles one update at a time on its
+own thread, so every blocking call to Telegram or Redis in a handler holds up
+all other chats. ChatOrderedDispatcher hands updates to a pool of threads
+instead. Updates of one chat are still handled one at a time and in the
+order they arrived, so handlers keep seeing the conversation state the
+previous update of the chat left.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Deque,
+    Dict,
+    Hashable,
+    Optional,
+    Tuple,
+)
+import logging
+import threading
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSerialExecutor:
+    """Runs calls on a thread pool, one at a time per key."""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # Calls waiting for the running call of their key to finish. A key is
+        # present while one of its calls runs.
+        self._queues: Dict[Hashable, Deque[Tuple[Callable, tuple]]] = {}
+        self.pending = 0
+
+    def submit(self, key: Hashable, fn: Callable, *args: Any):
+        with self._lock:
+            self.pending += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[key] = deque()
+        self._executor.submit(self._run, key, fn, args)
+
+    def _run(self, key: Hashable, fn: Callable, args: tuple):
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Call for {key} failed", exc_info=e)
+        with self._lock:
+            self.pending -= 1
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                if not self._queues:
+                    self._idle.notify_all()
+                return
+            fn, args = queue.popleft()
+        # Submitted again rather than run in a loop, so that a busy key does
+        # not keep a thread from the other keys.
+        self._executor.submit(self._run, key, fn, args)
+
+    def active_keys(self) -> int:
+        with self._lock:
+            return len(self._queues)
+
+    def wait(self):
+        """Waits for all submitted calls to finish."""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._queues)
+
+    def shutdown(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+
+def update_chat_id(update: object) -> Optional[int]:
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class ChatOrderedDispatcher(Dispatcher):
+
+    def __init__(self,
+                 *args,
+                 concurrent_updates: int,
+                 update_scope: Callable[[], ContextManager] = nullcontext,
+                 **kwargs):
+        """update_scope returns a context manager entered for the handling
+        of every update of a chat."""
+        super().__init__(*args, **kwargs)
+        self.chat_executor = ChatSerialExecutor(
+            concurrent_updates, thread_name_prefix="UpdateHandler")
+        self.update_scope = update_scope
+
+    def process_update(self, update: object) -> None:
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            # Polling errors and updates without a chat, like inline queries.
+            super().process_update(update)
+        else:
+            self.chat_executor.submit(chat_id, self.process_chat_update,
+                                      update)
+
+    def process_chat_update(self, update: Update) -> None:
+        with self.update_scope():
+            super().process_update(update)
+
+    def stop(self) -> None:
+        super().stop()
+        self.chat_executor.shutdown()
+
+    def update_stats(self) -> str:
+        return (f"Updates in progress or queued: "
+                f"{self.chat_executor.pending}, "
+                f"in {self.chat_executor.active_keys()} chats")
@@ -13,10 +13,53 @@ LOGLEVEL = _env.log_level("LOGLEVEL", logging.INFO)
 CONVERSATION_MODEL_LOCAL_URL = "file:conversation_tree.textproto"
 CONVERSATION_MODEL_URL = _env.str("CONVERSATION_MODEL_URL",
                                   CONVERSATION_MODEL_LOCAL_URL)
+# Derived data, like search index snapshots, is cached here across restarts.
+CACHE_DIR = _env.str("CACHE_DIR", ".cache")
+# Compiled by conversation_artifact.py when the app is built. Used instead of
+# parsing and indexing a fetched conversation with the same content.
+CONVERSATION_ARTIFACT = _env.str("CONVERSATION_ARTIFACT",
+                                 "conversation_tree.bin")
 
 REDIS_URL = _env.str("REDIS_TLS_URL", "redis://localhost:6379")
+# Connections per Redis database, by default enough for every thread.
+REDIS_MAX_CONNECTIONS = _env.int("REDIS_MAX_CONNECTIONS", None)
+# How long to wait for a free connection of the pool.
+REDIS_POOL_TIMEOUT_SEC = _env.float("REDIS_POOL_TIMEOUT_SEC", 10)
+REDIS_SOCKET_TIMEOUT_SEC = _env.float("REDIS_SOCKET_TIMEOUT_SEC", 5)
+# Connections idle for longer are checked with a PING before use.
+REDIS_HEALTH_CHECK_INTERVAL_SEC = _env.int("REDIS_HEALTH_CHECK_INTERVAL_SEC",
+                                           30)
 PERSIST_SESSIONS = _env.bool("PERSIST_SESSIONS", False)
 PERSIST_METRICS = _env.bool("PERSIST_METRICS", False)
+# Top interactions and queries are shown for this many last days.
+METRICS_RETENTION_DAYS = _env.int("METRICS_RETENTION_DAYS", 3)
+# Metrics are summed up in the background and stored every
+# METRICS_FLUSH_INTERVAL_MS milliseconds, or once METRICS_FLUSH_EVENTS events
+# were collected. Events are dropped while METRICS_QUEUE_SIZE are waiting to be
+# summed up. 0 stores them synchronously on every update.
+METRICS_QUEUE_SIZE = _env.int("METRICS_QUEUE_SIZE", 10000)
+METRICS_FLUSH_INTERVAL_MS = _env.int("METRICS_FLUSH_INTERVAL_MS", 1000)
+METRICS_FLUSH_EVENTS = _env.int("METRICS_FLUSH_EVENTS", 500)
+# Session writes are coalesced and flushed to Redis in the background every
+# SESSION_WRITE_BEHIND_MS milliseconds. 0 writes synchronously on every update.
+SESSION_WRITE_BEHIND_MS = _env.int("SESSION_WRITE_BEHIND_MS", 500)
+SESSION_WRITE_BEHIND_MAX_PENDING = _env.int("SESSION_WRITE_BEHIND_MAX_PENDING",
+                                            500)
+# Updates of different chats are handled concurrently by this many threads.
+CONCURRENT_UPDATES = _env.int("CONCURRENT_UPDATES", 16)
+# Several processes serve the bot and share its state in Redis. Needs
+# PERSIST_SESSIONS, session writes are then never deferred.
+MULTI_REPLICA = _env.bool("MULTI_REPLICA", False)
+# Updates are handled by tasks of an asyncio event loop instead of threads,
+# with at most ASYNC_MAX_CONNECTIONS requests to Telegram at a time. Not
+# supported with MULTI_REPLICA.
+ASYNC_RUNTIME = _env.bool("ASYNC_RUNTIME", False)
+ASYNC_MAX_CONNECTIONS = _env.int("ASYNC_MAX_CONNECTIONS", 100)
+
+# Prometheus metrics are served at this path of the webhook, or at PORT when
+# polling. Not served by default: the webhook is public and the metrics are
+# not authenticated, so use a path that is hard to guess.
+METRICS_PATH = _env.str("METRICS_PATH", None)
 
 DEFAULT_WEBHOOK_URL = "https://telegram-bot-help-ua-ch.herokuapp.com"
 WEBHOOK_URL = _env.str("WEBHOOK_URL", DEFAULT_WEBHOOK_URL)
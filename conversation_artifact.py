@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Compiled conversation artifact.
+
+Parsing the textproto and building the search index are the slow parts of
+loading a conversation. The artifact holds their results: the conversation
+as a serialized binary proto and the state of its search index. The bot
+loads it instead of the textproto when it was compiled from the same
+source:
+
+    $ python conversation_artifact.py conversation_tree.textproto \\
+        -o conversation_tree.bin
+
+File layout, integers little endian:
+
+    magic (4 bytes) | format version (uint16) |
+    sha256 of the textproto (32 bytes) | sha256 of the payload (32 bytes) |
+    payload: pickle of (index state version, conversation bytes, index state)
+"""
+
+from collections import namedtuple
+from typing import Optional
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import struct
+import sys
+import tempfile
+
+import google.protobuf.text_format as text_format
+
+import proto.conversation_pb2 as conversation_proto
+from conversation_loader import content_hash
+from morpho_index import MorphoIndex, state_version
+
+ARTIFACT_MAGIC = b"TBCA"
+ARTIFACT_VERSION = 1
+HEADER = struct.Struct("<4sH32s32s")
+
+logger = logging.getLogger(__name__)
+
+Artifact = namedtuple("Artifact",
+                      ["conversation", "morpho_index", "content_hash"])
+
+
+class InvalidArtifactError(ValueError):
+    pass
+
+
+def compile_artifact(conversation_textproto: str) -> bytes:
+    conversation = text_format.Parse(conversation_textproto,
+                                     conversation_proto.Conversation())
+    payload = pickle.dumps(
+        (state_version(), conversation.SerializeToString(),
+         MorphoIndex(conversation).state()),
+        protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(
+        ARTIFACT_MAGIC, ARTIFACT_VERSION,
+        bytes.fromhex(content_hash(conversation_textproto)),
+        hashlib.sha256(payload).digest()) + payload
+
+
+def parse_artifact(data: bytes) -> Artifact:
+    """Raises:
+        InvalidArtifactError: if the data is not a valid artifact of this
+            version of the bot.
+    """
+    if len(data) < HEADER.size:
+        raise InvalidArtifactError("Artifact is truncated")
+    magic, version, source_digest, payload_digest = HEADER.unpack_from(data)
+    if magic != ARTIFACT_MAGIC:
+        raise InvalidArtifactError("Not a conversation artifact")
+    if version != ARTIFACT_VERSION:
+        raise InvalidArtifactError(f"Unsupported artifact version {version}")
+    payload = data[HEADER.size:]
+    if hashlib.sha256(payload).digest() != payload_digest:
+        raise InvalidArtifactError("Artifact checksum mismatch")
+    index_version, conversation_bytes, index_state = pickle.loads(payload)
+    if index_version != state_version():
+        raise InvalidArtifactError(
+            f"Search index was built by {index_version}, "
+            f"expected {state_version()}")
+    return Artifact(
+        conversation_proto.Conversation.FromString(conversation_bytes),
+        MorphoIndex.from_state(index_state), source_digest.hex())
+
+
+def load_artifact(path: Optional[str],
+                  expected_content_hash: str) -> Optional[Artifact]:
+    """Returns the artifact at path if it was compiled from the source with
+    the expected content hash, or None."""
+    if not path:
+        return None
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) == HEADER.size and HEADER.unpack(
+                    header)[2].hex() != expected_content_hash:
+                # Compiled from another version, skip reading the payload.
+                logger.info(f"Artifact {path} is for another conversation")
+                return None
+            artifact = parse_artifact(header + f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Failed to load artifact {path}", exc_info=e)
+        return None
+    logger.info(f"Loaded conversation artifact {path}")
+    return artifact
+
+
+def write_artifact(path: str, conversation_textproto: str):
+    data = compile_artifact(conversation_textproto)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        try:
+            f.write(data)
+        except Exception:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("textproto", help="conversation source")
+    parser.add_argument("-o",
+                        "--output",
+                        default="conversation_tree.bin",
+                        help="artifact to write")
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="only check that the artifact is up to date")
+    args = parser.parse_args()
+
+    with open(args.textproto, "r", encoding="utf-8") as f:
+        textproto = f.read()
+    if args.check:
+        if load_artifact(args.output, content_hash(textproto)) is None:
+            print(f"{args.output} is missing or out of date")
+            sys.exit(1)
+        print(f"{args.output} is up to date")
+        return
+    write_artifact(args.output, textproto)
+    print(f"Wrote {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
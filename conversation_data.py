@@ -1,69 +1,222 @@
-from node_util import visit_node
-from typing import Dict, List
-
+from collections import namedtuple
+from node_util import node_fingerprint, visit_node
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    ReplyKeyboardMarkup,
+)
+from typing import Dict, List, Optional, Set, Tuple
+
+import bot_messages
+import hashlib
+import logging
 import proto.conversation_pb2 as conversation_proto
 
-
-def _create_node_by_hash(
-    conversation: conversation_proto.Conversation
-) -> Dict[str, conversation_proto.ConversationNode]:
-    node_by_hash = dict()
-
-    def updater(node):
-        node_by_hash[str(hash(node.name))] = node
-
-    for node in conversation.node:
-        visit_node(node, updater)
-    return node_by_hash
+# Versions the format of callback data, which is stored in sent messages.
+CALLBACK_DATA_PREFIX = "n:"
+
+ANSWER_TEXT, ANSWER_LINKS, ANSWER_VENUE, ANSWER_PHOTO = range(4)
+
+logger = logging.getLogger(__name__)
+
+Venue = namedtuple("Venue",
+                   ["lat", "lon", "title", "address", "google_place_id"])
+
+
+def node_id(node_name: str) -> str:
+    """Returns a compact node id, which is the same in every process and
+    across conversation reloads as long as the node name does not change."""
+    return hashlib.blake2b(node_name.encode("utf-8"),
+                           digest_size=8).hexdigest()
+
+
+class Answer:
+    """A node answer with everything needed to send it prepared."""
+
+    __slots__ = ("kind", "text", "inline_markup", "venue", "photo")
+
+    def __init__(self, answer: conversation_proto.ConversationNode.Answer):
+        self.text: str = None
+        self.inline_markup: InlineKeyboardMarkup = None
+        self.venue: Venue = None
+        self.photo: str = None
+        if len(answer.text) > 0:
+            self.kind = ANSWER_TEXT
+            self.text = answer.text
+        elif len(answer.links.text) > 0:
+            self.kind = ANSWER_LINKS
+            self.text = answer.links.text
+            self.inline_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton(url.label, url=url.url)]
+                for url in answer.links.url
+            ])
+        elif len(answer.venue.title) > 0:
+            self.kind = ANSWER_VENUE
+            venue = answer.venue
+            self.venue = Venue(venue.lat, venue.lon, venue.title,
+                               venue.address, venue.google_place_id)
+        else:
+            self.kind = ANSWER_PHOTO
+            self.photo = answer.photo
+
+
+class Node:
+    """A compiled conversation node.
+
+    Attributes:
+        index (int): dense id of the node, valid within one ConversationData.
+        fingerprint (bytes): digest of the node's content, see
+            :func:`node_util.node_fingerprint`.
+        keyboard (tuple): names of the linked nodes, one per keyboard row, or
+            None if the node has no links.
+        keyboard_markups (dict): reply keyboards of the node built so far, by
+            nav depth bucket and extra buttons.
+    """
+
+    __slots__ = ("index", "name", "fingerprint", "callback_data", "answers",
+                 "keyboard", "keyboard_markups")
+
+    def __init__(self,
+                 index: int,
+                 node: conversation_proto.ConversationNode,
+                 previous: Optional["Node"] = None):
+        self.index = index
+        self.name: str = node.name
+        self.fingerprint = node_fingerprint(node)
+        self.callback_data = CALLBACK_DATA_PREFIX + node_id(node.name)
+        if previous is not None and previous.fingerprint == self.fingerprint:
+            # Compiled parts do not depend on the index and are never
+            # modified, so they are shared with the previous version.
+            self.answers = previous.answers
+            self.keyboard = previous.keyboard
+            self.keyboard_markups = previous.keyboard_markups
+            return
+        self.answers: Tuple[Answer] = tuple(
+            Answer(answer) for answer in node.answer)
+        link_names = []
+        for link in node.link:
+            if len(link.name) > 0:
+                link_names.append(link.name)
+            elif len(link.branch.name) > 0:
+                link_names.append(link.branch.name)
+        self.keyboard: Tuple[Tuple[str]] = tuple(
+            (name, ) for name in link_names) if link_names else None
+        self.keyboard_markups: Dict[Tuple, ReplyKeyboardMarkup] = {}
 
 
-def _create_node_by_name(
-    conversation: conversation_proto.Conversation
-) -> Dict[str, conversation_proto.ConversationNode]:
-    node_by_name = dict()
+def _compile_nodes(conversation: conversation_proto.Conversation,
+                   previous_nodes: Dict[str, Node]) -> List[Node]:
+    nodes = []
+    seen = set()
 
     def updater(node: conversation_proto.ConversationNode):
-        node_by_name[node.name] = node
+        if node.name in seen:
+            return
+        seen.add(node.name)
+        nodes.append(Node(len(nodes), node, previous_nodes.get(node.name)))
 
     for node in conversation.node:
         visit_node(node, updater)
-    return node_by_name
+    return nodes
 
 
-def _create_keyboard_options(node_by_name) -> Dict[str, List[List[str]]]:
-    keyboard_by_name = dict()
-    for name in node_by_name:
-        if len(node_by_name[name].link) == 0:
-            continue
-        options = []
-        for link in node_by_name[name].link:
-            if len(link.name) > 0:
-                options.append([link.name])
-            elif len(link.branch.name) > 0:
-                options.append([link.branch.name])
-        keyboard_by_name[name] = options
-    return keyboard_by_name
+def _nav_depth_bucket(nav_stack_depth: int) -> int:
+    # Keyboards differ for the top level, the second level and deeper.
+    return min(max(nav_stack_depth, 1), 3)
 
 
 class ConversationData:
-
-    def __init__(self, conversation: conversation_proto.Conversation):
-        self._node_by_hash: Dict[
-            str, conversation_proto.ConversationNode] = _create_node_by_hash(
-                conversation)
-        self._node_by_name: Dict[
-            str, conversation_proto.ConversationNode] = _create_node_by_name(
-                conversation)
-        self._keyboard_by_name: Dict[
-            str,
-            List[List[str]]] = _create_keyboard_options(self._node_by_name)
-
-    def node_by_hash(self,
-                     hash_value: int) -> conversation_proto.ConversationNode:
-        return self._node_by_hash.get(str(hash_value))
-
-    def node_by_name(self, name: str) -> conversation_proto.ConversationNode:
+    """The conversation graph compiled once per load.
+
+    Nodes get dense integer indices, and reply keyboards are built once per
+    node, nav depth bucket and the set of extra buttons, so rendering a node
+    only looks data up.
+
+    When built on a reload, nodes whose content has not changed since the
+    previous ConversationData reuse its compiled answers and keyboards.
+
+    Attributes:
+        changed_node_names (set): names of the nodes that are new or changed
+            compared to the previous ConversationData.
+        removed_node_names (set): names of the nodes of the previous
+            ConversationData that are gone.
+    """
+
+    def __init__(self,
+                 conversation: conversation_proto.Conversation,
+                 previous: Optional["ConversationData"] = None):
+        previous_nodes = previous._node_by_name if previous else {}
+        self._nodes: List[Node] = _compile_nodes(conversation, previous_nodes)
+        self._node_by_name: Dict[str, Node] = {
+            node.name: node
+            for node in self._nodes
+        }
+        self.changed_node_names: Set[str] = {
+            node.name
+            for node in self._nodes if node.name not in previous_nodes or
+            previous_nodes[node.name].fingerprint != node.fingerprint
+        }
+        self.removed_node_names: Set[str] = previous_nodes.keys() - \
+            self._node_by_name.keys()
+        self._node_by_id: Dict[str, Node] = {}
+        for node in self._nodes:
+            nid = node.callback_data[len(CALLBACK_DATA_PREFIX):]
+            if nid in self._node_by_id:
+                logger.error(f"Node id collision: '{node.name}' and "
+                             f"'{self._node_by_id[nid].name}'")
+            self._node_by_id[nid] = node
+        # Keyboards of unknown nodes.
+        self._keyboard_markups: Dict[Tuple, ReplyKeyboardMarkup] = {}
+
+    def callback_data(self, node_name: str) -> str:
+        return CALLBACK_DATA_PREFIX + node_id(node_name)
+
+    def node_by_callback_data(self, callback_data: str) -> Optional[Node]:
+        """Returns the node a button created by :meth:`callback_data` points
+        to, or None if the node is gone or the data has an older format."""
+        if not callback_data.startswith(CALLBACK_DATA_PREFIX):
+            return None
+        return self._node_by_id.get(callback_data[len(CALLBACK_DATA_PREFIX):])
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def node_by_name(self, name: str) -> Optional[Node]:
         return self._node_by_name.get(name)
 
-    def keyboard_by_name(self, name: str) -> List[List[str]]:
-        return self._keyboard_by_name.get(name)
+    def keyboard_by_name(self, name: str) -> Optional[Tuple[Tuple[str]]]:
+        node = self._node_by_name.get(name)
+        return node.keyboard if node else None
+
+    def keyboard_markup(self,
+                        node_name: str,
+                        nav_stack_depth: int,
+                        show_admin_button: bool = False,
+                        feedback_enabled: bool = False) -> ReplyKeyboardMarkup:
+        """Returns the reply keyboard for a node and a navigation state.
+
+        The feedback and admin buttons are only shown on the top level, back
+        from the second level and start over from deeper levels.
+        """
+        node = self._node_by_name.get(node_name)
+        depth_bucket = _nav_depth_bucket(nav_stack_depth)
+        show_admin_button = show_admin_button and depth_bucket == 1
+        show_feedback_button = feedback_enabled and depth_bucket == 1
+        markups = node.keyboard_markups if node else self._keyboard_markups
+        cache_key = (depth_bucket, show_admin_button, show_feedback_button)
+        markup = markups.get(cache_key)
+        if markup is None:
+            options = []
+            if show_admin_button:
+                options.append([bot_messages.ADMIN])
+            if node is not None and node.keyboard is not None:
+                options.extend(list(row) for row in node.keyboard)
+            if show_feedback_button:
+                options.append([bot_messages.FEEDBACK])
+            if depth_bucket >= 2:
+                options.append([bot_messages.BACK])
+            if depth_bucket > 2:
+                options.append([bot_messages.START_OVER])
+            markup = ReplyKeyboardMarkup(options, one_time_keyboard=True)
+            markups[cache_key] = markup
+        return markup
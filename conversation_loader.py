@@ -0,0 +1,171 @@
+"""Fetches the conversation source with conditional requests.
+
+The last successfully fetched source is kept in the cache directory together
+with its ETag, Last-Modified date and content hash. Requests send them as
+If-None-Match and If-Modified-Since, so an unchanged source costs a 304 and
+no download. When the source can not be fetched, the cached copy is used,
+and when there is none either, the fallback URL, normally the conversation
+bundled with the bot.
+"""
+
+from collections import namedtuple
+from typing import Dict, Optional
+import hashlib
+import json
+import logging
+import os
+import ssl
+import tempfile
+import urllib.error
+import urllib.request
+
+CACHE_FILE = "conversation.textproto"
+CACHE_META_FILE = "conversation.json"
+FETCH_TIMEOUT_SEC = 20
+
+# Where a fetched source came from.
+FROM_NETWORK = "network"
+NOT_MODIFIED = "not modified"
+FROM_CACHE = "cache"
+FROM_FALLBACK = "fallback"
+
+logger = logging.getLogger(__name__)
+
+FetchResult = namedtuple("FetchResult",
+                         ["textproto", "content_hash", "source", "error"])
+
+
+def content_hash(conversation_textproto: str) -> str:
+    return hashlib.sha256(conversation_textproto.encode("utf-8")).hexdigest()
+
+
+def _write_atomically(path: str, data: str):
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile("w",
+                                     dir=directory,
+                                     encoding="utf-8",
+                                     delete=False) as f:
+        try:
+            f.write(data)
+        except Exception:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+class ConversationLoader:
+
+    def __init__(self,
+                 url: str,
+                 cache_dir: Optional[str],
+                 fallback_url: Optional[str] = None):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.fallback_url = fallback_url
+
+    def _cache_path(self, file_name: str) -> Optional[str]:
+        return os.path.join(self.cache_dir,
+                            file_name) if self.cache_dir else None
+
+    def _read_cache(self) -> Optional[Dict]:
+        """Returns the metadata of the cached copy of the source, with the
+        source under "textproto", or None if there is no valid copy."""
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(CACHE_META_FILE), "r") as f:
+                meta = json.load(f)
+            if meta.get("url") != self.url:
+                return None
+            with open(self._cache_path(CACHE_FILE), "r",
+                      encoding="utf-8") as f:
+                meta["textproto"] = f.read()
+            if content_hash(meta["textproto"]) != meta.get("content_hash"):
+                logger.warning("Cached conversation is corrupt, ignoring.")
+                return None
+            return meta
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Failed to read the cached conversation",
+                           exc_info=e)
+            return None
+
+    def _write_cache(self, textproto: str, meta: Dict):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # The metadata is checked against the source's hash on read, so
+            # a crash between the two writes is harmless.
+            _write_atomically(self._cache_path(CACHE_FILE), textproto)
+            _write_atomically(self._cache_path(CACHE_META_FILE),
+                              json.dumps(meta))
+        except Exception as e:
+            logger.warning("Failed to cache the conversation", exc_info=e)
+
+    def fetch(self) -> FetchResult:
+        """Returns the current conversation source.
+
+        Raises:
+            urllib.error.URLError: if the source can not be fetched and there
+                is neither a cached copy nor a fallback.
+        """
+        cached = self._read_cache()
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        request = urllib.request.Request(self.url, headers=headers)
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=FETCH_TIMEOUT_SEC,
+                                        context=ssl.create_default_context()
+                                        ) as f:
+                textproto = f.read().decode("utf-8")
+                response_headers = f.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached:
+                logger.info(f"Conversation at {self.url} is not modified")
+                return FetchResult(cached["textproto"],
+                                   cached["content_hash"], NOT_MODIFIED, None)
+            return self._fetch_failed(e, cached)
+        except (urllib.error.URLError, OSError) as e:
+            return self._fetch_failed(e, cached)
+
+        fetched_hash = content_hash(textproto)
+        etag = response_headers.get("ETag") if response_headers else None
+        last_modified = response_headers.get(
+            "Last-Modified") if response_headers else None
+        if not cached or cached["content_hash"] != fetched_hash or \
+                cached.get("etag") != etag or \
+                cached.get("last_modified") != last_modified:
+            self._write_cache(
+                textproto, {
+                    "url": self.url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "content_hash": fetched_hash,
+                })
+        return FetchResult(textproto, fetched_hash, FROM_NETWORK, None)
+
+    def _fetch_failed(self, error: Exception,
+                      cached: Optional[Dict]) -> FetchResult:
+        logger.error(f"Failed to load conversation from {self.url}",
+                     exc_info=error)
+        if cached:
+            logger.warning("Using the cached conversation")
+            return FetchResult(cached["textproto"], cached["content_hash"],
+                               FROM_CACHE, error)
+        if self.fallback_url and self.fallback_url != self.url:
+            logger.warning(
+                f"Using the fallback conversation {self.fallback_url}")
+            with urllib.request.urlopen(self.fallback_url) as f:
+                textproto = f.read().decode("utf-8")
+            return FetchResult(textproto, content_hash(textproto),
+                               FROM_FALLBACK, error)
+        if isinstance(error, urllib.error.URLError):
+            raise error
+        raise urllib.error.URLError(error)
@@ -0,0 +1,95 @@
+"""Plans how the answers of a node are sent with the fewest messages.
+
+Adjacent text answers are merged into one message while it fits
+MAX_MESSAGE_LENGTH, adjacent photos are sent as one album of up to
+MAX_MEDIA_GROUP_SIZE photos, and the reply keyboard is attached to the last
+message. Only when the last message can not carry it, because it is an album
+or already has inline buttons, a prompt is sent with the keyboard.
+"""
+
+from collections import namedtuple
+from telegram import ParseMode, ReplyMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
+from typing import List, Sequence
+
+from conversation_data import (
+    ANSWER_LINKS,
+    ANSWER_PHOTO,
+    ANSWER_TEXT,
+    ANSWER_VENUE,
+    Answer,
+)
+from photo_cache import PhotoCache
+from runtime import BotApi
+
+SEND_TEXT, SEND_PHOTO, SEND_MEDIA_GROUP, SEND_VENUE = range(4)
+MAX_MEDIA_GROUP_SIZE = 10
+TEXT_SEPARATOR = "\n\n"
+
+# content is the text for SEND_TEXT, the photo name for SEND_PHOTO, a tuple
+# of photo names for SEND_MEDIA_GROUP and a Venue for SEND_VENUE.
+Send = namedtuple("Send", ["kind", "content", "reply_markup"])
+
+
+def plan(answers: Sequence[Answer], reply_markup: ReplyMarkup,
+         prompt: str) -> List[Send]:
+    sends: List[Send] = []
+    for answer in answers:
+        last = sends[-1] if sends else None
+        if answer.kind == ANSWER_TEXT:
+            if last and last.kind == SEND_TEXT and \
+                    last.reply_markup is None and \
+                    len(last.content) + len(TEXT_SEPARATOR) + len(
+                        answer.text) <= MAX_MESSAGE_LENGTH:
+                sends[-1] = last._replace(content=last.content +
+                                          TEXT_SEPARATOR + answer.text)
+            else:
+                sends.append(Send(SEND_TEXT, answer.text, None))
+        elif answer.kind == ANSWER_LINKS:
+            sends.append(Send(SEND_TEXT, answer.text, answer.inline_markup))
+        elif answer.kind == ANSWER_VENUE:
+            sends.append(Send(SEND_VENUE, answer.venue, None))
+        elif answer.kind == ANSWER_PHOTO:
+            if last and last.kind == SEND_PHOTO:
+                sends[-1] = Send(SEND_MEDIA_GROUP,
+                                 (last.content, answer.photo), None)
+            elif last and last.kind == SEND_MEDIA_GROUP and \
+                    len(last.content) < MAX_MEDIA_GROUP_SIZE:
+                sends[-1] = last._replace(content=last.content +
+                                          (answer.photo, ))
+            else:
+                sends.append(Send(SEND_PHOTO, answer.photo, None))
+
+    last = sends[-1] if sends else None
+    if last and last.kind != SEND_MEDIA_GROUP and last.reply_markup is None:
+        sends[-1] = last._replace(reply_markup=reply_markup)
+    else:
+        sends.append(Send(SEND_TEXT, prompt, reply_markup))
+    return sends
+
+
+async def deliver(api: BotApi, chat_id: int, sends: Sequence[Send],
+                  photo_cache: PhotoCache):
+    """Sends planned messages to a chat."""
+    for send in sends:
+        if send.kind == SEND_TEXT:
+            await api.send_message(chat_id,
+                                   send.content,
+                                   parse_mode=ParseMode.HTML,
+                                   reply_markup=send.reply_markup)
+        elif send.kind == SEND_PHOTO:
+            await photo_cache.send_photo(api,
+                                         chat_id,
+                                         send.content,
+                                         reply_markup=send.reply_markup)
+        elif send.kind == SEND_MEDIA_GROUP:
+            await photo_cache.send_media_group(api, chat_id, send.content)
+        elif send.kind == SEND_VENUE:
+            venue = send.content
+            await api.send_venue(chat_id,
+                                 latitude=venue.lat,
+                                 longitude=venue.lon,
+                                 title=venue.title,
+                                 address=venue.address,
+                                 google_place_id=venue.google_place_id,
+                                 reply_markup=send.reply_markup)
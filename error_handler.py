@@ -5,6 +5,8 @@ from telegram import (
     Update,
 )
 from telegram.ext import CallbackContext
+from runtime import BotApi
+from typing import List
 import bot_messages
 import config
 import html
@@ -27,7 +29,21 @@ MAX_ERROR_MESSAGE_LENGTH = max_arg_length(ERROR_TEMPLATE)
 logger = logging.getLogger(__name__)
 
 
-def handle_error(update: object, context: CallbackContext):
+async def send_error_report(api: BotApi, html_messages: List[str]):
+    try:
+        await api.send_message(
+            config.FEEDBACK_CHANNEL_ID,
+            "An exception was raised when handling an update:")
+        for text in html_messages:
+            await api.send_message(config.FEEDBACK_CHANNEL_ID,
+                                   text,
+                                   parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.warning(msg="Can't send a message to a feedback channel.",
+                       exc_info=e)
+
+
+async def handle_error(update: object, context: CallbackContext):
     logger.error(msg="Exception while handling an update:",
                  exc_info=context.error)
 
@@ -37,37 +53,25 @@ def handle_error(update: object, context: CallbackContext):
         tb_string = ''.join(tb_list)
         update_str = update.to_dict() if isinstance(update,
                                                     Update) else str(update)
-        try:
-            context.bot.send_message(
-                chat_id=config.FEEDBACK_CHANNEL_ID,
-                text="An exception was raised when handling an update:")
-            update_msg = (UPDATE_TEMPLATE.format(
-                html.escape(
-                    json.dumps(update_str,
-                               indent=2,
-                               ensure_ascii=False,
-                               default=str))[:MAX_UPDATE_MESSAGE_LENGTH]))
-            context.bot.send_message(chat_id=config.FEEDBACK_CHANNEL_ID,
-                                     text=update_msg,
-                                     parse_mode=ParseMode.HTML)
-            context_msg = (CONTEXT_TEMPLATE.format(
-                json.dumps(context.user_data,
+        update_msg = (UPDATE_TEMPLATE.format(
+            html.escape(
+                json.dumps(update_str,
                            indent=2,
                            ensure_ascii=False,
-                           default=str)[:MAX_CONTEXT_MESSAGE_LENGTH]))
-            context.bot.send_message(chat_id=config.FEEDBACK_CHANNEL_ID,
-                                     text=context_msg,
-                                     parse_mode=ParseMode.HTML)
-            error_msg = ERROR_TEMPLATE.format(
-                html.escape(tb_string)[:MAX_ERROR_MESSAGE_LENGTH])
-            context.bot.send_message(chat_id=config.FEEDBACK_CHANNEL_ID,
-                                     text=error_msg,
-                                     parse_mode=ParseMode.HTML)
-        except Exception as e:
-            logger.warning(msg="Can't send a message to a feedback channel.",
-                           exc_info=e)
+                           default=str))[:MAX_UPDATE_MESSAGE_LENGTH]))
+        context_msg = (CONTEXT_TEMPLATE.format(
+            json.dumps(context.user_data,
+                       indent=2,
+                       ensure_ascii=False,
+                       default=str)[:MAX_CONTEXT_MESSAGE_LENGTH]))
+        error_msg = ERROR_TEMPLATE.format(
+            html.escape(tb_string)[:MAX_ERROR_MESSAGE_LENGTH])
+        # Sent in the background, a burst of errors must not hold up updates.
+        context.api.send_in_background(send_error_report, context.api,
+                                       [update_msg, context_msg, error_msg])
     if isinstance(update, Update) and update.message is not None:
-        update.message.reply_text(bot_messages.ERROR_OCCURRED,
-                                  reply_markup=ReplyKeyboardMarkup(
-                                      [[bot_messages.START_OVER]],
-                                      one_time_keyboard=True))
+        await context.api.send_message(update.message.chat_id,
+                                       bot_messages.ERROR_OCCURRED,
+                                       reply_markup=ReplyKeyboardMarkup(
+                                           [[bot_messages.START_OVER]],
+                                           one_time_keyboard=True))
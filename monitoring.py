@@ -0,0 +1,104 @@
+"""Prometheus metrics of the bot.
+
+With a webhook they are served at METRICS_PATH by the webhook server, on the
+port Telegram sends updates to. When polling, by a server of their own.
+"""
+
+from typing import Callable, Coroutine
+import functools
+import logging
+
+from prometheus_client import (Counter, Gauge, Histogram, REGISTRY,
+                               start_http_server)
+from prometheus_client.exposition import choose_encoder
+from telegram.ext import Updater
+import tornado.web
+
+# Redis round trips are much faster than the default buckets start at.
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1, 2.5)
+RELOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SEARCH_RESULT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds",
+                            "Time to handle an update, by handler.",
+                            ["handler"])
+TELEGRAM_API_LATENCY = Histogram(
+    "bot_telegram_api_latency_seconds",
+    "Time of a Telegram Bot API request, by method, without the wait for "
+    "rate limits.", ["method"])
+REDIS_LATENCY = Histogram("bot_redis_latency_seconds",
+                          "Time of the Redis round trips of an operation.",
+                          ["operation"],
+                          buckets=REDIS_BUCKETS)
+SEARCH_LATENCY = Histogram("bot_search_latency_seconds",
+                           "Time of a free text search of the conversation.")
+SEARCH_RESULTS = Histogram("bot_search_results",
+                           "Nodes matching a free text search.",
+                           buckets=SEARCH_RESULT_BUCKETS)
+RELOAD_DURATION = Histogram("bot_conversation_reload_seconds",
+                            "Time to load a conversation.",
+                            buckets=RELOAD_BUCKETS)
+STALE_UPDATES = Counter(
+    "bot_stale_updates",
+    "Updates dropped, as a later update of their chat was handled by a "
+    "replica.")
+SESSION_WRITE_CONFLICTS = Counter(
+    "bot_session_write_conflicts",
+    "Session writes made after another replica wrote the same entry.")
+SESSION_WRITES_DROPPED = Counter(
+    "bot_session_writes_dropped",
+    "Session writes dropped, as other replicas kept writing the entry.")
+QUEUE_DEPTH = Gauge("bot_queue_depth",
+                    "Updates or requests waiting, by queue.", ["queue"])
+
+logger = logging.getLogger(__name__)
+
+
+def time_handler(handler: str):
+    """Decorates a handler coroutine to observe the time it takes, awaits
+    included, as the latency of handler."""
+    histogram = HANDLER_LATENCY.labels(handler)
+
+    def decorate(coroutine_function: Callable[..., Coroutine]):
+
+        @functools.wraps(coroutine_function)
+        async def timed(*args, **kwargs):
+            with histogram.time():
+                return await coroutine_function(*args, **kwargs)
+
+        return timed
+
+    return decorate
+
+
+def track_queue(queue: str, depth: Callable[[], float]):
+    """Reports the depth of a queue, read when the metrics are scraped."""
+    QUEUE_DEPTH.labels(queue).set_function(depth)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        encoder, content_type = choose_encoder(self.request.headers.get(
+            "Accept"))
+        self.set_header("Content-Type", content_type)
+        self.write(encoder(REGISTRY))
+
+
+def serve(updater: Updater, path: str, port: int):
+    """Serves the metrics at path of the webhook server of a started updater,
+    or at port when it polls."""
+    httpd = updater.httpd
+    if httpd is None:
+        start_http_server(port)
+        logger.info(f"Serving metrics at port {port}")
+        return
+
+    def add_handler():
+        httpd.http_server.request_callback.add_handlers(
+            r".*", [(path, MetricsHandler)])
+
+    # The app of the webhook is only used by the thread of its IO loop.
+    httpd.loop.add_callback(add_handler)
+    logger.info(f"Serving metrics at {path}")
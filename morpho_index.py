@@ -1,14 +1,20 @@
+from array import array
 from collections import namedtuple
+import functools
+import hashlib
+import heapq
 import logging
+import os
+import pickle
 import pprint
 import proto.conversation_pb2 as conversation_proto
 import pymorphy2
 import re
+import tempfile
+import threading
 
-from multiset import Multiset
-from node_util import visit_node_with_branch_parent
-from operator import itemgetter
-from typing import Dict, List
+from node_util import node_fingerprint, visit_node_with_branch_parent
+from typing import Dict, Iterable, List, Optional, Tuple
 
 UKR_APOS = "'`’ʼ"
 UKR_APOS_REGEX = re.compile(f"[{UKR_APOS}]")
@@ -19,11 +25,19 @@ UKRAINIAN_WORD = re.compile(f"^[А-ЩЬЮЯҐЄІЇа-щьюяґєії{UKR_APOS}
 UNKNOWN_POS = "UNK"
 NODE_NAME_TERM_SCORE = 9000
 IGNORED_NODES = set(["/start"])
-MORPH_RU = pymorphy2.MorphAnalyzer()
-MORPH_UK = pymorphy2.MorphAnalyzer(lang='uk')
+BREADCRUMB_SEPARATOR = " > "
+# Bump when the index structure or the way texts are analyzed changes.
+SNAPSHOT_VERSION = 3
+SNAPSHOT_FILE_TEMPLATE = "morpho_index-{}.pickle"
+# Conversation texts have a few thousand distinct words, queries add more.
+WORD_TAGS_CACHE_SIZE = 20000
+# Typecode of the posting arrays, holds node ids and summed term weights.
+POSTING_TYPECODE = "L"
 
 logger = logging.getLogger(__name__)
-parent_name_by_branch_name = {}
+
+_morph_analyzers = None
+_morph_analyzers_lock = threading.Lock()
 
 WordTag = namedtuple("WordTag", ["word", "part_of_speech"])
 SearchResult = namedtuple("SearchResult", ["node_name", "score", "node_label"])
@@ -37,45 +51,77 @@ def normalize_word(word: str):
 
 
 def word_tag_for_parse(parse):
-    return WordTag(parse.normal_form, parse.tag.POS)
+    # Keep a plain str: pymorphy2 grammemes can not be pickled.
+    pos = parse.tag.POS
+    return WordTag(parse.normal_form, str(pos) if pos is not None else None)
+
+
+def load_morph_analyzers():
+    """Returns the Russian and Ukrainian analyzers, loading their
+    dictionaries on first use."""
+    global _morph_analyzers
+    if _morph_analyzers is None:
+        with _morph_analyzers_lock:
+            if _morph_analyzers is None:
+                _morph_analyzers = (pymorphy2.MorphAnalyzer(),
+                                    pymorphy2.MorphAnalyzer(lang='uk'))
+    return _morph_analyzers
+
 
+def word_tags(word: str) -> Tuple[WordTag, ...]:
+    return _normalized_word_tags(normalize_word(word))
 
-def word_tags(word: str) -> List[WordTag]:
-    word = normalize_word(word)
-    length = len(word)
 
+def word_tags_cache_stats() -> str:
+    info = _normalized_word_tags.cache_info()
+    lookups = info.hits + info.misses
+    hit_rate = info.hits / lookups if lookups else 0
+    return (f"Word tag cache: {info.hits} hits, {info.misses} misses "
+            f"({hit_rate:.0%}), {info.currsize}/{info.maxsize} words")
+
+
+# lru_cache is thread-safe, so handlers running concurrently may share it.
+@functools.lru_cache(maxsize=WORD_TAGS_CACHE_SIZE)
+def _normalized_word_tags(word: str) -> Tuple[WordTag, ...]:
     # Retain abbreviated canton names (e.g. "ZH").
-    if length < 2:
-        return []
+    if len(word) < 2:
+        return ()
+    return _tags_of_parses(word, _best_parses(word))
 
+
+def _best_parses(word: str) -> List:
+    """Returns the best Russian parse of the word, then the best Ukrainian
+    one, for the languages the word can be in."""
     is_russian = re.match(RUSSIAN_WORD, word)
     is_ukrainian = re.match(UKRAINIAN_WORD, word)
-    parse_ru = None
-    parse_uk = None
+    if not is_russian and not is_ukrainian:
+        return []
+    morph_ru, morph_uk = load_morph_analyzers()
+    best = []
     if is_russian:
-        parses = MORPH_RU.parse(word)
+        parses = morph_ru.parse(word)
         if parses:
-            parse_ru = parses[0]
+            best.append(parses[0])
     if is_ukrainian:
-        parses = MORPH_UK.parse(word)
+        parses = morph_uk.parse(word)
         if parses:
-            parse_uk = prefer_noun(word, parses)
+            best.append(prefer_noun(word, parses))
+    return best
+
 
+def _tags_of_parses(word: str, parses: List) -> Tuple[WordTag, ...]:
+    """Returns the tags of the known parses, or else of the first parse."""
     result = []
-    if parse_ru and parse_ru.is_known:
-        result.append(word_tag_for_parse(parse_ru))
-    if parse_uk and parse_uk.is_known:
-        word_tag_uk = word_tag_for_parse(parse_uk)
-        if word_tag_uk not in result:
-            result.append(word_tag_uk)
-    if not result and parse_ru:
-        result.append(word_tag_for_parse(parse_ru))
-    if not result and parse_uk:
-        result.append(word_tag_for_parse(parse_uk))
+    for parse in parses:
+        if parse.is_known:
+            word_tag = word_tag_for_parse(parse)
+            if word_tag not in result:
+                result.append(word_tag)
+    if not result and parses:
+        result.append(word_tag_for_parse(parses[0]))
     if not result:
         result.append(WordTag(word, UNKNOWN_POS))
-
-    return result
+    return tuple(result)
 
 
 def prefer_noun(original_word: str, parses: List):
@@ -90,73 +136,297 @@ def prefer_noun(original_word: str, parses: List):
     return candidate
 
 
+def state_version() -> str:
+    """Identifies the index state format and the analyzers that built it."""
+    return f"{SNAPSHOT_VERSION}:{pymorphy2.__version__}"
+
+
+def snapshot_key(conversation_textproto: str) -> str:
+    """Returns the key of the index snapshot for a conversation source."""
+    digest = hashlib.sha256()
+    digest.update(f"{state_version()}:".encode())
+    digest.update(conversation_textproto.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _node_terms(
+        node: conversation_proto.ConversationNode) -> Dict[WordTag, int]:
+    """Returns the summed weights of the word tags in a node's own texts."""
+    terms: Dict[WordTag, int] = {}
+
+    def process_text(text: str, weight: int):
+        words = re.split(SPLIT_REGEX, text)
+        for word in words:
+            wtags = word_tags(word)
+            for wt in wtags:
+                terms[wt] = terms.get(wt, 0) + weight
+
+    # Drastically boost search terms found in the node name.
+    process_text(node.name, NODE_NAME_TERM_SCORE)
+    for alt_name in node.alt_name:
+        process_text(alt_name, NODE_NAME_TERM_SCORE)
+    for keyword in node.keyword:
+        process_text(keyword, 1)
+    for ans in node.answer:
+        if ans.text:
+            process_text(ans.text, 1)
+        if ans.links and ans.links.text:
+            process_text(ans.links.text, 1)
+            for url in ans.links.url:
+                process_text(url.label, 1)
+    return terms
+
+
 class MorphoIndex:
+    """Inverted index from word tags to the conversation nodes.
+
+    Nodes get dense integer ids in the order they are first visited. The
+    postings of a word tag are a pair of arrays: the ids of the nodes
+    containing it, ascending, and the summed weights of its occurrences.
 
-    def __init__(self, conversation: conversation_proto.Conversation):
-        self._node_counts_by_word_tag: Dict[WordTag, Multiset] = {}
+    The word tags of every node are kept by the node's content fingerprint.
+    An index built with a previous index only analyzes the nodes whose name,
+    alt names, keywords or answers have changed, and keeps the postings of
+    word tags that no changed node contains.
 
-        def process_text(node: conversation_proto.ConversationNode, text: str,
-                         weight: int):
-            words = re.split(SPLIT_REGEX, text)
-            for word in words:
-                wtags = word_tags(word)
-                for wt in wtags:
-                    node_set = self._node_counts_by_word_tag.setdefault(
-                        wt, Multiset())
-                    node_set.add(node.name, weight)
+    Attributes:
+        reindexed_node_count (int): number of nodes analyzed to build the
+            index.
+    """
+
+    # State saved in snapshots.
+    _SNAPSHOT_FIELDS = ("_node_names", "_postings",
+                        "_parent_name_by_branch_name", "_node_fingerprints",
+                        "_terms_by_fingerprint")
+
+    def __init__(self,
+                 conversation: conversation_proto.Conversation,
+                 previous: Optional["MorphoIndex"] = None):
+        self._node_names: List[str] = []
+        self._parent_name_by_branch_name: Dict[str, str] = {}
+        # (node id, fingerprint) of every visit of a node, in visit order.
+        self._node_fingerprints: List[Tuple[int, bytes]] = []
+        self._terms_by_fingerprint: Dict[bytes, Dict[WordTag, int]] = {}
+        self.reindexed_node_count = 0
+        previous_terms = previous._terms_by_fingerprint if previous else {}
+        node_ids: Dict[str, int] = {}
 
         def process_node(node: conversation_proto.ConversationNode,
                          branch_parent: conversation_proto.ConversationNode):
             if node.name in IGNORED_NODES:
                 return
             if branch_parent:
-                parent_name_by_branch_name[node.name] = branch_parent.name
-
-            # Drastically boost search terms found in the node name.
-            process_text(node, node.name, NODE_NAME_TERM_SCORE)
-            for alt_name in node.alt_name:
-                process_text(node, alt_name, NODE_NAME_TERM_SCORE)
-            for keyword in node.keyword:
-                process_text(node, keyword, 1)
-            for ans in node.answer:
-                if ans.text:
-                    process_text(node, ans.text, 1)
-                if ans.links and ans.links.text:
-                    process_text(node, ans.links.text, 1)
-                    for url in ans.links.url:
-                        process_text(node, url.label, 1)
+                self._parent_name_by_branch_name[node.name] = \
+                    branch_parent.name
+            node_id = node_ids.setdefault(node.name, len(self._node_names))
+            if node_id == len(self._node_names):
+                self._node_names.append(node.name)
+            fingerprint = node_fingerprint(node, with_links=False)
+            if fingerprint not in self._terms_by_fingerprint:
+                terms = previous_terms.get(fingerprint)
+                if terms is None:
+                    terms = _node_terms(node)
+                    self.reindexed_node_count += 1
+                self._terms_by_fingerprint[fingerprint] = terms
+            self._node_fingerprints.append((node_id, fingerprint))
 
         for node in conversation.node:
             visit_node_with_branch_parent(node, process_node)
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug(
-                "node_counts_by_word_tag:\n%s",
-                pprint.pformat(self._node_counts_by_word_tag, indent=2))
+        self._postings: Dict[WordTag, Tuple[array, array]] = {}
+        self._build_postings(previous)
 
-    def search(self, text: str) -> List[SearchResult]:
-        words = re.split(SPLIT_REGEX, text)
-        result_multiset = Multiset()
-        found_word_count_by_node_name = {}
-        for word in words:
-            wtags = word_tags(word)
-            for wt in wtags:
-                node_counts = self._node_counts_by_word_tag.get(wt)
-                if not node_counts:
+    def _build_postings(self, previous: Optional["MorphoIndex"]):
+        changed_word_tags = None
+        if previous is not None and \
+                previous._node_names == self._node_names and \
+                len(previous._node_fingerprints) == len(
+                    self._node_fingerprints):
+            # Node ids are the same, so postings of word tags not found in
+            # changed nodes are still valid.
+            changed_word_tags = set()
+            for (_, fingerprint), (_, previous_fingerprint) in zip(
+                    self._node_fingerprints, previous._node_fingerprints):
+                if fingerprint != previous_fingerprint:
+                    changed_word_tags.update(
+                        self._terms_by_fingerprint[fingerprint])
+                    changed_word_tags.update(previous._terms_by_fingerprint[
+                        previous_fingerprint])
+            self._postings.update(
+                (wt, postings) for wt, postings in previous._postings.items()
+                if wt not in changed_word_tags)
+
+        weights_by_word_tag: Dict[WordTag, Dict[int, int]] = {}
+        for node_id, fingerprint in self._node_fingerprints:
+            for wt, weight in self._terms_by_fingerprint[fingerprint].items():
+                if changed_word_tags is not None and \
+                        wt not in changed_word_tags:
                     continue
-                for item in node_counts.items():
-                    count = found_word_count_by_node_name.get(item[0], 0)
-                    found_word_count_by_node_name[item[0]] = count + 1
-                    result_multiset.add(item[0], item[1])
+                node_weights = weights_by_word_tag.setdefault(wt, {})
+                node_weights[node_id] = node_weights.get(node_id, 0) + weight
+        self._postings.update(
+            (wt, (array(POSTING_TYPECODE, node_weights.keys()),
+                  array(POSTING_TYPECODE, node_weights.values())))
+            for wt, node_weights in weights_by_word_tag.items())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("node_weights_by_word_tag:\n%s",
+                         pprint.pformat(weights_by_word_tag, indent=2))
+
+    @classmethod
+    def load_or_build(
+            cls,
+            conversation: conversation_proto.Conversation,
+            conversation_textproto: str,
+            snapshot_dir: Optional[str],
+            previous: Optional["MorphoIndex"] = None) -> "MorphoIndex":
+        """Loads the index from a snapshot of the same conversation source, or
+        builds it, reusing the unchanged nodes of the previous index, and
+        saves a snapshot.
+
+        Building analyzes every word of the conversation, loading a snapshot
+        skips that. Snapshots are keyed by :func:`snapshot_key`, so a changed
+        conversation never gets a stale index.
+        """
+        if snapshot_dir is None:
+            return cls(conversation, previous)
+        path = os.path.join(
+            snapshot_dir,
+            SNAPSHOT_FILE_TEMPLATE.format(
+                snapshot_key(conversation_textproto)))
+        try:
+            with open(path, "rb") as f:
+                index = cls.from_state(pickle.load(f))
+                logger.info(f"Loaded search index snapshot {path}")
+                return index
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to load search index snapshot {path}",
+                           exc_info=e)
+
+        index = cls(conversation, previous)
+        try:
+            index._save_snapshot(path)
+        except Exception as e:
+            logger.warning(f"Failed to save search index snapshot {path}",
+                           exc_info=e)
+        return index
+
+    def state(self) -> Tuple:
+        """Returns the picklable state of the index, see :meth:`from_state`.
+        It is only valid for the same :func:`state_version`."""
+        return tuple(getattr(self, field) for field in self._SNAPSHOT_FIELDS)
+
+    @classmethod
+    def from_state(cls, state: Tuple) -> "MorphoIndex":
+        index = cls.__new__(cls)
+        for field, value in zip(cls._SNAPSHOT_FIELDS, state):
+            setattr(index, field, value)
+        index.reindexed_node_count = 0
+        return index
+
+    def _save_snapshot(self, path: str):
+        snapshot_dir = os.path.dirname(path)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        # Write to a temporary file first, so that a concurrent reader never
+        # sees a partially written snapshot.
+        with tempfile.NamedTemporaryFile(dir=snapshot_dir, delete=False) as f:
+            try:
+                pickle.dump(self.state(),
+                            f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+        for name in os.listdir(snapshot_dir):
+            if name != os.path.basename(path) and re.fullmatch(
+                    SNAPSHOT_FILE_TEMPLATE.format(".+"), name):
+                os.remove(os.path.join(snapshot_dir, name))
+
+    def _node_label(self, node_name: str) -> str:
+        parent_name = self._parent_name_by_branch_name.get(node_name)
+        if parent_name is None:
+            return node_name
+        return f"{parent_name}{BREADCRUMB_SEPARATOR}{node_name}"
+
+    def _word_postings(self, word: str) -> List[Tuple[array, array]]:
+        postings = []
+        for wt in word_tags(word):
+            word_tag_postings = self._postings.get(wt)
+            if word_tag_postings is not None:
+                postings.append(word_tag_postings)
+        return postings
+
+    def _rank(self, postings: Iterable[Tuple[array, array]],
+              k: Optional[int]) -> Tuple[List[SearchResult], int]:
+        node_count = len(self._node_names)
+        weight_sums = [0] * node_count
+        hit_counts = [0] * node_count
+        matched = []
+        for node_ids, weights in postings:
+            for node_id, weight in zip(node_ids, weights):
+                if hit_counts[node_id] == 0:
+                    matched.append(node_id)
+                hit_counts[node_id] += 1
+                weight_sums[node_id] += weight
 
         # Boost nodes having hits for multiple words from the query.
-        search_results = list(
-            map(
-                lambda tuple: SearchResult(
-                    tuple[0], tuple[1], tuple[0]
-                    if tuple[0] not in parent_name_by_branch_name else
-                    f"{parent_name_by_branch_name[tuple[0]]} > {tuple[0]}"),
-                [(node_name, count * found_word_count_by_node_name[node_name])
-                 for (node_name, count) in result_multiset.items()]))
-        search_results.sort(key=itemgetter(1), reverse=True)
-        logger.debug(f"Search: [{text}] -> {search_results}")
-        return search_results
+        scores = [
+            weight_sum * hit_count
+            for weight_sum, hit_count in zip(weight_sums, hit_counts)
+        ]
+        if k is None:
+            top_ids = sorted(matched, key=scores.__getitem__, reverse=True)
+        else:
+            # Stable like sorted(), so ties are ordered the same way.
+            top_ids = heapq.nlargest(k, matched, key=scores.__getitem__)
+        search_results = []
+        for node_id in top_ids:
+            node_name = self._node_names[node_id]
+            search_results.append(
+                SearchResult(node_name, scores[node_id],
+                             self._node_label(node_name)))
+        return search_results, len(matched)
+
+    def search_top_k(self, text: str,
+                     k: Optional[int]) -> Tuple[List[SearchResult], int]:
+        """Returns the k best matching nodes, best first, and the number of
+        all matching nodes. With k None, all matching nodes are returned.
+
+        Ties keep the order in which nodes are first matched by the query.
+        """
+        search_results, total = self._rank(
+            (postings for word in re.split(SPLIT_REGEX, text)
+             for postings in self._word_postings(word)), k)
+        logger.debug(f"Search: [{text}] -> {total} nodes, "
+                     f"top: {search_results}")
+        return search_results, total
+
+    def search_many(
+            self,
+            queries: Iterable[str],
+            k: Optional[int] = None) -> List[Tuple[List[SearchResult], int]]:
+        """Like :meth:`search_top_k` for a batch of queries.
+
+        Words are analyzed and looked up in the index once per batch, and
+        repeated queries are ranked once.
+        """
+        postings_by_word: Dict[str, List[Tuple[array, array]]] = {}
+        results_by_query: Dict[str, Tuple[List[SearchResult], int]] = {}
+        batch_results = []
+        for query in queries:
+            if query not in results_by_query:
+                query_postings = []
+                for word in re.split(SPLIT_REGEX, query):
+                    postings = postings_by_word.get(word)
+                    if postings is None:
+                        postings = self._word_postings(word)
+                        postings_by_word[word] = postings
+                    query_postings.extend(postings)
+                results_by_query[query] = self._rank(query_postings, k)
+            search_results, total = results_by_query[query]
+            batch_results.append((list(search_results), total))
+        return batch_results
+
+    def search(self, text: str) -> List[SearchResult]:
+        return self.search_top_k(text, None)[0]
@@ -1,3 +1,4 @@
+import hashlib
 import proto.conversation_pb2 as conversation_proto
 
 from typing import Set
@@ -32,3 +33,24 @@ def visit_node_with_branch_parent(
                    ) > 0 and subnode.branch.name not in visited:
                 visit_node_with_branch_parent(subnode.branch, consumer, node,
                                               visited)
+
+
+def node_fingerprint(node: conversation_proto.ConversationNode,
+                     with_links: bool = True) -> bytes:
+    """Returns a digest of the node's own content.
+
+    Branches are represented by their names only, so a change inside a branch
+    does not change the fingerprint of its parent.
+    """
+    shallow = conversation_proto.ConversationNode(name=node.name,
+                                                  alt_name=node.alt_name,
+                                                  keyword=node.keyword,
+                                                  answer=node.answer)
+    if with_links:
+        for link in node.link:
+            if link.HasField("branch"):
+                shallow.link.add().branch.name = link.branch.name
+            else:
+                shallow.link.add().name = link.name
+    return hashlib.blake2b(shallow.SerializeToString(deterministic=True),
+                           digest_size=16).digest()
@@ -0,0 +1,161 @@
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import hashlib
+import logging
+import os
+import threading
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+import telegram
+import telegram.error
+
+from runtime import BotApi, resolved
+
+REDIS_KEY = "PhotoCache:file_ids"
+
+logger = logging.getLogger(__name__)
+
+# Identifies a version of a photo file without reading it.
+_PhotoFile = namedtuple("_PhotoFile", ["mtime_ns", "size", "content_hash"])
+
+
+class PhotoCache:
+    """Sends photos by the file_id Telegram assigned to them on their first
+    upload.
+
+    File ids are kept by the content hash of the photo, in memory and, when
+    Redis is given, in a Redis hash, so they survive restarts. The asyncio
+    runtime gives an asyncio client. A photo file is only read when it is new
+    or its modification time or size have changed. A file id Telegram no
+    longer accepts is dropped and the photo uploaded again.
+    """
+
+    def __init__(self,
+                 photo_dir: str,
+                 redis: Optional[Union[Redis, AsyncRedis]] = None):
+        self.photo_dir = photo_dir
+        self.redis = redis
+        self._files: Dict[str, _PhotoFile] = {}
+        self._file_ids: Optional[Dict[str, str]] = None
+        self._file_ids_lock = threading.Lock()
+
+    async def _load_file_ids(self) -> Dict[str, str]:
+        if self._file_ids is None:
+            # Not loaded under the lock, which would block the event loop of
+            # the asyncio runtime while it awaits Redis.
+            file_ids = {}
+            if self.redis is not None:
+                try:
+                    file_ids = {
+                        content_hash.decode(): file_id.decode()
+                        for content_hash, file_id in (await resolved(
+                            self.redis.hgetall(REDIS_KEY))).items()
+                    }
+                except Exception as e:
+                    logger.error("Failed to load photo file ids", exc_info=e)
+            with self._file_ids_lock:
+                if self._file_ids is None:
+                    self._file_ids = file_ids
+        return self._file_ids
+
+    async def _store_file_id(self, content_hash: str,
+                             file_id: Optional[str]):
+        file_ids = await self._load_file_ids()
+        if file_id is None:
+            file_ids.pop(content_hash, None)
+        else:
+            file_ids[content_hash] = file_id
+        if self.redis is None:
+            return
+        try:
+            if file_id is None:
+                await resolved(self.redis.hdel(REDIS_KEY, content_hash))
+            else:
+                await resolved(
+                    self.redis.hset(REDIS_KEY, content_hash, file_id))
+        except Exception as e:
+            logger.error("Failed to store photo file id", exc_info=e)
+
+    def _photo_file(self,
+                    name: str) -> Tuple[_PhotoFile, Optional[bytes]]:
+        """Returns the current version of a photo file, and its contents if
+        they had to be read."""
+        path = os.path.join(self.photo_dir, name)
+        stat = os.stat(path)
+        photo_file = self._files.get(name)
+        if photo_file is not None and \
+                photo_file.mtime_ns == stat.st_mtime_ns and \
+                photo_file.size == stat.st_size:
+            return photo_file, None
+        with open(path, "rb") as f:
+            photo_bytes = f.read()
+        photo_file = _PhotoFile(stat.st_mtime_ns, stat.st_size,
+                                hashlib.sha256(photo_bytes).hexdigest())
+        self._files[name] = photo_file
+        return photo_file, photo_bytes
+
+    def _read(self, name: str) -> bytes:
+        with open(os.path.join(self.photo_dir, name), "rb") as f:
+            return f.read()
+
+    async def _remember_sent(self, photo_files: List[_PhotoFile],
+                             sent_messages: List[telegram.Message]):
+        for photo_file, sent in zip(photo_files, sent_messages):
+            if sent is not None and sent.photo:
+                # Any size identifies the photo, the last one is the largest.
+                await self._store_file_id(photo_file.content_hash,
+                                          sent.photo[-1].file_id)
+
+    async def send_photo(self,
+                         api: BotApi,
+                         chat_id: int,
+                         name: str,
+                         reply_markup: telegram.ReplyMarkup = None):
+        photo_file, photo_bytes = self._photo_file(name)
+        file_id = (await self._load_file_ids()).get(photo_file.content_hash)
+        if file_id is not None:
+            try:
+                return await api.send_photo(chat_id,
+                                            file_id,
+                                            reply_markup=reply_markup)
+            except telegram.error.BadRequest as e:
+                logger.warning(f"File id of photo {name} was rejected, "
+                               f"uploading it again: {e}")
+                await self._store_file_id(photo_file.content_hash, None)
+
+        sent = await api.send_photo(chat_id,
+                                    photo_bytes or self._read(name),
+                                    reply_markup=reply_markup)
+        await self._remember_sent([photo_file], [sent])
+        return sent
+
+    async def send_media_group(
+            self, api: BotApi, chat_id: int,
+            names: Sequence[str]) -> List[telegram.Message]:
+        """Sends photos as one album, of 2 to 10 photos."""
+        photo_files = []
+        media = []
+        file_ids = await self._load_file_ids()
+        for name in names:
+            photo_file, photo_bytes = self._photo_file(name)
+            photo_files.append(photo_file)
+            media.append(
+                file_ids.get(photo_file.content_hash) or photo_bytes or
+                self._read(name))
+        try:
+            sent = await api.send_media_group(
+                chat_id, [telegram.InputMediaPhoto(m) for m in media])
+        except telegram.error.BadRequest as e:
+            if all(isinstance(m, bytes) for m in media):
+                raise
+            # It is not known which file id was rejected, upload all.
+            logger.warning(f"File ids of photos {names} were rejected, "
+                           f"uploading them again: {e}")
+            for photo_file in photo_files:
+                await self._store_file_id(photo_file.content_hash, None)
+            sent = await api.send_media_group(chat_id, [
+                telegram.InputMediaPhoto(self._read(name)) for name in names
+            ])
+        await self._remember_sent(photo_files, sent)
+        return sent
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: session.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rsession.proto\x12\x05proto\"\xcb\x01\n\x0bUserSession\x12\x0f\n\x07version\x18\x01 \x01(\r\x12\x19\n\x0c\x63urrent_node\x18\x02 \x01(\tH\x00\x88\x01\x01\x12\x11\n\tnav_stack\x18\x03 \x03(\t\x12\x34\n\x08\x66\x65\x65\x64\x62\x61\x63k\x18\x04 \x03(\x0b\x32\".proto.UserSession.FeedbackMessage\x1a\x36\n\x0f\x46\x65\x65\x64\x62\x61\x63kMessage\x12\x0f\n\x07\x63hat_id\x18\x01 \x01(\x03\x12\x12\n\nmessage_id\x18\x02 \x01(\x03\x42\x0f\n\r_current_node\"@\n\x11\x43onversationState\x12\x0f\n\x07version\x18\x01 \x01(\r\x12\x0b\n\x03key\x18\x02 \x03(\x03\x12\r\n\x05state\x18\x03 \x01(\x05\x62\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'session_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _USERSESSION._serialized_start=25
+  _USERSESSION._serialized_end=228
+  _USERSESSION_FEEDBACKMESSAGE._serialized_start=157
+  _USERSESSION_FEEDBACKMESSAGE._serialized_end=211
+  _CONVERSATIONSTATE._serialized_start=230
+  _CONVERSATIONSTATE._serialized_end=294
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,316 @@
+"""Keeps outbound Telegram requests within the flood limits.
+
+Every request that sends something to a chat first takes a token from the
+bucket of that chat and from the global bucket. Requests waiting for tokens
+are admitted by priority: replies to users go before traffic to groups and
+channels, like error reports and forwarded feedback, and otherwise in the
+order they arrived. Channel traffic is sent in the background, so that
+waiting for it does not hold up the handling of updates. A request rejected
+with RetryAfter pauses its chat for the time Telegram asks and is retried.
+The asyncio runtime waits for tokens with acquire_async.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Union
+import asyncio
+import itertools
+import logging
+import threading
+import time
+
+from telegram.constants import (
+    MAX_MESSAGES_PER_MINUTE_PER_GROUP,
+    MAX_MESSAGES_PER_SECOND,
+    MAX_MESSAGES_PER_SECOND_PER_CHAT,
+)
+from telegram.ext import ExtBot
+from telegram.utils.helpers import DEFAULT_NONE
+import telegram.error
+
+from monitoring import TELEGRAM_API_LATENCY
+
+USER_PRIORITY, CHANNEL_PRIORITY = range(2)
+
+GLOBAL_RATE = MAX_MESSAGES_PER_SECOND
+GLOBAL_BURST = MAX_MESSAGES_PER_SECOND
+# Telegram allows short bursts in a chat, a node is sent in a few messages.
+PRIVATE_CHAT_RATE = MAX_MESSAGES_PER_SECOND_PER_CHAT
+PRIVATE_CHAT_BURST = 5
+GROUP_CHAT_RATE = MAX_MESSAGES_PER_MINUTE_PER_GROUP / 60
+GROUP_CHAT_BURST = 3
+# Buckets of idle chats are dropped when more chats than this are tracked.
+MAX_TRACKED_CHATS = 10000
+
+MAX_FLOOD_RETRIES = 3
+# A request is not retried when Telegram asks to wait longer than this.
+MAX_RETRY_AFTER_SEC = 60
+# Methods that send something to the chat in their chat_id parameter.
+LIMITED_ENDPOINTS = ("send", "forward", "copy")
+
+logger = logging.getLogger(__name__)
+
+ChatId = Union[int, str]
+
+
+def chat_priority(chat_id: ChatId) -> int:
+    # Private chats have positive ids, groups and channels negative ids or
+    # @usernames.
+    if isinstance(chat_id, int) and chat_id > 0:
+        return USER_PRIORITY
+    return CHANNEL_PRIORITY
+
+
+class TokenBucket:
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Returns the seconds until a token is available."""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Makes the next token available in seconds at the earliest."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundLimiter:
+
+    def __init__(self,
+                 global_rate: float = GLOBAL_RATE,
+                 global_burst: float = GLOBAL_BURST,
+                 private_chat_rate: float = PRIVATE_CHAT_RATE,
+                 private_chat_burst: float = PRIVATE_CHAT_BURST,
+                 group_chat_rate: float = GROUP_CHAT_RATE,
+                 group_chat_burst: float = GROUP_CHAT_BURST,
+                 clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._private_chat_limit = (private_chat_rate, private_chat_burst)
+        self._group_chat_limit = (group_chat_rate, group_chat_burst)
+        self._global_bucket = TokenBucket(global_rate, global_burst, clock())
+        self._chat_buckets: Dict[ChatId, TokenBucket] = {}
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        # Chat ids of requests waiting for tokens, by (priority, ticket).
+        self._waiting: Dict[tuple, ChatId] = {}
+        # Set when the limiter changes, to wake up acquire_async.
+        self._changed: Optional[asyncio.Event] = None
+
+        self.admitted = 0
+        self.delayed = 0
+        self.total_wait_sec = 0.0
+        self.max_wait_sec = 0.0
+        self.flood_waits = 0
+
+    def _chat_bucket(self, chat_id: ChatId, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_TRACKED_CHATS:
+                waiting = set(self._waiting.values())
+                self._chat_buckets = {
+                    c: b
+                    for c, b in self._chat_buckets.items()
+                    if c in waiting or not b.is_full(now)
+                }
+            rate, burst = self._private_chat_limit \
+                if chat_priority(chat_id) == USER_PRIORITY \
+                else self._group_chat_limit
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                rate, burst, now)
+        return bucket
+
+    def _admission_delay(self, ticket: tuple, chat_id: ChatId,
+                         now: float) -> Optional[float]:
+        """Returns the seconds until the request can be admitted, or None
+        when it has to wait for another request to be admitted first."""
+        for other_ticket, other_chat_id in self._waiting.items():
+            if other_ticket < ticket and (
+                    other_chat_id == chat_id or
+                    self._chat_bucket(other_chat_id, now).delay(now) == 0):
+                return None
+        return max(
+            self._chat_bucket(chat_id, now).delay(now),
+            self._global_bucket.delay(now))
+
+    def _enqueue(self, chat_id: ChatId) -> tuple:
+        ticket = (chat_priority(chat_id), next(self._tickets))
+        self._waiting[ticket] = chat_id
+        return ticket
+
+    def _dequeue(self, ticket: tuple):
+        del self._waiting[ticket]
+        self._notify()
+
+    def _admit(self, chat_id: ChatId, now: float):
+        self._chat_bucket(chat_id, now).take(now)
+        self._global_bucket.take(now)
+
+    def _record_wait(self, waited: float) -> float:
+        self.admitted += 1
+        if waited > 0:
+            self.delayed += 1
+            self.total_wait_sec += waited
+            self.max_wait_sec = max(self.max_wait_sec, waited)
+        return waited
+
+    def _notify(self):
+        self._condition.notify_all()
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def acquire(self, chat_id: ChatId) -> float:
+        """Blocks until a request to the chat may be sent. Returns the
+        seconds waited."""
+        with self._condition:
+            start = now = self._clock()
+            ticket = self._enqueue(chat_id)
+            try:
+                while True:
+                    delay = self._admission_delay(ticket, chat_id, now)
+                    if delay == 0:
+                        break
+                    self._condition.wait(delay)
+                    now = self._clock()
+                self._admit(chat_id, now)
+            finally:
+                self._dequeue(ticket)
+            return self._record_wait(now - start)
+
+    async def acquire_async(self, chat_id: ChatId) -> float:
+        """Waits until a request to the chat may be sent without blocking the
+        event loop, which must be the only one using the limiter. Returns the
+        seconds waited."""
+        with self._condition:
+            start = now = self._clock()
+            ticket = self._enqueue(chat_id)
+        try:
+            while True:
+                with self._condition:
+                    delay = self._admission_delay(ticket, chat_id, now)
+                    if delay == 0:
+                        self._admit(chat_id, now)
+                        break
+                # Nothing else changes the limiter until this awaits.
+                if self._changed is None:
+                    self._changed = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                now = self._clock()
+        finally:
+            with self._condition:
+                self._dequeue(ticket)
+        with self._condition:
+            return self._record_wait(now - start)
+
+    def pause(self, chat_id: ChatId, seconds: float):
+        with self._condition:
+            now = self._clock()
+            self._chat_bucket(chat_id, now).pause(now, seconds)
+            self.flood_waits += 1
+            self._notify()
+
+    def queue_depth(self, priority: int) -> int:
+        with self._condition:
+            return sum(1 for p, _ in self._waiting if p == priority)
+
+
+class RateLimitedBot(ExtBot):
+    """Bot whose requests to chats go through an OutboundLimiter."""
+
+    def __init__(self, token: str, limiter: OutboundLimiter, **kwargs):
+        super().__init__(token, **kwargs)
+        self.limiter = limiter
+        self.sent = 0
+        self.total_send_sec = 0.0
+        self._background = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ChannelSender")
+        self._background_pending = 0
+        self._lock = threading.Lock()
+
+    def _post(self,
+              endpoint: str,
+              data=None,
+              timeout=DEFAULT_NONE,
+              api_kwargs=None):
+        chat_id = data.get("chat_id") if data else None
+        if chat_id is None or not endpoint.startswith(LIMITED_ENDPOINTS):
+            with TELEGRAM_API_LATENCY.labels(endpoint).time():
+                return super()._post(endpoint, data, timeout, api_kwargs)
+
+        for attempt in itertools.count():
+            self.limiter.acquire(chat_id)
+            start = time.monotonic()
+            try:
+                return super()._post(endpoint, data, timeout, api_kwargs)
+            except telegram.error.RetryAfter as e:
+                if attempt >= MAX_FLOOD_RETRIES or \
+                        e.retry_after > MAX_RETRY_AFTER_SEC:
+                    raise
+                logger.warning(f"Flood control on {endpoint} to {chat_id}, "
+                               f"retrying in {e.retry_after}s")
+                self.limiter.pause(chat_id, e.retry_after)
+            finally:
+                elapsed = time.monotonic() - start
+                TELEGRAM_API_LATENCY.labels(endpoint).observe(elapsed)
+                with self._lock:
+                    self.sent += 1
+                    self.total_send_sec += elapsed
+
+    def send_in_background(self, send: Callable, *args, **kwargs) -> Future:
+        """Calls send, which sends to groups or channels, in the background
+        thread. Calls are made one at a time in the order submitted."""
+
+        def run():
+            try:
+                return send(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._background_pending -= 1
+
+        with self._lock:
+            self._background_pending += 1
+        return self._background.submit(run)
+
+    def outbound_stats(self) -> str:
+        return outbound_stats(self.limiter, self.sent, self.total_send_sec,
+                              self._background_pending)
+
+
+def outbound_stats(limiter: OutboundLimiter, sent: int, total_send_sec: float,
+                   background_pending: int) -> str:
+    average_wait_ms = 1000 * limiter.total_wait_sec / limiter.delayed \
+        if limiter.delayed else 0
+    average_send_ms = 1000 * total_send_sec / sent if sent else 0
+    return (f"Outbound requests: {sent}, "
+            f"average {average_send_ms:.0f} ms; "
+            f"delayed by limits: {limiter.delayed}, "
+            f"average wait {average_wait_ms:.0f} ms, "
+            f"max {1000 * limiter.max_wait_sec:.0f} ms; "
+            f"flood waits: {limiter.flood_waits}\n"
+            f"Waiting: users {limiter.queue_depth(USER_PRIORITY)}, "
+            f"channels {limiter.queue_depth(CHANNEL_PRIORITY)}, "
+            f"background {background_pending}")
@@ -0,0 +1,173 @@
+"""Running several bot processes behind one webhook.
+
+Replicas share nothing but Redis:
+
+- the session state, written by RedisPersistence in versioned mode,
+- a lock per chat, held while an update of the chat is handled, so updates
+  of a chat are handled one at a time even when they reach different
+  replicas,
+- the id of the last update handled per chat. Telegram delivers updates
+  over concurrent connections, so a replica may get the lock of a chat for
+  an update after another replica handled a later one. Such an update is
+  dropped, so the updates of a chat are handled in order, though not every
+  one of them,
+- a pub/sub channel on which a replica that reloaded the conversation tells
+  the others to reload it too.
+"""
+
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+import json
+import logging
+import threading
+import time
+import uuid
+
+from redis import Redis
+from telegram import Update
+
+from bot_redis_persistence import RedisPersistence
+from chat_dispatcher import ChatOrderedDispatcher
+from monitoring import STALE_UPDATES
+
+CHAT_LOCK_KEY_PREFIX = "Replicas:chat_lock:"
+LAST_UPDATE_KEY_PREFIX = "Replicas:last_update:"
+RELOAD_CHANNEL = "Replicas:conversation_reloaded"
+# A replica that dies while handling an update blocks its chat this long.
+CHAT_LOCK_TTL_MS = 30000
+CHAT_LOCK_POLL_INTERVAL_SEC = 0.01
+# Telegram keeps undelivered updates for a day.
+LAST_UPDATE_TTL_MS = 24 * 60 * 60 * 1000
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLocks:
+
+    def __init__(self,
+                 redis: Redis,
+                 ttl_ms: int = CHAT_LOCK_TTL_MS,
+                 poll_interval: float = CHAT_LOCK_POLL_INTERVAL_SEC):
+        self.redis = redis
+        self.ttl_ms = ttl_ms
+        self.poll_interval = poll_interval
+
+    @contextmanager
+    def hold(self, chat_id: int) -> Iterator[None]:
+        key = f"{CHAT_LOCK_KEY_PREFIX}{chat_id}"
+        token = uuid.uuid4().hex.encode()
+        while not self.redis.set(key, token, nx=True, px=self.ttl_ms):
+            time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            self._release(key, token)
+
+    def claim_update(self, chat_id: int, update_id: int) -> bool:
+        """Records the update as the last handled of the chat, unless the
+        same or a later update of the chat was handled. Called while holding
+        the lock of the chat."""
+        key = f"{LAST_UPDATE_KEY_PREFIX}{chat_id}"
+        last_update_id = self.redis.get(key)
+        if last_update_id is not None and int(last_update_id) >= update_id:
+            return False
+        self.redis.set(key, update_id, px=LAST_UPDATE_TTL_MS)
+        return True
+
+    def _release(self, key: str, token: bytes):
+
+        def release(pipeline):
+            # The lock may have expired and been taken by another replica.
+            if pipeline.get(key) == token:
+                pipeline.multi()
+                pipeline.delete(key)
+
+        try:
+            self.redis.transaction(release, key)
+        except Exception as e:
+            logger.error(f"Failed to release {key}", exc_info=e)
+
+
+class ReplicaDispatcher(ChatOrderedDispatcher):
+    """Handles an update while holding the lock of its chat, with the state
+    of the user read again from Redis. Drops updates older than the last
+    handled update of the chat."""
+
+    def __init__(self, *args, chat_locks: ChatLocks, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not isinstance(self.persistence, RedisPersistence) or \
+                not self.persistence.versioned:
+            raise ValueError("Replicas need versioned RedisPersistence")
+        self.chat_locks = chat_locks
+        self.out_of_order = 0
+        self._out_of_order_lock = threading.Lock()
+
+    def process_chat_update(self, update: Update) -> None:
+        chat_id = update.effective_chat.id
+        with self.chat_locks.hold(chat_id):
+            if not self.chat_locks.claim_update(chat_id, update.update_id):
+                logger.warning(f"Dropping update {update.update_id} of chat "
+                               f"{chat_id}, a later one was handled")
+                with self._out_of_order_lock:
+                    self.out_of_order += 1
+                STALE_UPDATES.inc()
+                return
+            user = update.effective_user
+            self.persistence.forget(chat_id,
+                                    user.id if user is not None else None)
+            super().process_chat_update(update)
+
+    def update_stats(self) -> str:
+        return (f"{super().update_stats()}; dropped out of order: "
+                f"{self.out_of_order}")
+
+
+class ReloadBroadcaster:
+    """Tells other replicas that the conversation was reloaded, and calls
+    on_reload with the content hash when another replica did."""
+
+    def __init__(self, redis: Redis, on_reload: Callable[[str], None]):
+        self.redis = redis
+        self.on_reload = on_reload
+        self.replica_id = uuid.uuid4().hex
+        self._pubsub = None
+        self._thread = None
+
+    def publish(self, content_hash: str):
+        try:
+            self.redis.publish(
+                RELOAD_CHANNEL,
+                json.dumps({
+                    "replica": self.replica_id,
+                    "content_hash": content_hash
+                }))
+        except Exception as e:
+            logger.error("Failed to announce conversation reload",
+                         exc_info=e)
+
+    def _on_message(self, message: dict):
+        try:
+            announcement = json.loads(message["data"])
+        except ValueError as e:
+            logger.warning(f"Ignoring reload announcement: {e}")
+            return
+        if announcement.get("replica") == self.replica_id:
+            return
+        logger.info(f"Replica {announcement.get('replica')} reloaded the "
+                    f"conversation")
+        self.on_reload(announcement.get("content_hash"))
+
+    def start(self, poll_interval: Optional[float] = 1.0):
+        self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{RELOAD_CHANNEL: self._on_message})
+        self._thread = self._pubsub.run_in_thread(sleep_time=poll_interval,
+                                                  daemon=True)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread.join()
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
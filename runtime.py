@@ -0,0 +1,190 @@
+"""Runs the conversation logic of the bot on either of its runtimes.
+
+Handlers are coroutines. They talk to Telegram, and run blocking or
+background work, through the BotApi of their context. The asyncio runtime of
+async_runtime.py awaits them on its event loop. The threaded runtime calls
+them on the threads of its dispatcher through sync_handler: its
+ThreadedBotApi makes blocking requests, so a handler never suspends and
+run_sync runs it to completion in one step.
+"""
+
+from concurrent.futures import Executor
+from typing import (Any, Awaitable, Callable, Coroutine, List, Optional,
+                    Sequence, TypeVar, Union)
+import functools
+import inspect
+
+import telegram
+
+T = TypeVar("T")
+
+
+def run_sync(coroutine: Coroutine[Any, Any, T]) -> T:
+    """Runs a coroutine which never suspends and returns its result."""
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError(
+        f"{coroutine.__qualname__} suspended outside of an event loop")
+
+
+def sync_handler(handler: Callable[..., Coroutine]) -> Callable:
+    """Returns a callback for python-telegram-bot, which runs the handler
+    coroutine with run_sync."""
+
+    @functools.wraps(handler)
+    def run(*args, **kwargs):
+        return run_sync(handler(*args, **kwargs))
+
+    return run
+
+
+async def resolved(value: Union[T, Awaitable[T]]) -> T:
+    """Returns the value, awaited if an asynchronous client returned it."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class BotApi:
+    """Telegram Bot API methods the conversation logic uses, and how it runs
+    work besides the handling of an update."""
+
+    async def send_message(
+            self,
+            chat_id: int,
+            text: str,
+            parse_mode: Optional[str] = None,
+            reply_markup: Optional[telegram.ReplyMarkup] = None,
+            entities: Optional[List[telegram.MessageEntity]] = None
+    ) -> telegram.Message:
+        pass
+
+    async def send_photo(
+            self,
+            chat_id: int,
+            photo: Union[str, bytes],
+            reply_markup: Optional[telegram.ReplyMarkup] = None
+    ) -> telegram.Message:
+        """Sends a photo by its file id, or uploads it."""
+        pass
+
+    async def send_media_group(
+            self, chat_id: int,
+            media: Sequence[telegram.InputMediaPhoto]
+    ) -> List[telegram.Message]:
+        pass
+
+    async def send_venue(
+            self,
+            chat_id: int,
+            latitude: float,
+            longitude: float,
+            title: str,
+            address: str,
+            google_place_id: Optional[str] = None,
+            reply_markup: Optional[telegram.ReplyMarkup] = None
+    ) -> telegram.Message:
+        pass
+
+    async def forward_message(self, chat_id: int, from_chat_id: int,
+                              message_id: int) -> telegram.Message:
+        pass
+
+    async def answer_callback_query(self,
+                                    callback_query_id: str,
+                                    text: Optional[str] = None,
+                                    show_alert: bool = False) -> bool:
+        pass
+
+    def send_in_background(self, send: Callable[..., Coroutine], *args):
+        """Runs send(*args), which sends to groups or channels, in the
+        background. Calls are made one at a time in the order submitted."""
+        pass
+
+    def run_in_background(self, coroutine: Coroutine):
+        """Runs the coroutine in the background, after the ones submitted
+        before."""
+        pass
+
+    async def run_blocking(self, fn: Callable[..., T], *args) -> T:
+        """Returns fn(*args), called where blocking does not hold up the
+        handling of other updates."""
+        pass
+
+    def outbound_stats(self) -> str:
+        pass
+
+
+class ThreadedBotApi(BotApi):
+    """BotApi of the threaded runtime. Requests are made by a blocking bot,
+    a RateLimitedBot when it serves the bot, and background coroutines run
+    on the executor. Blocking work runs right away on the thread handling
+    the update, or the one of the background coroutine."""
+
+    def __init__(self, bot: telegram.Bot, executor: Executor):
+        self.bot = bot
+        self.executor = executor
+
+    async def send_message(self,
+                           chat_id,
+                           text,
+                           parse_mode=None,
+                           reply_markup=None,
+                           entities=None):
+        return self.bot.send_message(chat_id=chat_id,
+                                     text=text,
+                                     parse_mode=parse_mode,
+                                     reply_markup=reply_markup,
+                                     entities=entities)
+
+    async def send_photo(self, chat_id, photo, reply_markup=None):
+        return self.bot.send_photo(chat_id=chat_id,
+                                   photo=photo,
+                                   reply_markup=reply_markup)
+
+    async def send_media_group(self, chat_id, media):
+        return self.bot.send_media_group(chat_id=chat_id, media=media)
+
+    async def send_venue(self,
+                         chat_id,
+                         latitude,
+                         longitude,
+                         title,
+                         address,
+                         google_place_id=None,
+                         reply_markup=None):
+        return self.bot.send_venue(chat_id=chat_id,
+                                   latitude=latitude,
+                                   longitude=longitude,
+                                   title=title,
+                                   address=address,
+                                   google_place_id=google_place_id,
+                                   reply_markup=reply_markup)
+
+    async def forward_message(self, chat_id, from_chat_id, message_id):
+        return self.bot.forward_message(chat_id=chat_id,
+                                        from_chat_id=from_chat_id,
+                                        message_id=message_id)
+
+    async def answer_callback_query(self,
+                                    callback_query_id,
+                                    text=None,
+                                    show_alert=False):
+        return self.bot.answer_callback_query(callback_query_id,
+                                              text=text,
+                                              show_alert=show_alert)
+
+    def send_in_background(self, send, *args):
+        return self.bot.send_in_background(run_sync, send(*args))
+
+    def run_in_background(self, coroutine):
+        return self.executor.submit(run_sync, coroutine)
+
+    async def run_blocking(self, fn, *args):
+        return fn(*args)
+
+    def outbound_stats(self):
+        return self.bot.outbound_stats()
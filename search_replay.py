@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Replays search queries against a conversation tree.
+
+Prints the top results of every query and the search throughput, so changes
+to the conversation tree can be checked for relevance and latency before a
+deploy. Queries are read one per line from a file or stdin:
+
+    $ python search_replay.py --queries tests/search_queries.txt
+
+or taken from the most frequent queries recorded by the bot's search stats:
+
+    $ python search_replay.py --redis-url "$REDIS_TLS_URL" --limit 100
+
+Queries from the stats are shown with the number of nodes they matched when
+they were searched, and flagged if the number differs now.
+"""
+
+import argparse
+import re
+import sys
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import urlparse
+
+import google.protobuf.text_format as text_format
+import redis
+
+import proto.conversation_pb2 as conversation_proto
+import stats
+from morpho_index import SPLIT_REGEX, MorphoIndex
+
+# Search stats are stored in this database of the bot, see bot.py.
+METRICS_DATABASE = 1
+
+
+def read_queries(path: str) -> List[Tuple[str, Optional[str]]]:
+    f = sys.stdin if path == "-" else open(path, "r")
+    with f:
+        return [(line.strip(), None) for line in f if line.strip()]
+
+
+def read_stats_queries(redis_url: str, redis_db: int,
+                       limit: int) -> List[Tuple[str, Optional[str]]]:
+    url = urlparse(redis_url)
+    rd = redis.Redis(db=redis_db,
+                     host=url.hostname,
+                     port=url.port,
+                     username=url.username,
+                     password=url.password,
+                     ssl=url.scheme == "rediss",
+                     ssl_cert_reqs=None)
+    bot_stats = stats.Stats(stats.RedisStorage(rd))
+    return [(query, matching_nodes)
+            for query, matching_nodes, _ in bot_stats.top_queries(limit)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--conversation",
+                        default="conversation_tree.textproto",
+                        help="conversation tree to search")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--queries",
+                        help="file with one query per line, - for stdin")
+    source.add_argument("--redis-url", help="Redis with the bot's stats")
+    parser.add_argument("--redis-db", type=int, default=METRICS_DATABASE)
+    parser.add_argument("--limit",
+                        type=int,
+                        default=stats.TOP_K_QUERIES,
+                        help="number of top queries to take from the stats")
+    parser.add_argument("--top",
+                        type=int,
+                        default=3,
+                        help="results to show per query")
+    parser.add_argument("--snapshot-dir",
+                        default=None,
+                        help="load or save the search index snapshot here")
+    args = parser.parse_args()
+
+    if args.queries:
+        queries = read_queries(args.queries)
+    else:
+        queries = read_stats_queries(args.redis_url, args.redis_db,
+                                     args.limit)
+
+    with open(args.conversation, "r") as f:
+        textproto = f.read()
+    t0 = time.perf_counter()
+    index = MorphoIndex.load_or_build(
+        text_format.Parse(textproto, conversation_proto.Conversation()),
+        textproto, args.snapshot_dir)
+    t_index = time.perf_counter()
+    results = index.search_many([query for query, _ in queries], args.top)
+    t_search = time.perf_counter()
+
+    changed = 0
+    for (query, logged_matches), (top, total) in zip(queries, results):
+        header = f"'{query}': {total} nodes"
+        if logged_matches is not None and logged_matches != str(total):
+            header += f" (was {logged_matches})"
+            changed += 1
+        print(header)
+        for result in top:
+            print(f"\t{result.score}\t{result.node_label}")
+
+    query_count = len(queries)
+    distinct_words = len({
+        word
+        for query, _ in queries
+        for word in re.split(SPLIT_REGEX, query)
+    })
+    search_sec = t_search - t_index
+    print(f"\nIndex ready in {(t_index - t0) * 1000:.0f} ms.")
+    print(f"Searched {query_count} queries ({distinct_words} distinct words) "
+          f"in {search_sec * 1000:.1f} ms: "
+          f"{query_count / search_sec if search_sec else 0:.0f} queries/s, "
+          f"{search_sec / query_count * 1e6 if query_count else 0:.0f} "
+          f"us/query.")
+    if changed:
+        print(f"{changed} queries match a different number of nodes than "
+              f"when they were searched.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Compact, versioned encoding of the persisted per-user bot state.
+
+A user session is stored as a serialized `proto.UserSession` message. Only
+the state the bot needs is kept: the current node, the navigation stack and
+the (chat id, message id) pairs of the messages collected for feedback.
+
+Values written by older versions of the bot are pickles. They are recognized
+by the pickle protocol opcode every pickle starts with and converted on read,
+so a stored state survives the upgrade.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+import logging
+import pickle
+
+import proto.session_pb2 as session_proto
+
+SESSION_VERSION = 1
+# Every pickle of protocol 2 and up starts with the PROTO opcode. A serialized
+# message starts with the tag of the version field instead.
+PICKLE_PROTO_OPCODE = b"\x80"
+USER_DATA_KEYS = ("current_node", "nav_stack", "feedback")
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedVersionError(ValueError):
+    pass
+
+
+def _is_pickle(data_bytes: bytes) -> bool:
+    return data_bytes[:1] == PICKLE_PROTO_OPCODE
+
+
+def _check_version(version: int):
+    if version > SESSION_VERSION:
+        raise UnsupportedVersionError(
+            f"Session version {version} is newer than {SESSION_VERSION}.")
+
+
+def _feedback_ids(feedback) -> Tuple[int, int]:
+    # Older versions kept whole telegram.Message objects.
+    if isinstance(feedback, tuple):
+        return feedback
+    return (feedback.chat_id, feedback.message_id)
+
+
+def encode_user_data(user_data: Dict[str, Any]) -> bytes:
+    session = session_proto.UserSession(version=SESSION_VERSION)
+    if "current_node" in user_data:
+        session.current_node = user_data["current_node"]
+    session.nav_stack.extend(user_data.get("nav_stack") or [])
+    for feedback in user_data.get("feedback") or []:
+        chat_id, message_id = _feedback_ids(feedback)
+        session.feedback.add(chat_id=chat_id, message_id=message_id)
+    unknown_keys = user_data.keys() - set(USER_DATA_KEYS)
+    if unknown_keys:
+        logger.warning("Not persisting unknown user_data keys: %s",
+                       unknown_keys)
+    return session.SerializeToString()
+
+
+def decode_user_data(data_bytes: bytes) -> Dict[str, Any]:
+    if _is_pickle(data_bytes):
+        # Round trip to drop what the session format does not keep.
+        return decode_user_data(encode_user_data(pickle.loads(data_bytes)))
+
+    session = session_proto.UserSession.FromString(data_bytes)
+    _check_version(session.version)
+    if not session.HasField("current_node"):
+        return {}
+    return {
+        "current_node": session.current_node,
+        "nav_stack": list(session.nav_stack),
+        "feedback": [(f.chat_id, f.message_id) for f in session.feedback],
+    }
+
+
+def encode_conversation_state(key: Tuple[int, ...], state: int) -> bytes:
+    return session_proto.ConversationState(version=SESSION_VERSION,
+                                           key=key,
+                                           state=state).SerializeToString()
+
+
+def decode_conversation_state(
+        data_bytes: bytes) -> Tuple[Tuple[int, ...], Optional[int]]:
+    if _is_pickle(data_bytes):
+        key, state = pickle.loads(data_bytes)
+        return tuple(key), state
+
+    conversation_state = session_proto.ConversationState.FromString(
+        data_bytes)
+    _check_version(conversation_state.version)
+    return tuple(conversation_state.key), conversation_state.state
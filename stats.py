@@ -1,11 +1,21 @@
-from typing import Dict, List
-from collections import Counter, defaultdict
+from typing import (Awaitable, Callable, ContextManager, Dict, Iterator,
+                    List, Optional, Tuple, Union)
+from collections import Counter, namedtuple
 from pytz import timezone
 
-import math
+import asyncio
+import contextlib
+import logging
 import hashlib
 import datetime
+import queue
 import redis
+import redis.asyncio
+import threading
+import time
+
+from monitoring import REDIS_LATENCY
+from runtime import resolved
 
 TIME_BUCKETS = {
     "1h": datetime.timedelta(hours=1).total_seconds(),
@@ -15,19 +25,76 @@ TIME_BUCKETS = {
 TOP_K_INTERACTIONS = 20
 TOP_K_QUERIES = 30
 HOUR_SEC = int(datetime.timedelta(hours=1).total_seconds())
+DAY_SEC = int(datetime.timedelta(days=1).total_seconds())
 
 BOT_TIMEZONE = timezone("Europe/Zurich")
 STARTTIME_TZ = datetime.datetime.now(BOT_TIMEZONE)
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 METRICS_RETENTION = datetime.timedelta(days=3)
+# Windows are moved forward when read, and on writes at least this often.
+ROLL_INTERVAL_SEC = 300
+# Interactions and queries counted per hour by MemStorage.
+MEM_BUCKET_CAPACITY = 1000
+# Keys of a single user's last seen time, written by older versions.
 REDIS_USER_NS = "user"
+# Sorted set of users scored by the time they were last seen.
+REDIS_USERS_KEY = "users:last_seen"
+# Sorted sets of counts per member, in the namespace of the metric:
+# "{ns}:h:{hour ts}" and "{ns}:d:{day ts}" per bucket, "{ns}:w:{window}" per
+# window, kept up to date on write and moved forward by subtracting buckets
+# which fell out of it. Older versions wrote hashes of hourly counts to
+# "{ns}:{hour ts}", which expire on their own.
 REDIS_NODE_NS = "node"
 REDIS_SEARCH_NS = "search"
 
+logger = logging.getLogger(__name__)
+
+
+Window = namedtuple("Window", ["name", "bucket_sec", "buckets"])
+INTERACTION = "interaction"
+SEARCH = "search"
+# The member of an interaction is the node, of a search (query, matching
+# nodes).
+MetricEvent = namedtuple("MetricEvent", ["kind", "user_id", "member", "ts"])
+
+
+def metrics_windows(retention: datetime.timedelta) -> List[Window]:
+    """Returns the windows in which top interactions and queries are counted.
+    A window is its current bucket and the buckets - 1 buckets before it."""
+    days = max(1, retention.days)
+    return [
+        Window("1h", HOUR_SEC, 1),
+        Window("24h", HOUR_SEC, 24),
+        Window(f"{days}d", DAY_SEC, days),
+    ]
+
+
+def bucket_start(ts: int, bucket_sec: int) -> int:
+    return ts - ts % bucket_sec
+
 
 class Storage:
 
+    retention: datetime.timedelta
+    windows: List[Window]
+
+    def __init__(self, retention: datetime.timedelta = METRICS_RETENTION):
+        self.retention = retention
+        self.windows = metrics_windows(retention)
+
+    def window(self, name: str) -> Window:
+        for window in self.windows:
+            if window.name == name:
+                return window
+        raise ValueError(f"Unknown metrics window {name}, "
+                         f"expected one of {[w.name for w in self.windows]}")
+
+    def batch(self) -> ContextManager:
+        """Returns a context in which writes may be sent together when it
+        exits."""
+        return contextlib.nullcontext()
+
     def store_interaction(self, user_id: str, node: str, ts: int):
         pass
 
@@ -35,63 +102,297 @@ class Storage:
                      ts: int):
         pass
 
-    def get_users_data(self) -> List[int]:
+    def store_aggregate(self, aggregate: "Aggregate"):
         pass
 
-    def get_interactions_data(self) -> Counter:
+    def count_users_since(self, timestamps: List[int]) -> List[int]:
+        """Returns the number of users seen after each of the timestamps."""
         pass
 
-    def get_search_data(self) -> Counter:
+    def top_interactions(self, window: str, k: int,
+                         now_ts: int) -> List[Tuple[str, int]]:
+        """Returns the k most visited (node, count) in the window."""
         pass
 
+    def top_searches(self, window: str, k: int,
+                     now_ts: int) -> List[Tuple[str, int]]:
+        """Returns the k most frequent ("query#matching nodes", count) in
+        the window."""
+        pass
+
+
+class Aggregate:
+    """Sums of the metric events between two stores."""
+
+    def __init__(self):
+        self.events = 0
+        self.last_ts = 0
+        self.last_seen: Dict[str, int] = {}
+        # Counts by (node, start of the hour).
+        self.interactions = Counter()
+        # Counts by ("query#matching nodes", start of the hour).
+        self.searches = Counter()
+
+    def add(self, event: MetricEvent):
+        if event.kind == INTERACTION:
+            member = event.member
+        else:
+            query, matching_nodes = event.member
+            member = f"{query.lower()}#{matching_nodes}"
+        self.count(event.kind, hash_user(event.user_id), member, event.ts)
+
+    def count(self, kind: str, user: str, member: str, ts: int):
+        """Counts an event of a hashed user."""
+        self.last_seen[user] = max(ts, self.last_seen.get(user, 0))
+        hour = bucket_start(ts, HOUR_SEC)
+        if kind == INTERACTION:
+            self.interactions[member, hour] += 1
+        else:
+            self.searches[member, hour] += 1
+        self.events += 1
+        self.last_ts = max(self.last_ts, ts)
+
+
+class MetricsAggregator:
+    """Sums up metric events in a background thread and stores the sums
+    every flush_interval seconds, or as soon as flush_events events were
+    summed up. Events pushed while max_pending are queued are dropped."""
+
+    _STOP = object()
+
+    def __init__(self,
+                 storage: Storage,
+                 flush_interval: float = 1.0,
+                 flush_events: int = 500,
+                 max_pending: int = 10000):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self._queue = queue.Queue(max_pending)
+        self._counts_lock = threading.Lock()
+        self.stored = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name="MetricsAggregator",
+                                        daemon=True)
+        self._thread.start()
+
+    def push(self, event: MetricEvent):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._counts_lock:
+                self.dropped += 1
+
+    def _run(self):
+        aggregate = Aggregate()
+        deadline = None
+        while True:
+            timeout = None if deadline is None \
+                else max(0, deadline - time.monotonic())
+            try:
+                event = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+            if event is not None and event is not self._STOP:
+                if not aggregate.events:
+                    deadline = time.monotonic() + self.flush_interval
+                aggregate.add(event)
+                if aggregate.events < self.flush_events:
+                    continue
+            if aggregate.events:
+                self._store(aggregate)
+                aggregate = Aggregate()
+                deadline = None
+            if event is self._STOP:
+                return
+
+    def _store(self, aggregate: Aggregate):
+        try:
+            self.storage.store_aggregate(aggregate)
+        except Exception as e:
+            logger.error(f"Failed to store {aggregate.events} metric events",
+                         exc_info=e)
+            with self._counts_lock:
+                self.dropped += aggregate.events
+            return
+        with self._counts_lock:
+            self.stored += aggregate.events
+
+    def stop(self):
+        """Stores the events pushed so far and stops the thread."""
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def stats(self) -> str:
+        return (f"Metric events: {self.stored} stored, "
+                f"{self._queue.qsize()} queued, {self.dropped} dropped")
+
+
+class AsyncMetricsAggregator:
+    """MetricsAggregator of the asyncio runtime, which sums up the events in a
+    task of the event loop and stores them with an asynchronous storage, or a
+    MemStorage. Created on the loop, and only used from it."""
+
+    _STOP = MetricsAggregator._STOP
+
+    def __init__(self,
+                 storage: Storage,
+                 flush_interval: float = 1.0,
+                 flush_events: int = 500,
+                 max_pending: int = 10000):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self._queue = asyncio.Queue(max_pending)
+        self.stored = 0
+        self.dropped = 0
+        self._task = asyncio.ensure_future(self._run())
+
+    def push(self, event: MetricEvent):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self):
+        aggregate = Aggregate()
+        deadline = None
+        while True:
+            timeout = None if deadline is None \
+                else max(0, deadline - time.monotonic())
+            try:
+                event = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                event = None
+            if event is not None and event is not self._STOP:
+                if not aggregate.events:
+                    deadline = time.monotonic() + self.flush_interval
+                aggregate.add(event)
+                if aggregate.events < self.flush_events:
+                    continue
+            if aggregate.events:
+                await self._store(aggregate)
+                aggregate = Aggregate()
+                deadline = None
+            if event is self._STOP:
+                return
+
+    async def _store(self, aggregate: Aggregate):
+        try:
+            await resolved(self.storage.store_aggregate(aggregate))
+        except Exception as e:
+            logger.error(f"Failed to store {aggregate.events} metric events",
+                         exc_info=e)
+            self.dropped += aggregate.events
+            return
+        self.stored += aggregate.events
+
+    async def stop(self):
+        """Stores the events pushed so far and stops the task."""
+        await self._queue.put(self._STOP)
+        await self._task
+
+    def stats(self) -> str:
+        return (f"Metric events: {self.stored} stored, "
+                f"{self._queue.qsize()} queued, {self.dropped} dropped")
+
 
 class Stats:
 
     storage: Storage
     last_reload_time_tz: datetime.datetime
     last_reloader_username: str
-
-    def __init__(self, storage: Storage):
+    info_providers: List[Callable[[], str]]
+    aggregator: Optional[Union[MetricsAggregator, "AsyncMetricsAggregator"]]
+
+    def __init__(self,
+                 storage: Storage,
+                 aggregator: Optional[Union[MetricsAggregator,
+                                            "AsyncMetricsAggregator"]] = None):
+        """With an aggregator, metrics are collected in the background."""
         self.storage = storage
+        self.aggregator = aggregator
         self.last_reload_time_tz = None
         self.last_reloader_username = None
+        self.info_providers = []
+
+    def add_info_provider(self, provider: Callable[[], str]):
+        """Adds a callable, whose output is shown in the statistics."""
+        self.info_providers.append(provider)
+
+    def batch(self) -> ContextManager:
+        return self.storage.batch()
 
     def collect_interaction(self, user_id: int, node: str):
+        if self.aggregator is not None:
+            self.aggregator.push(
+                MetricEvent(INTERACTION, user_id, node, int(time.time())))
+            return
         ts = int(datetime.datetime.now(BOT_TIMEZONE).timestamp())
         return self.storage.store_interaction(hash_user(user_id), node, ts)
 
     def collect_search(self, user_id: int, query: str, matching_nodes: int):
+        if self.aggregator is not None:
+            self.aggregator.push(
+                MetricEvent(SEARCH, user_id, (query, matching_nodes),
+                            int(time.time())))
+            return
         ts = int(datetime.datetime.now(BOT_TIMEZONE).timestamp())
         return self.storage.store_search(hash_user(user_id), query.lower(),
                                          matching_nodes, ts)
 
+    def stop(self) -> Optional[Awaitable[None]]:
+        """Stores the metrics collected in the background. Returns what to
+        await for it with an asynchronous aggregator."""
+        if self.aggregator is not None:
+            return self.aggregator.stop()
+        return None
+
     def conversation_reloaded(self, username):
         self.last_reload_time_tz = datetime.datetime.now(BOT_TIMEZONE)
         self.last_reloader_username = username
 
-    def compute(self) -> str:
+    def _window(self, window: Optional[str]) -> str:
+        # The longest window by default.
+        return window or self.storage.windows[-1].name
+
+    def top_interactions(
+            self,
+            k: int,
+            window: Optional[str] = None) -> List[Tuple[str, int]]:
+        """Returns the k most visited (node, count) in the window."""
+        now_ts = int(datetime.datetime.now(BOT_TIMEZONE).timestamp())
+        return self.storage.top_interactions(self._window(window), k, now_ts)
+
+    def top_queries(
+            self,
+            k: int,
+            window: Optional[str] = None) -> List[Tuple[str, str, int]]:
+        """Returns the k most frequent (query, matching nodes, count) in the
+        window."""
+        now_ts = int(datetime.datetime.now(BOT_TIMEZONE).timestamp())
+        return _queries(
+            self.storage.top_searches(self._window(window), k, now_ts))
+
+    async def compute(self) -> str:
+        """Returns the statistics shown to admins. Reads of an asynchronous
+        storage are awaited."""
         now_tz = datetime.datetime.now(BOT_TIMEZONE)
         uptime = now_tz - STARTTIME_TZ
         uptime = datetime.timedelta(seconds=int(uptime.total_seconds()))
 
         now_ts = int(now_tz.timestamp())
-        interacts_data = self.storage.get_interactions_data().most_common(
-            TOP_K_INTERACTIONS)
-        search_data = self.storage.get_search_data().most_common(TOP_K_QUERIES)
-
-        def search_data_mapper(t):
-            last_hash = t[0].rindex("#")
-            return (t[0][0:last_hash], t[0][last_hash + 1:], t[1])
-
-        search_data = map(search_data_mapper, search_data)
-        users_data = defaultdict(int)
-        for user_ts in self.storage.get_users_data():
-            for k, bucket_ts in TIME_BUCKETS.items():
-                if user_ts > now_ts - bucket_ts:
-                    users_data[k] += 1
+        window = self._window(None)
+        interacts_data = await resolved(
+            self.storage.top_interactions(window, TOP_K_INTERACTIONS, now_ts))
+        search_data = _queries(await resolved(
+            self.storage.top_searches(window, TOP_K_QUERIES, now_ts)))
+        user_counts = await resolved(self.storage.count_users_since(
+            [now_ts - int(bucket_ts) for bucket_ts in TIME_BUCKETS.values()]))
 
         users_stats = "\n".join(
-            [f"\t- {i}: {c}" for i, c in users_data.items()])
+            [f"\t- {i}: {c}" for i, c in zip(TIME_BUCKETS, user_counts)])
         interacts_stats = "\n".join(
             [f"\t- {n}: {c}" for n, c in interacts_data])
         search_stats = "\n".join(
@@ -108,10 +409,13 @@ class Stats:
                 f"({self.last_reloader_username})"
             )
 
+        output.extend(provider() for provider in self.info_providers)
         output.extend([
             f"Total users:\n{users_stats}",
-            f"Top {TOP_K_INTERACTIONS} interactions:\n{interacts_stats}\n",
-            f"Top {TOP_K_QUERIES} queries [count: 'query' (matchingNodes)]:\n"
+            f"Top {TOP_K_INTERACTIONS} interactions in {window}:\n"
+            f"{interacts_stats}\n",
+            f"Top {TOP_K_QUERIES} queries in {window} "
+            f"[count: 'query' (matchingNodes)]:\n"
             f"{search_stats}"
         ])
         return "\n".join(output)
@@ -121,108 +425,538 @@ class RedisStorage(Storage):
 
     rd: redis.Redis
 
-    def __init__(self, rd: redis.Redis):
+    def __init__(self,
+                 rd: redis.Redis,
+                 retention: datetime.timedelta = METRICS_RETENTION):
+        super().__init__(retention)
         self.rd = rd
+        self._batches = threading.local()
+        self._user_keys_migrated = False
+        self._rolled_at = {}
+        # Hourly buckets are compacted into daily ones when the windows are
+        # moved after their day is over. They are kept until the longest
+        # window moved past their day, so that daily buckets exist when it
+        # subtracts them, however long ago the windows were moved last.
+        self.hourly_bucket_ttl = datetime.timedelta(
+            seconds=max(w.buckets * w.bucket_sec for w in self.windows),
+            days=1)
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[None]:
+        """Sends the writes made by this thread in the block in one
+        transaction. A failure to send them is logged."""
+        if getattr(self._batches, "aggregate", None) is not None:
+            yield
+            return
+        self._batches.aggregate = Aggregate()
+        try:
+            yield
+        finally:
+            aggregate, self._batches.aggregate = self._batches.aggregate, None
+            if aggregate.events:
+                try:
+                    self._store_counts(aggregate)
+                except Exception as e:
+                    logger.error("Failed to store metrics", exc_info=e)
+
+    def _store_event(self, kind: str, user_id: str, member: str, ts: int):
+        # Writes of a batch are sent when it ends.
+        aggregate = getattr(self._batches, "aggregate", None)
+        if aggregate is not None:
+            aggregate.count(kind, user_id, member, ts)
+            return
+        aggregate = Aggregate()
+        aggregate.count(kind, user_id, member, ts)
+        self._store_counts(aggregate)
+
+    def _store_users(self, pipeline: redis.client.Pipeline,
+                     last_seen: Dict[str, int]):
+        pipeline.zadd(REDIS_USERS_KEY, last_seen)
+        pipeline.zremrangebyscore(
+            REDIS_USERS_KEY, "-inf",
+            f"({max(last_seen.values()) - int(self.retention.total_seconds())}"
+        )
+        pipeline.expire(REDIS_USERS_KEY, self.retention)
+
+    def _maybe_roll(self, ns: str, ts: int):
+        if ts - self._rolled_at.get(ns, 0) >= ROLL_INTERVAL_SEC:
+            self._roll(ns, ts)
+
+    def _count(self, pipeline: redis.client.Pipeline, ns: str, member: str,
+               ts: int, count: int, compacted_until: Optional[bytes],
+               starts: List[Optional[bytes]]):
+        """Adds count to the buckets of ts and to the windows, which were
+        last moved to starts after compacting the days before
+        compacted_until."""
+        hour_key = self._bucket_key(ns, HOUR_SEC, bucket_start(ts, HOUR_SEC))
+        pipeline.zincrby(hour_key, count, member)
+        pipeline.expire(hour_key, self.hourly_bucket_ttl)
+        day = bucket_start(ts, DAY_SEC)
+        if compacted_until is not None and day < int(compacted_until):
+            # Moving the windows subtracts the daily bucket of the day.
+            day_key = self._bucket_key(ns, DAY_SEC, day)
+            pipeline.zincrby(day_key, count, member)
+            pipeline.expireat(day_key, self._day_bucket_expiry(day))
+        for window, start in zip(self.windows, starts):
+            # Buckets a window moved past are never subtracted from it.
+            if start is None or \
+                    bucket_start(ts, window.bucket_sec) >= int(start):
+                pipeline.zincrby(self._window_key(ns, window), count, member)
+
+    def _count_writes(
+        self, aggregate: Aggregate
+    ) -> Tuple[List[str], Callable[[redis.client.Pipeline, list], None]]:
+        """Returns the keys of the state of the windows which decides where
+        the counts of the aggregate are written, and a function queueing the
+        writes in a transaction given the values of the keys."""
+        metrics = [(ns, counts)
+                   for ns, counts in ((REDIS_NODE_NS, aggregate.interactions),
+                                      (REDIS_SEARCH_NS, aggregate.searches))
+                   if counts]
+        roll_keys = [self._roll_keys(ns) for ns, _ in metrics]
+        watched = [key for keys in roll_keys for key in keys]
+
+        def queue_writes(pipeline: redis.client.Pipeline, values: list):
+            states = iter(values)
+            self._store_users(pipeline, aggregate.last_seen)
+            for (ns, counts), keys in zip(metrics, roll_keys):
+                compacted_until, *starts = [next(states) for _ in keys]
+                for (member, hour), count in counts.items():
+                    self._count(pipeline, ns, member, hour, count,
+                                compacted_until, starts)
+
+        return watched, queue_writes
+
+    def _store_counts(self, aggregate: Aggregate):
+        """Stores the aggregate in a transaction with the state of the
+        windows, so that counts a concurrent roll compacted or moved past are
+        written where moving the windows subtracts them."""
+        watched, queue_writes = self._count_writes(aggregate)
+
+        def write(pipeline: redis.client.Pipeline):
+            values = pipeline.mget(watched) if watched else []
+            pipeline.multi()
+            queue_writes(pipeline, values)
+
+        with REDIS_LATENCY.labels("stats_write").time():
+            self.rd.transaction(write, *watched)
 
     def store_interaction(self, user_id: str, node: str, ts: int):
-        pipeline = self.rd.pipeline()
-        pipeline.setex(
-            f"{REDIS_USER_NS}:{user_id}",
-            METRICS_RETENTION,
-            ts,
-        )
-        bucket = self.hbucket(ts, 1)
-        pipeline.hincrby(f"{REDIS_NODE_NS}:{bucket}", node, 1)
-        pipeline.expire(
-            f"{REDIS_NODE_NS}:{bucket}",
-            METRICS_RETENTION,
-        )
-        pipeline.execute()
+        self._maybe_roll(REDIS_NODE_NS, ts)
+        self._store_event(INTERACTION, user_id, node, ts)
 
     def store_search(self, user_id: str, query: str, matching_nodes: int,
                      ts: int):
+        self._maybe_roll(REDIS_SEARCH_NS, ts)
+        self._store_event(SEARCH, user_id, f"{query}#{matching_nodes}", ts)
+
+    def store_aggregate(self, aggregate: Aggregate):
+        # Counts of a day which ended during the aggregate are written
+        # before it is compacted.
+        self._store_counts(aggregate)
+        for ns in (REDIS_NODE_NS, REDIS_SEARCH_NS):
+            self._maybe_roll(ns, aggregate.last_ts)
+
+    def _migrate_user_keys(self):
+        """Moves the last seen times of the one key per user, which older
+        versions wrote, into the sorted set."""
+        if self._user_keys_migrated:
+            return
+        self._user_keys_migrated = True
+        keys = list(self.rd.scan_iter(f"{REDIS_USER_NS}:*", count=1000))
+        if not keys:
+            return
         pipeline = self.rd.pipeline()
-        pipeline.setex(
-            f"{REDIS_USER_NS}:{user_id}",
-            METRICS_RETENTION,
-            ts,
-        )
-        bucket = self.hbucket(ts, 1)
-        pipeline.hincrby(f"{REDIS_SEARCH_NS}:{bucket}",
-                         f"{query}#{matching_nodes}", 1)
-        pipeline.expire(
-            f"{REDIS_SEARCH_NS}:{bucket}",
-            METRICS_RETENTION,
-        )
+        migrated = self._queue_user_migration(pipeline, keys,
+                                              self.rd.mget(keys))
         pipeline.execute()
+        logger.info(f"Migrated last seen times of {migrated} users")
+
+    def _queue_user_migration(self, pipeline: redis.client.Pipeline,
+                              keys: List[bytes], values: List[bytes]) -> int:
+        """Queues the migration of the keys with the values and returns the
+        number of users migrated."""
+        last_seen = {
+            key.decode("utf-8")[len(REDIS_USER_NS) + 1:]: int(ts)
+            for key, ts in zip(keys, values) if ts is not None
+        }
+        if last_seen:
+            # Users already in the set were seen after the upgrade.
+            pipeline.zadd(REDIS_USERS_KEY, last_seen, nx=True)
+            pipeline.expire(REDIS_USERS_KEY, self.retention)
+        pipeline.delete(*keys)
+        return len(last_seen)
+
+    def count_users_since(self, timestamps: List[int]) -> List[int]:
+        self._migrate_user_keys()
+        pipeline = self.rd.pipeline(transaction=False)
+        for ts in timestamps:
+            pipeline.zcount(REDIS_USERS_KEY, f"({ts}", "+inf")
+        with REDIS_LATENCY.labels("stats_users").time():
+            return pipeline.execute()
+
+    def top_interactions(self, window: str, k: int,
+                         now_ts: int) -> List[Tuple[str, int]]:
+        return self._top(REDIS_NODE_NS, self.window(window), k, now_ts)
+
+    def top_searches(self, window: str, k: int,
+                     now_ts: int) -> List[Tuple[str, int]]:
+        return self._top(REDIS_SEARCH_NS, self.window(window), k, now_ts)
+
+    def _top(self, ns: str, window: Window, k: int,
+             now_ts: int) -> List[Tuple[str, int]]:
+        self._roll(ns, now_ts)
+        with REDIS_LATENCY.labels("stats_top").time():
+            top = self.rd.zrevrange(self._window_key(ns, window),
+                                    0,
+                                    k - 1,
+                                    withscores=True)
+        return _top_counts(top)
+
+    @staticmethod
+    def _bucket_key(ns: str, bucket_sec: int, bucket_ts: int) -> str:
+        return f"{ns}:{'h' if bucket_sec == HOUR_SEC else 'd'}:{bucket_ts}"
+
+    @staticmethod
+    def _window_key(ns: str, window: Window) -> str:
+        return f"{ns}:w:{window.name}"
+
+    def _window_bucket_keys(self, ns: str, window: Window, first: int,
+                            now_ts: int) -> List[str]:
+        """Returns keys of the buckets a window starting at first has now.
+        The current day is only in hourly buckets."""
+        today = bucket_start(now_ts, DAY_SEC)
+        keys = [
+            self._bucket_key(ns, window.bucket_sec, bucket_ts)
+            for bucket_ts in range(first, min(today, now_ts + 1),
+                                   window.bucket_sec)
+        ]
+        if window.bucket_sec == DAY_SEC:
+            keys.extend(
+                self._bucket_key(ns, HOUR_SEC, hour)
+                for hour in range(today, now_ts + 1, HOUR_SEC))
+        else:
+            keys.extend(
+                self._bucket_key(ns, HOUR_SEC, hour)
+                for hour in range(max(first, today), now_ts + 1, HOUR_SEC))
+        return keys
+
+    def _roll_keys(self, ns: str) -> List[str]:
+        """Returns the keys of the day compacted last and of the start of
+        each window."""
+        return [f"{ns}:compacted_until"] + [
+            f"{self._window_key(ns, window)}:start" for window in self.windows
+        ]
 
-    def get_users_data(self) -> List[int]:
-        users_data = []
-        for user in self.rd.scan_iter(f"{REDIS_USER_NS}:*"):
-            users_data.append(int(self.rd.get(user)))
-
-        return users_data
-
-    def get_interactions_data(self) -> Counter:
-        interacts_data = Counter()
-        for bucket in self.hourly_buckets(METRICS_RETENTION.total_seconds()):
-            node_stats = self.rd.hgetall(f"{REDIS_NODE_NS}:{bucket}").items()
-            for node, node_interacts in node_stats:
-                interacts_data[node.decode("utf-8")] += int(node_interacts)
-
-        return interacts_data
-
-    def get_search_data(self) -> Counter:
-        search_data = Counter()
-        for bucket in self.hourly_buckets(METRICS_RETENTION.total_seconds()):
-            search_stats = self.rd.hgetall(
-                f"{REDIS_SEARCH_NS}:{bucket}").items()
-            for query_and_found_nodes, query_occurrences in search_stats:
-                search_data[query_and_found_nodes.decode("utf-8")] += int(
-                    query_occurrences)
-
-        return search_data
-
-    def hourly_buckets(self, stats_period: int) -> List[int]:
-        now_ts = int(datetime.datetime.now(BOT_TIMEZONE).timestamp())
-        num_buckets = math.ceil(stats_period / HOUR_SEC)
-        buckets = []
-        for i in range(1, num_buckets + 1):
-            buckets.append(self.hbucket(now_ts, i))
-
-        return buckets
-
-    def hbucket(self, now_ts: int, bucket: int) -> int:
-        return now_ts - (now_ts % HOUR_SEC) - HOUR_SEC * (bucket - 1)
+    def _day_bucket_expiry(self, day: int) -> int:
+        return day + DAY_SEC + int(self.retention.total_seconds())
+
+    def _roll(self, ns: str, now_ts: int):
+        """Compacts the hourly buckets of past days into daily ones and moves
+        the windows of the metric forward to now."""
+        self._rolled_at[ns] = now_ts
+        roll_keys = self._roll_keys(ns)
+
+        def roll(pipeline: redis.client.Pipeline):
+            values = pipeline.mget(roll_keys)
+            pipeline.multi()
+            self._queue_roll(pipeline, ns, now_ts, values)
+
+        # Replicas roll the windows concurrently, the first one wins. Writes
+        # of counts started before are retried.
+        with REDIS_LATENCY.labels("stats_roll").time():
+            self.rd.transaction(roll, *roll_keys)
+
+    def _queue_roll(self, pipeline: redis.client.Pipeline, ns: str,
+                    now_ts: int, values: List[Optional[bytes]]):
+        """Queues the roll to now of the windows, whose roll keys have the
+        values."""
+        compacted_key, *start_keys = self._roll_keys(ns)
+        compacted_until, *starts = values
+        self._compact(pipeline, ns, compacted_until, now_ts)
+        pipeline.set(
+            compacted_key,
+            max(bucket_start(now_ts, DAY_SEC), int(compacted_until or 0)))
+        for window, start_key, start in zip(self.windows, start_keys,
+                                            starts):
+            first = self._move_window(pipeline, ns, window, start, now_ts)
+            pipeline.set(start_key, first)
+
+    def _compact(self, pipeline: redis.client.Pipeline, ns: str,
+                 compacted_until: Optional[bytes], now_ts: int):
+        today = bucket_start(now_ts, DAY_SEC)
+        # Hourly buckets of older days are gone.
+        oldest = today - DAY_SEC * self.hourly_bucket_ttl.days
+        first_day = today - DAY_SEC if compacted_until is None \
+            else max(int(compacted_until), oldest)
+        for day in range(first_day, today, DAY_SEC):
+            day_key = self._bucket_key(ns, DAY_SEC, day)
+            pipeline.zunionstore(day_key, [
+                self._bucket_key(ns, HOUR_SEC, hour)
+                for hour in range(day, day + DAY_SEC, HOUR_SEC)
+            ])
+            pipeline.expireat(day_key, self._day_bucket_expiry(day))
+
+    def _move_window(self, pipeline: redis.client.Pipeline, ns: str,
+                     window: Window, start: Optional[bytes],
+                     now_ts: int) -> int:
+        """Subtracts the buckets which fell out of the window since it
+        started at start and returns the start of the window now. A window
+        is never moved back, by a roll to an earlier time."""
+        window_key = self._window_key(ns, window)
+        first = bucket_start(now_ts, window.bucket_sec) - \
+            (window.buckets - 1) * window.bucket_sec
+        if start is None or \
+                first - int(start) >= window.buckets * window.bucket_sec:
+            # New, or every bucket of the window fell out of it.
+            pipeline.zunionstore(
+                window_key,
+                self._window_bucket_keys(ns, window, first, now_ts))
+            return first
+        if int(start) >= first:
+            return int(start)
+        for bucket_ts in range(int(start), first, window.bucket_sec):
+            pipeline.zunionstore(
+                window_key, {
+                    window_key: 1,
+                    self._bucket_key(ns, window.bucket_sec, bucket_ts): -1
+                })
+        pipeline.zremrangebyscore(window_key, "-inf", 0)
+        return first
+
+
+class AsyncRedisStorage(RedisStorage):
+    """RedisStorage of the asyncio runtime, on a redis.asyncio client. Keeps
+    the metrics in the same keys, written in the same transactions; its
+    methods are coroutines. Writes are sent one aggregate at a time, by an
+    AsyncMetricsAggregator."""
+
+    rd: redis.asyncio.Redis
+
+    def batch(self) -> ContextManager:
+        return contextlib.nullcontext()
+
+    async def store_interaction(self, user_id: str, node: str, ts: int):
+        aggregate = Aggregate()
+        aggregate.count(INTERACTION, user_id, node, ts)
+        await self.store_aggregate(aggregate)
+
+    async def store_search(self, user_id: str, query: str,
+                           matching_nodes: int, ts: int):
+        aggregate = Aggregate()
+        aggregate.count(SEARCH, user_id, f"{query}#{matching_nodes}", ts)
+        await self.store_aggregate(aggregate)
+
+    async def store_aggregate(self, aggregate: Aggregate):
+        await self._store_counts(aggregate)
+        for ns in (REDIS_NODE_NS, REDIS_SEARCH_NS):
+            await self._maybe_roll(ns, aggregate.last_ts)
+
+    async def _store_counts(self, aggregate: Aggregate):
+        watched, queue_writes = self._count_writes(aggregate)
+
+        async def write(pipeline: redis.asyncio.client.Pipeline):
+            values = await pipeline.mget(watched) if watched else []
+            pipeline.multi()
+            queue_writes(pipeline, values)
+
+        with REDIS_LATENCY.labels("stats_write").time():
+            await self.rd.transaction(write, *watched)
+
+    async def _maybe_roll(self, ns: str, ts: int):
+        if ts - self._rolled_at.get(ns, 0) >= ROLL_INTERVAL_SEC:
+            await self._roll(ns, ts)
+
+    async def _roll(self, ns: str, now_ts: int):
+        self._rolled_at[ns] = now_ts
+        roll_keys = self._roll_keys(ns)
+
+        async def roll(pipeline: redis.asyncio.client.Pipeline):
+            values = await pipeline.mget(roll_keys)
+            pipeline.multi()
+            self._queue_roll(pipeline, ns, now_ts, values)
+
+        with REDIS_LATENCY.labels("stats_roll").time():
+            await self.rd.transaction(roll, *roll_keys)
+
+    async def _migrate_user_keys(self):
+        if self._user_keys_migrated:
+            return
+        self._user_keys_migrated = True
+        pattern = f"{REDIS_USER_NS}:*"
+        keys = [key async for key in self.rd.scan_iter(pattern, count=1000)]
+        if not keys:
+            return
+        pipeline = self.rd.pipeline()
+        migrated = self._queue_user_migration(pipeline, keys, await
+                                              self.rd.mget(keys))
+        await pipeline.execute()
+        logger.info(f"Migrated last seen times of {migrated} users")
+
+    async def count_users_since(self, timestamps: List[int]) -> List[int]:
+        await self._migrate_user_keys()
+        pipeline = self.rd.pipeline(transaction=False)
+        for ts in timestamps:
+            pipeline.zcount(REDIS_USERS_KEY, f"({ts}", "+inf")
+        with REDIS_LATENCY.labels("stats_users").time():
+            return await pipeline.execute()
+
+    async def top_interactions(self, window: str, k: int,
+                               now_ts: int) -> List[Tuple[str, int]]:
+        return await self._top(REDIS_NODE_NS, self.window(window), k, now_ts)
+
+    async def top_searches(self, window: str, k: int,
+                           now_ts: int) -> List[Tuple[str, int]]:
+        return await self._top(REDIS_SEARCH_NS, self.window(window), k,
+                               now_ts)
+
+    async def _top(self, ns: str, window: Window, k: int,
+                   now_ts: int) -> List[Tuple[str, int]]:
+        await self._roll(ns, now_ts)
+        with REDIS_LATENCY.labels("stats_top").time():
+            top = await self.rd.zrevrange(self._window_key(ns, window),
+                                          0,
+                                          k - 1,
+                                          withscores=True)
+        return _top_counts(top)
+
+
+class SpaceSaving:
+    """Counts of the most frequent members in at most capacity counters
+    (Metwally et al., "Efficient Computation of Frequent and Top-k Elements
+    in Data Streams"). When all counters are taken, a new member takes over
+    the counter of the least frequent one, and its count is overestimated by
+    at most that counter. Counts are exact while fewer members were added."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+
+    def add(self, member: str, count: int = 1):
+        if member not in self.counts and len(self.counts) >= self.capacity:
+            evicted = min(self.counts, key=self.counts.get)
+            count += self.counts.pop(evicted)
+        self.counts[member] = self.counts.get(member, 0) + count
+
+
+_HourBucket = namedtuple("_HourBucket", ["hour", "interactions", "searches"])
 
 
 class MemStorage(Storage):
+    """Keeps the metrics of the longest window in a ring of hourly buckets,
+    with at most capacity interactions and queries counted per bucket. Gives
+    the same top counts as RedisStorage as long as the capacity is not
+    reached."""
 
     timestamp_by_user: Dict[str, int]
-    interactions: Counter()
 
-    def __init__(self):
+    def __init__(self,
+                 retention: datetime.timedelta = METRICS_RETENTION,
+                 capacity: int = MEM_BUCKET_CAPACITY):
+        super().__init__(retention)
+        self.capacity = capacity
         self.timestamp_by_user = {}
-        self.interactions = Counter()
-        self.searches = Counter()
+        self._buckets: List[Optional[_HourBucket]] = [None] * max(
+            w.buckets * w.bucket_sec // HOUR_SEC for w in self.windows)
+        # Updates of different chats are handled concurrently.
+        self._lock = threading.Lock()
+
+    def _bucket(self, ts: int) -> Optional[_HourBucket]:
+        """Returns the bucket of the hour, or None when it was evicted."""
+        hour = bucket_start(ts, HOUR_SEC)
+        i = hour // HOUR_SEC % len(self._buckets)
+        bucket = self._buckets[i]
+        if bucket is not None and bucket.hour > hour:
+            return None
+        if bucket is None or bucket.hour < hour:
+            bucket = self._buckets[i] = _HourBucket(
+                hour, SpaceSaving(self.capacity), SpaceSaving(self.capacity))
+            self._evict_users(ts)
+        return bucket
+
+    def _evict_users(self, ts: int):
+        oldest = ts - int(self.retention.total_seconds())
+        self.timestamp_by_user = {
+            user_id: user_ts
+            for user_id, user_ts in self.timestamp_by_user.items()
+            if user_ts >= oldest
+        }
+
+    def _store(self, user_id: str, ts: int, interaction: Optional[str],
+               search: Optional[str]):
+        with self._lock:
+            self.timestamp_by_user[user_id] = max(
+                ts, self.timestamp_by_user.get(user_id, 0))
+            bucket = self._bucket(ts)
+            if bucket is None:
+                return
+            if interaction is not None:
+                bucket.interactions.add(interaction)
+            if search is not None:
+                bucket.searches.add(search)
 
     def store_interaction(self, user_id: str, node: str, ts: int):
-        self.timestamp_by_user[user_id] = ts
-        self.interactions[node] += 1
+        self._store(user_id, ts, node, None)
 
     def store_search(self, user_id: str, query: str, matching_nodes: int,
                      ts: int):
-        self.timestamp_by_user[user_id] = ts
-        self.searches[f"{query}#{matching_nodes}"] += 1
-
-    def get_users_data(self) -> List[int]:
-        return self.timestamp_by_user.values()
-
-    def get_interactions_data(self) -> Counter:
-        return self.interactions
-
-    def get_search_data(self) -> Counter:
-        return self.searches
+        self._store(user_id, ts, None, f"{query}#{matching_nodes}")
+
+    def store_aggregate(self, aggregate: Aggregate):
+        with self._lock:
+            for user_id, ts in aggregate.last_seen.items():
+                self.timestamp_by_user[user_id] = max(
+                    ts, self.timestamp_by_user.get(user_id, 0))
+            for counts, field in ((aggregate.interactions, "interactions"),
+                                  (aggregate.searches, "searches")):
+                for (member, hour), count in counts.items():
+                    bucket = self._bucket(hour)
+                    if bucket is not None:
+                        getattr(bucket, field).add(member, count)
+
+    def count_users_since(self, timestamps: List[int]) -> List[int]:
+        with self._lock:
+            return [
+                sum(1 for user_ts in self.timestamp_by_user.values()
+                    if user_ts > ts) for ts in timestamps
+            ]
+
+    def _top(self, field: str, window: Window, k: int,
+             now_ts: int) -> List[Tuple[str, int]]:
+        first = bucket_start(now_ts, window.bucket_sec) - \
+            (window.buckets - 1) * window.bucket_sec
+        counts = Counter()
+        with self._lock:
+            for bucket in self._buckets:
+                if bucket is not None and first <= bucket.hour <= now_ts:
+                    counts.update(getattr(bucket, field).counts)
+        # Ordered like ZREVRANGE orders members with equal counts.
+        return sorted(counts.items(),
+                      key=lambda item: (item[1], item[0]),
+                      reverse=True)[:k]
+
+    def top_interactions(self, window: str, k: int,
+                         now_ts: int) -> List[Tuple[str, int]]:
+        return self._top("interactions", self.window(window), k, now_ts)
+
+    def top_searches(self, window: str, k: int,
+                     now_ts: int) -> List[Tuple[str, int]]:
+        return self._top("searches", self.window(window), k, now_ts)
+
+
+def _queries(
+        top_searches: List[Tuple[str, int]]) -> List[Tuple[str, str, int]]:
+    """Returns (query, matching nodes, count) of top searches."""
+
+    def search_data_mapper(t):
+        last_hash = t[0].rindex("#")
+        return (t[0][0:last_hash], t[0][last_hash + 1:], t[1])
+
+    return list(map(search_data_mapper, top_searches))
+
+
+def _top_counts(top: List[Tuple[bytes, float]]) -> List[Tuple[str, int]]:
+    return [(member.decode("utf-8"), int(count)) for member, count in top]
 
 
 def hash_user(user_id: int) -> str:
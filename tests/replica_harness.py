@@ -0,0 +1,114 @@
+"""Runs several bot replicas against one fake Redis server.
+
+A replica has everything a bot process has of its own: a dispatcher, a
+session persistence with its own Redis connection and a conversation
+handler. Replicas run in the test process, as fakeredis can not be shared
+between processes. The loaded conversation and the stats are globals of
+bot.py, so they are shared, like they would be equal in real processes.
+"""
+
+from queue import Queue
+import datetime
+import itertools
+import os
+
+import fakeredis
+import telegram
+
+os.environ.setdefault("TELEGRAM_BOT_API_KEY", "123:TOKEN")
+
+import bot  # noqa: E402
+from bot_redis_persistence import RedisPersistence  # noqa: E402
+from replicas import ChatLocks, ReplicaDispatcher  # noqa: E402
+
+_update_ids = itertools.count(1)
+
+
+def load_bot():
+    if bot.conversation_snapshot is None:
+        with open("conversation_tree.textproto", "r") as f:
+            bot.reset_bot_data(f.read())
+    bot.init_stats()
+
+
+class RecordingBot(telegram.Bot):
+    """Bot which records requests instead of making them."""
+
+    def __init__(self):
+        super().__init__("123:TOKEN")
+        self.requests = []
+        self._message_ids = itertools.count(1)
+
+    def _sent_message(self, chat_id):
+        return {
+            "message_id": next(self._message_ids),
+            "date": 0,
+            "chat": {
+                "id": chat_id,
+                "type": telegram.Chat.PRIVATE
+            },
+            "photo": [{
+                "file_id": "photo",
+                "file_unique_id": "photo",
+                "width": 1,
+                "height": 1
+            }],
+        }
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        self.requests.append((endpoint, data))
+        if endpoint == "sendMediaGroup":
+            return [self._sent_message(data["chat_id"]) for _ in data["media"]]
+        if endpoint.startswith("send"):
+            return self._sent_message(data["chat_id"])
+        return True
+
+    def sent_texts(self, chat_id):
+        return [
+            data["text"] for endpoint, data in self.requests
+            if endpoint == "sendMessage" and data["chat_id"] == chat_id
+        ]
+
+
+class Replica:
+
+    def __init__(self, server: fakeredis.FakeServer, concurrent_updates=4):
+        self.redis = fakeredis.FakeRedis(server=server)
+        self.persistence = RedisPersistence(self.redis, None, versioned=True)
+        self.bot = RecordingBot()
+        self.dispatcher = ReplicaDispatcher(
+            self.bot,
+            Queue(),
+            persistence=self.persistence,
+            context_types=telegram.ext.ContextTypes(context=bot.BotContext),
+            concurrent_updates=concurrent_updates,
+            chat_locks=ChatLocks(self.redis, poll_interval=0.001))
+        self.dispatcher.add_handler(bot.conversation_handler(True))
+
+    def send_text(self, user_id: int, text: str):
+        """Handles a message of a user and waits until it was handled."""
+        self.dispatcher.process_update(self.text_update(user_id, text))
+        self.dispatcher.chat_executor.wait()
+
+    def text_update(self, user_id: int, text: str) -> telegram.Update:
+        update_id = next(_update_ids)
+        return telegram.Update(
+            update_id,
+            message=telegram.Message(update_id,
+                                     datetime.datetime.now(),
+                                     telegram.Chat(user_id,
+                                                   telegram.Chat.PRIVATE),
+                                     from_user=telegram.User(
+                                         user_id, "User", False),
+                                     text=text,
+                                     bot=self.bot))
+
+    def stop(self):
+        self.dispatcher.stop()
+
+
+def stored_user_data(server: fakeredis.FakeServer, user_id: int) -> dict:
+    persistence = RedisPersistence(fakeredis.FakeRedis(server=server), None)
+    user_data = {}
+    persistence.refresh_user_data(user_id, user_data)
+    return user_data
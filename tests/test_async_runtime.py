@@ -0,0 +1,299 @@
+import asyncio
+import contextlib
+import datetime
+import itertools
+import json
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+import telegram
+import telegram.error
+from telegram.ext import CallbackQueryHandler, Filters, MessageHandler
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+import tornado.web
+
+from async_runtime import AsyncBotApi, AsyncContext, AsyncDispatcher
+from bot_redis_persistence import AsyncRedisPersistence
+from rate_limiter import OutboundLimiter
+from replica_harness import Replica, bot, load_bot, stored_user_data
+from runtime import BotApi
+import bot_messages
+
+USER = 42
+OTHER_USER = 43
+_message_ids = itertools.count(1)
+
+
+def text_update(user_id, text):
+    update_id = next(_message_ids)
+    return telegram.Update(
+        update_id,
+        message=telegram.Message(update_id,
+                                 datetime.datetime.now(),
+                                 telegram.Chat(user_id,
+                                               telegram.Chat.PRIVATE),
+                                 from_user=telegram.User(
+                                     user_id, "User", False),
+                                 text=text))
+
+
+def sent_message(chat_id):
+    return {
+        "message_id": next(_message_ids),
+        "date": 0,
+        "chat": {
+            "id": int(chat_id),
+            "type": telegram.Chat.PRIVATE
+        },
+        "photo": [{
+            "file_id": "photo",
+            "file_unique_id": "photo",
+            "width": 1,
+            "height": 1
+        }],
+    }
+
+
+class FakeTelegram(tornado.web.RequestHandler):
+    """Records Bot API requests, and answers them with the responses given,
+    then like Telegram does."""
+
+    def initialize(self, requests, responses):
+        self.requests = requests
+        self.responses = responses
+
+    def post(self, method):
+        if self.request.headers["Content-Type"] == "application/json":
+            data = json.loads(self.request.body)
+        else:
+            data = {
+                key: values[0].decode()
+                for key, values in self.request.body_arguments.items()
+            }
+            data.update({
+                key: files[0].body
+                for key, files in self.request.files.items()
+            })
+        self.requests.append((method, data))
+        if self.responses:
+            status, response = self.responses.pop(0)
+        elif method == "sendMediaGroup":
+            media = json.loads(data["media"]) \
+                if isinstance(data["media"], str) else data["media"]
+            status, response = 200, {
+                "ok": True,
+                "result": [sent_message(data["chat_id"]) for _ in media]
+            }
+        elif method.startswith(("send", "forward")):
+            status, response = 200, {
+                "ok": True,
+                "result": sent_message(data["chat_id"])
+            }
+        else:
+            status, response = 200, {"ok": True, "result": True}
+        self.set_status(status)
+        self.write(response)
+
+
+@contextlib.asynccontextmanager
+async def fake_telegram(responses=()):
+    """Yields an AsyncBotApi making its requests to a fake Telegram, and the
+    requests it made."""
+    requests = []
+    sock, port = bind_unused_port()
+    server = HTTPServer(
+        tornado.web.Application([
+            (r"/bot[^/]+/(\w+)", FakeTelegram,
+             dict(requests=requests, responses=list(responses))),
+        ]))
+    server.add_sockets([sock])
+    api = AsyncBotApi("123:TOKEN",
+                      OutboundLimiter(private_chat_rate=1000,
+                                      private_chat_burst=1000),
+                      None,
+                      base_url=f"http://127.0.0.1:{port}/bot")
+    try:
+        yield api, requests
+    finally:
+        await api.close()
+        server.stop()
+
+
+def sent_texts(requests, chat_id):
+    return [
+        data["text"] for method, data in requests
+        if method == "sendMessage" and int(data["chat_id"]) == chat_id
+    ]
+
+
+class TestAsyncBotApi:
+
+    def test_requests_are_encoded_like_python_telegram_bot(self):
+
+        async def run():
+            async with fake_telegram() as (api, requests):
+                message = await api.send_message(
+                    USER,
+                    "Привет",
+                    reply_markup=telegram.ReplyKeyboardMarkup([["a"]]))
+                await api.send_photo(USER, b"jpeg a")
+                await api.send_media_group(USER, [
+                    telegram.InputMediaPhoto(b"jpeg a"),
+                    telegram.InputMediaPhoto("file id"),
+                ])
+            return message, requests
+
+        message, requests = asyncio.run(run())
+
+        assert message.chat_id == USER
+        (_, text), (_, photo), (_, media_group) = requests
+        assert text["text"] == "Привет"
+        assert text["reply_markup"]["keyboard"] == [[{"text": "a"}]]
+        assert "parse_mode" not in text
+        assert photo == {"chat_id": str(USER), "photo": b"jpeg a"}
+        uploaded, by_file_id = json.loads(media_group["media"])
+        assert media_group[uploaded["media"][len("attach://"):]] == b"jpeg a"
+        assert by_file_id["media"] == "file id"
+
+    def test_flood_control_is_retried(self):
+        flood = {
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests",
+            "parameters": {
+                "retry_after": 0.01
+            }
+        }
+
+        async def run():
+            async with fake_telegram([(429, flood)]) as (api, requests):
+                await api.send_message(USER, "a")
+                assert api.limiter.flood_waits == 1
+                assert api.outbound_stats().startswith(
+                    "Outbound requests: 2")
+            return requests
+
+        assert sent_texts(asyncio.run(run()), USER) == ["a", "a"]
+
+    def test_errors_are_raised_like_python_telegram_bot(self):
+        error = {"ok": False, "description": "Bad Request: chat not found"}
+
+        async def run():
+            async with fake_telegram([(400, error)]) as (api, _):
+                await api.send_message(USER, "a")
+
+        with pytest.raises(telegram.error.BadRequest, match="Chat not found"):
+            asyncio.run(run())
+
+    def test_background_sends_are_made_in_order(self):
+
+        async def send(api, text):
+            await asyncio.sleep(0.01 if text == "a" else 0)
+            await api.send_message(USER, text)
+
+        async def run():
+            async with fake_telegram() as (api, requests):
+                for text in "abc":
+                    api.send_in_background(send, api, text)
+            return requests
+
+        assert sent_texts(asyncio.run(run()), USER) == ["a", "b", "c"]
+
+
+class TestAsyncDispatcher:
+
+    def test_chats_are_handled_concurrently_each_in_order(self):
+        handled = []
+
+        async def run():
+            released = asyncio.Event()
+
+            async def handle(update, context):
+                if update.message.text == "slow":
+                    await released.wait()
+                handled.append((update.effective_chat.id, update.message.text))
+
+            dispatcher = AsyncDispatcher(BotApi(), AsyncContext)
+            dispatcher.add_handler(MessageHandler(Filters.all, handle))
+            for user_id, text in [(USER, "slow"), (USER, "next"),
+                                  (OTHER_USER, "other")]:
+                dispatcher.process_update(text_update(user_id, text))
+            while not handled:
+                await asyncio.sleep(0.001)
+            assert dispatcher.pending == 2
+            released.set()
+            await dispatcher.wait()
+
+        asyncio.run(run())
+        assert handled == [(OTHER_USER, "other"), (USER, "slow"),
+                           (USER, "next")]
+
+    def test_errors_are_handled_by_the_error_handlers(self):
+        errors = []
+
+        async def fail(update, context):
+            context.user_data["seen"] = True
+            raise ValueError("failed")
+
+        async def on_error(update, context):
+            errors.append((context.error, dict(context.user_data)))
+
+        async def run():
+            dispatcher = AsyncDispatcher(BotApi(), AsyncContext)
+            dispatcher.add_handler(MessageHandler(Filters.all, fail))
+            dispatcher.add_error_handler(on_error)
+            dispatcher.process_update(text_update(USER, "a"))
+            await dispatcher.wait()
+
+        asyncio.run(run())
+        [(error, user_data)] = errors
+        assert str(error) == "failed"
+        assert user_data == {"seen": True}
+
+
+class TestRuntimes:
+
+    TEXTS = [
+        "/start",
+        "страховка",
+        "абракадабра",
+        bot_messages.BACK,
+        bot_messages.START_OVER,
+    ]
+
+    def test_the_conversation_is_the_same_on_both_runtimes(self):
+        load_bot()
+        threaded_server = fakeredis.FakeServer()
+        replica = Replica(threaded_server)
+        try:
+            for text in self.TEXTS:
+                replica.send_text(USER, text)
+        finally:
+            replica.stop()
+
+        async_server = fakeredis.FakeServer()
+
+        async def run():
+            persistence = AsyncRedisPersistence(
+                fakeredis.aioredis.FakeRedis(server=async_server), None)
+            async with fake_telegram() as (api, requests):
+                dispatcher = AsyncDispatcher(api, bot.AsyncBotContext,
+                                             persistence)
+                dispatcher.add_handler(
+                    bot.conversation_handler(
+                        True, as_callback=lambda handler: handler))
+                dispatcher.add_handler(CallbackQueryHandler(bot.on_button))
+                dispatcher.add_error_handler(bot.handle_error)
+                for text in self.TEXTS:
+                    dispatcher.process_update(text_update(USER, text))
+                await dispatcher.wait()
+            await persistence.close()
+            return requests
+
+        requests = asyncio.run(run())
+
+        assert sent_texts(requests, USER) == replica.bot.sent_texts(USER)
+        assert stored_user_data(async_server, USER) == \
+            stored_user_data(threaded_server, USER)
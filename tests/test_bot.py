@@ -0,0 +1,226 @@
+import datetime
+import itertools
+import os
+import queue
+import threading
+import types
+import urllib.error
+
+import pytest
+import telegram
+
+os.environ.setdefault("TELEGRAM_BOT_API_KEY", "123:TOKEN")
+
+import bot  # noqa: E402
+import bot_messages  # noqa: E402
+import config  # noqa: E402
+import conversation_loader  # noqa: E402
+import runtime  # noqa: E402
+
+USER = 42
+
+
+class RecordingBot(telegram.Bot):
+    """Bot which records sent texts instead of sending them."""
+
+    def __init__(self):
+        super().__init__("123:TOKEN")
+        self.texts = []
+        self._message_ids = itertools.count(1)
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        if "text" in data:
+            self.texts.append(data["text"])
+        return {
+            "message_id": next(self._message_ids),
+            "date": 0,
+            "chat": {
+                "id": data["chat_id"],
+                "type": telegram.Chat.PRIVATE
+            },
+        }
+
+
+@pytest.fixture
+def user():
+    """Returns a function which makes an update of a user's text message, and
+    the context of the user."""
+    if bot.conversation_snapshot is None:
+        with open("conversation_tree.textproto", "r") as f:
+            bot.reset_bot_data(f.read())
+    bot.init_stats()
+    recording_bot = RecordingBot()
+    context = types.SimpleNamespace(bot=recording_bot,
+                                    api=runtime.ThreadedBotApi(
+                                        recording_bot, None),
+                                    user_data={},
+                                    conversation=bot.conversation_snapshot)
+
+    def text_update(text):
+        return telegram.Update(
+            1,
+            message=telegram.Message(1,
+                                     datetime.datetime.now(),
+                                     telegram.Chat(USER,
+                                                   telegram.Chat.PRIVATE),
+                                     from_user=telegram.User(
+                                         USER, "User", False),
+                                     text=text,
+                                     bot=recording_bot))
+
+    return text_update, context
+
+
+def changed_conversation():
+    """Returns the conversation with a node added, which only a search for
+    its answer finds."""
+    with open("conversation_tree.textproto", "r") as f:
+        return f.read() + ('node { name: "Уникальный узел" '
+                           'answer { text: "абракадабра" } }')
+
+
+@pytest.fixture
+def reloadable(user, monkeypatch):
+    """Returns a function which makes a context of the user like the
+    dispatcher does for an update, and restores the conversation after the
+    test."""
+    text_update, context = user
+    monkeypatch.setattr(bot, "conversation_snapshot",
+                        bot.conversation_snapshot)
+    monkeypatch.setattr(config, "CACHE_DIR", None)
+    dispatcher = telegram.ext.Dispatcher(
+        context.bot,
+        queue.Queue(),
+        context_types=telegram.ext.ContextTypes(context=bot.BotContext))
+
+    def new_context():
+        return bot.BotContext.from_update(text_update("/start"), dispatcher)
+
+    return text_update, new_context
+
+
+class TestHandlers:
+
+    def test_free_text_is_searched(self, user):
+        text_update, context = user
+        runtime.run_sync(bot.start(text_update("/start"), context))
+        context.bot.texts.clear()
+
+        assert runtime.run_sync(bot.choice(text_update("страховка"),
+                                           context)) == bot.CHOOSING
+        assert context.bot.texts[0] == bot_messages.SEARCH_RESULT_HEADER or \
+            context.bot.texts[0].startswith(
+                bot_messages.SINGLE_SEARCH_RESULT_HEADER_TEMPLATE.split(
+                    "{")[0])
+
+    @pytest.mark.parametrize("source, note", [
+        (conversation_loader.FROM_CACHE, "сохранённая копия"),
+        (conversation_loader.FROM_FALLBACK, "встроенная в бота"),
+    ])
+    def test_admin_is_told_which_copy_a_failed_reload_used(
+            self, user, monkeypatch, source, note):
+        text_update, context = user
+        with open("conversation_tree.textproto", "r") as f:
+            textproto = f.read()
+        fetched = conversation_loader.FetchResult(
+            textproto, bot.conversation_snapshot.content_hash, source,
+            urllib.error.URLError("offline"))
+        monkeypatch.setattr(bot, "conversation_source",
+                            types.SimpleNamespace(fetch=lambda: fetched))
+
+        runtime.run_sync(
+            bot.reload_conversation_in_background(context.api, USER,
+                                                  "admin"))
+
+        assert "offline" in context.bot.texts[0]
+        assert note in context.bot.texts[0]
+        assert context.bot.texts[1] == "Диалог не изменился."
+
+
+class TestReload:
+
+    def test_context_keeps_its_snapshot_through_a_reload(self, reloadable):
+        text_update, new_context = reloadable
+        context = new_context()
+        snapshot = context.conversation
+        runtime.run_sync(bot.start(text_update("/start"), context))
+
+        reload = threading.Thread(target=bot.reset_bot_data,
+                                  args=(changed_conversation(), ))
+        reload.start()
+        reload.join()
+
+        assert bot.conversation_snapshot is not snapshot
+        assert context.conversation is snapshot
+        assert runtime.run_sync(
+            bot.choice(text_update("Уникальный узел"),
+                       context)) == bot.SEARCH_FAILED
+        assert context.bot.texts[-1] == bot_messages.EMPTY_SEARCH_RESULTS
+        assert new_context().conversation is bot.conversation_snapshot
+
+    def test_background_reload_publishes_tree_and_index_together(
+            self, reloadable, monkeypatch):
+        text_update, new_context = reloadable
+        textproto = changed_conversation()
+        fetched = conversation_loader.FetchResult(
+            textproto, conversation_loader.content_hash(textproto),
+            conversation_loader.FROM_NETWORK, None)
+        monkeypatch.setattr(bot, "conversation_source",
+                            types.SimpleNamespace(fetch=lambda: fetched))
+        seen = []
+        reloaded = threading.Event()
+
+        def watch_snapshots():
+            while not reloaded.is_set():
+                snapshot = bot.conversation_snapshot
+                seen.append(
+                    (snapshot.convo_data.node_by_name("Уникальный узел")
+                     is not None,
+                     bool(snapshot.morpho_index.search("абракадабра"))))
+
+        watcher = threading.Thread(target=watch_snapshots)
+        watcher.start()
+        runtime.run_sync(
+            bot.reload_conversation_in_background(new_context().api, USER,
+                                                  "admin"))
+        reloaded.set()
+        watcher.join()
+
+        assert new_context().bot.texts[-1].startswith(
+            "Диалог успешно перезагружен")
+        assert set(seen) <= {(False, False), (True, True)}
+        snapshot = bot.conversation_snapshot
+        assert snapshot.content_hash == \
+            conversation_loader.content_hash(textproto)
+        assert snapshot.morpho_index.search("абракадабра")[0].node_name == \
+            "Уникальный узел"
+
+    def test_search_and_navigation_work_after_a_reload(self, reloadable):
+        text_update, new_context = reloadable
+        bot.reset_bot_data(changed_conversation())
+        context = new_context()
+        runtime.run_sync(bot.start(text_update("/start"), context))
+
+        assert runtime.run_sync(bot.choice(text_update("абракадабра"),
+                                           context)) == bot.CHOOSING
+        assert context.bot.texts[-2] == \
+            bot_messages.SINGLE_SEARCH_RESULT_HEADER_TEMPLATE.format(
+                "Уникальный узел")
+        assert context.bot.texts[-1] == "абракадабра"
+        assert context.user_data["current_node"] == bot.START_NODE
+
+        runtime.run_sync(bot.choice(text_update("Уникальный узел"), context))
+        assert context.bot.texts[-1] == "абракадабра"
+        assert runtime.run_sync(
+            bot.back_choice(text_update(bot_messages.BACK),
+                            context)) == bot.CHOOSING
+        assert context.user_data["nav_stack"] == [bot.START_NODE]
+
+
+class TestConfig:
+
+    def test_replicas_need_persistent_sessions(self, monkeypatch):
+        monkeypatch.setattr(config, "MULTI_REPLICA", True)
+        monkeypatch.setattr(bot, "persistence", None)
+        with pytest.raises(ValueError, match="PERSIST_SESSIONS"):
+            bot.check_config()
@@ -0,0 +1,82 @@
+from queue import Queue
+import contextlib
+import datetime
+import threading
+import time
+
+from telegram import Bot, Chat, Message, Update
+from telegram.ext import CallbackContext, TypeHandler
+
+from chat_dispatcher import ChatOrderedDispatcher, ChatSerialExecutor
+
+
+def make_update(update_id, chat_id):
+    return Update(update_id,
+                  message=Message(update_id,
+                                  datetime.datetime.now(),
+                                  Chat(chat_id, Chat.PRIVATE),
+                                  text=str(update_id)))
+
+
+class TestChatSerialExecutor:
+
+    def test_calls_of_a_key_run_in_order(self):
+        executor = ChatSerialExecutor(max_workers=4)
+        calls = []
+
+        def call(key, i):
+            time.sleep(0.001 * (5 - i))
+            calls.append((key, i))
+
+        for i in range(5):
+            for key in "ab":
+                executor.submit(key, call, key, i)
+        executor.shutdown()
+
+        assert [i for key, i in calls if key == "a"] == list(range(5))
+        assert [i for key, i in calls if key == "b"] == list(range(5))
+        assert executor.pending == 0
+
+    def test_keys_run_concurrently(self):
+        executor = ChatSerialExecutor(max_workers=2)
+        both_running = threading.Barrier(2, timeout=5)
+        for key in "ab":
+            executor.submit(key, both_running.wait)
+        executor.shutdown()
+
+        assert not both_running.broken
+
+
+class TestChatOrderedDispatcher:
+
+    def test_updates_of_a_chat_are_handled_in_order(self):
+        scopes = []
+
+        @contextlib.contextmanager
+        def update_scope():
+            scopes.append(threading.current_thread().name)
+            yield
+
+        dispatcher = ChatOrderedDispatcher(Bot("123:TOKEN"),
+                                           Queue(),
+                                           concurrent_updates=4,
+                                           update_scope=update_scope)
+        handled = []
+        threads = set()
+
+        def handle(update: Update, context: CallbackContext):
+            time.sleep(0.01)
+            threads.add(threading.current_thread().name)
+            handled.append((update.effective_chat.id, update.update_id))
+
+        dispatcher.add_handler(TypeHandler(Update, handle))
+        for update_id in range(6):
+            dispatcher.process_update(make_update(update_id,
+                                                  chat_id=update_id % 2 + 1))
+        dispatcher.stop()
+
+        assert [u for chat, u in handled if chat == 1] == [0, 2, 4]
+        assert [u for chat, u in handled if chat == 2] == [1, 3, 5]
+        assert len(threads) > 1
+        assert len(scopes) == 6 and set(scopes) == threads
+        assert "0, in 0 chats" in dispatcher.update_stats()
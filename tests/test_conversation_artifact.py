@@ -0,0 +1,51 @@
+import google.protobuf.text_format as text_format
+
+import conversation_artifact
+import proto.conversation_pb2 as conversation_proto
+from conversation_loader import content_hash
+from morpho_index import MorphoIndex
+
+
+def read_conversation_textproto():
+    with open('conversation_tree.textproto', 'r') as f:
+        return f.read()
+
+
+class TestConversationArtifact:
+
+    def test_artifact_matches_textproto(self, tmp_path):
+        textproto = read_conversation_textproto()
+        path = str(tmp_path / "conversation.bin")
+        conversation_artifact.write_artifact(path, textproto)
+
+        artifact = conversation_artifact.load_artifact(
+            path, content_hash(textproto))
+
+        conversation = text_format.Parse(textproto,
+                                         conversation_proto.Conversation())
+        assert artifact.conversation == conversation
+        assert artifact.content_hash == content_hash(textproto)
+        index = MorphoIndex(conversation)
+        for query in ["медицинская страховка", "житло", "ZH"]:
+            assert artifact.morpho_index.search(query) == index.search(query)
+
+    def test_artifact_of_other_source_is_not_used(self, tmp_path):
+        textproto = read_conversation_textproto()
+        path = str(tmp_path / "conversation.bin")
+        conversation_artifact.write_artifact(path, textproto)
+
+        assert conversation_artifact.load_artifact(
+            path, content_hash(textproto + " ")) is None
+        assert conversation_artifact.load_artifact(
+            str(tmp_path / "missing.bin"), content_hash(textproto)) is None
+
+    def test_corrupt_artifact_is_not_used(self, tmp_path):
+        textproto = read_conversation_textproto()
+        path = tmp_path / "conversation.bin"
+        conversation_artifact.write_artifact(str(path), textproto)
+        data = bytearray(path.read_bytes())
+        data[-1] ^= 0xff
+        path.write_bytes(bytes(data))
+
+        assert conversation_artifact.load_artifact(
+            str(path), content_hash(textproto)) is None
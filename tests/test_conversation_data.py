@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+import google.protobuf.text_format as text_format
+
+import bot_messages
+import conversation_data
+import proto.conversation_pb2 as conversation_proto
+from conversation_data import ConversationData
+from node_util import visit_node
+
+
+def read_conversation_tree():
+    with open('conversation_tree.textproto', 'r') as f:
+        return text_format.Parse(f.read(), conversation_proto.Conversation())
+
+
+def all_node_names(conversation):
+    names = []
+    for node in conversation.node:
+        visit_node(node, lambda n: names.append(n.name))
+    return names
+
+
+class TestConversationData:
+
+    def test_callback_data_resolves_every_node(self):
+        conversation = read_conversation_tree()
+        data = ConversationData(conversation)
+        for name in all_node_names(conversation):
+            callback_data = data.callback_data(name)
+            assert len(callback_data.encode()) <= 64
+            assert data.node_by_callback_data(callback_data).name == name
+
+    def test_callback_data_is_stable_across_processes(self):
+        name = all_node_names(read_conversation_tree())[-1]
+        ids = set()
+        for seed in ["1", "2"]:
+            output = subprocess.check_output(
+                [
+                    sys.executable, "-c",
+                    "import sys, conversation_data; "
+                    "print(conversation_data.node_id(sys.argv[1]))", name
+                ],
+                env=dict(os.environ, PYTHONHASHSEED=seed))
+            ids.add(output.decode().strip())
+        assert ids == {conversation_data.node_id(name)}
+
+    def test_unknown_callback_data(self):
+        data = ConversationData(read_conversation_tree())
+        assert data.node_by_callback_data(str(hash("/start"))) is None
+        assert data.node_by_callback_data("n:0000000000000000") is None
+
+    def test_keyboard_markup(self):
+        data = ConversationData(read_conversation_tree())
+        links = [list(row) for row in data.keyboard_by_name("/start")]
+
+        top = data.keyboard_markup("/start", 1, True, True)
+        assert top.keyboard[0][0].text == bot_messages.ADMIN
+        assert top.keyboard[-1][0].text == bot_messages.FEEDBACK
+        assert len(top.keyboard) == len(links) + 2
+
+        deep = data.keyboard_markup("/start", 5, True, True)
+        assert [row[0].text for row in deep.keyboard[-2:]] == [
+            bot_messages.BACK, bot_messages.START_OVER
+        ]
+        assert len(deep.keyboard) == len(links) + 2
+        assert data.keyboard_markup("/start", 3, True, True) is deep
+
+    def test_reload_reuses_unchanged_nodes(self):
+        conversation = read_conversation_tree()
+        data = ConversationData(conversation)
+        start_markup = data.keyboard_markup("/start", 1)
+        changed = conversation_proto.Conversation()
+        changed.CopyFrom(conversation)
+        changed.node[0].answer[0].text += " Обновлено."
+
+        reloaded = ConversationData(changed, previous=data)
+
+        assert reloaded.changed_node_names == {changed.node[0].name}
+        assert reloaded.removed_node_names == set()
+        name = all_node_names(conversation)[-1]
+        assert reloaded.node_by_name(name).answers is \
+            data.node_by_name(name).answers
+        assert reloaded.node_by_name(changed.node[0].name).answers[
+            0].text.endswith("Обновлено.")
+        if changed.node[0].name != "/start":
+            assert reloaded.keyboard_markup("/start", 1) is start_markup
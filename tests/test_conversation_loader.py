@@ -0,0 +1,126 @@
+import http.server
+import threading
+import urllib.error
+
+import pytest
+
+import conversation_loader
+from conversation_loader import ConversationLoader
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Sat, 02 Apr 2022 10:00:00 GMT"
+CONVERSATION = 'node { name: "/start" answer { text: "Привет" } }'
+
+
+class ConversationServer(http.server.ThreadingHTTPServer):
+    """Serves a conversation like raw.githubusercontent.com does."""
+
+    def __init__(self, send_validators=True):
+        super().__init__(("127.0.0.1", 0), ConversationRequestHandler)
+        self.conversation = CONVERSATION
+        self.send_validators = send_validators
+        self.requests = []
+        self.full_responses = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/tree.textproto"
+
+
+class ConversationRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.send_validators and \
+                self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.conversation.encode("utf-8")
+        server.full_responses += 1
+        self.send_response(200)
+        if server.send_validators:
+            self.send_header("ETag", ETAG)
+            self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ConversationServer()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestConversationLoader:
+
+    def test_unchanged_conversation_is_not_downloaded_again(
+            self, server, tmp_path):
+        loader = ConversationLoader(server.url, str(tmp_path))
+        first = loader.fetch()
+        second = loader.fetch()
+
+        assert first.source == conversation_loader.FROM_NETWORK
+        assert second.source == conversation_loader.NOT_MODIFIED
+        assert second.textproto == CONVERSATION
+        assert second.content_hash == first.content_hash
+        assert server.requests[1]["If-None-Match"] == ETAG
+        assert server.requests[1]["If-Modified-Since"] == LAST_MODIFIED
+        assert server.full_responses == 1
+
+    def test_content_hash_without_validators(self, tmp_path):
+        server = ConversationServer(send_validators=False)
+        try:
+            loader = ConversationLoader(server.url, str(tmp_path))
+            first = loader.fetch()
+            assert loader.fetch().content_hash == first.content_hash
+
+            server.conversation += " "
+            assert loader.fetch().content_hash != first.content_hash
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_cached_copy_is_used_when_fetch_fails(self, server, tmp_path):
+        ConversationLoader(server.url, str(tmp_path)).fetch()
+        url = server.url
+        server.shutdown()
+        server.server_close()
+
+        fetched = ConversationLoader(url, str(tmp_path)).fetch()
+
+        assert fetched.source == conversation_loader.FROM_CACHE
+        assert fetched.textproto == CONVERSATION
+        assert isinstance(fetched.error, urllib.error.URLError)
+
+    def test_fallback_is_used_without_cached_copy(self, server, tmp_path):
+        url = server.url
+        server.shutdown()
+        server.server_close()
+        fallback = tmp_path / "bundled.textproto"
+        fallback.write_text(CONVERSATION, encoding="utf-8")
+
+        fetched = ConversationLoader(url,
+                                     str(tmp_path / "cache"),
+                                     fallback_url=fallback.as_uri()).fetch()
+
+        assert fetched.source == conversation_loader.FROM_FALLBACK
+        assert fetched.textproto == CONVERSATION
+        with pytest.raises(urllib.error.URLError):
+            ConversationLoader(url, str(tmp_path / "cache")).fetch()
+
+    def test_cached_copy_of_another_url_is_ignored(self, server, tmp_path):
+        ConversationLoader(server.url, str(tmp_path)).fetch()
+        loader = ConversationLoader(server.url + "?branch=dev",
+                                    str(tmp_path))
+
+        assert loader.fetch().source == conversation_loader.FROM_NETWORK
+        assert "If-None-Match" not in server.requests[-1]
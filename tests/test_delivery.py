@@ -0,0 +1,78 @@
+from telegram import ReplyKeyboardMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+import delivery
+import proto.conversation_pb2 as conversation_proto
+from conversation_data import Answer
+
+KEYBOARD = ReplyKeyboardMarkup([["a"]])
+PROMPT = "prompt"
+
+
+def answers(*textprotos):
+    result = []
+    for textproto in textprotos:
+        answer = conversation_proto.ConversationNode.Answer()
+        kind, value = textproto
+        if kind == "links":
+            answer.links.text = value
+            answer.links.url.add(label="l", url="https://example.com")
+        elif kind == "venue":
+            answer.venue.title = value
+        else:
+            setattr(answer, kind, value)
+        result.append(Answer(answer))
+    return result
+
+
+def kinds(sends):
+    return [send.kind for send in sends]
+
+
+class TestDeliveryPlan:
+
+    def test_texts_are_merged_and_carry_keyboard(self):
+        sends = delivery.plan(answers(("text", "a"), ("text", "b")),
+                              KEYBOARD, PROMPT)
+        assert sends == [
+            delivery.Send(delivery.SEND_TEXT, "a\n\nb", KEYBOARD)
+        ]
+
+    def test_long_texts_are_not_merged(self):
+        long_text = "x" * (MAX_MESSAGE_LENGTH - 1)
+        sends = delivery.plan(answers(("text", long_text), ("text", "b")),
+                              KEYBOARD, PROMPT)
+        assert [send.content for send in sends] == [long_text, "b"]
+        assert sends[-1].reply_markup is KEYBOARD
+
+    def test_photos_are_sent_as_albums(self):
+        photos = [("photo", f"{i}.jpg") for i in range(12)]
+        sends = delivery.plan(answers(("text", "a"), *photos), KEYBOARD,
+                              PROMPT)
+        assert kinds(sends) == [
+            delivery.SEND_TEXT, delivery.SEND_MEDIA_GROUP,
+            delivery.SEND_MEDIA_GROUP, delivery.SEND_TEXT
+        ]
+        assert len(sends[1].content) == delivery.MAX_MEDIA_GROUP_SIZE
+        assert sends[2].content == ("10.jpg", "11.jpg")
+        assert sends[-1] == delivery.Send(delivery.SEND_TEXT, PROMPT,
+                                          KEYBOARD)
+
+    def test_keyboard_is_attached_to_last_photo_or_venue(self):
+        for last in [("photo", "1.jpg"), ("venue", "v")]:
+            sends = delivery.plan(answers(("text", "a"), last), KEYBOARD,
+                                  PROMPT)
+            assert len(sends) == 2
+            assert sends[-1].reply_markup is KEYBOARD
+
+    def test_links_keep_inline_buttons(self):
+        sends = delivery.plan(
+            answers(("text", "a"), ("links", "b"), ("text", "c")), KEYBOARD,
+            PROMPT)
+        assert [send.content for send in sends] == ["a", "b", "c"]
+        assert sends[1].reply_markup.inline_keyboard[0][0].text == "l"
+        assert sends[-1].reply_markup is KEYBOARD
+
+        sends = delivery.plan(answers(("links", "b")), KEYBOARD, PROMPT)
+        assert sends[-1] == delivery.Send(delivery.SEND_TEXT, PROMPT,
+                                          KEYBOARD)
@@ -0,0 +1,90 @@
+from queue import Queue
+import threading
+import types
+import urllib.error
+import urllib.request
+
+from prometheus_client import REGISTRY
+from telegram.ext.utils.webhookhandler import WebhookAppClass, WebhookServer
+import fakeredis
+import pytest
+import telegram
+
+from replica_harness import Replica, bot, load_bot
+import monitoring
+
+USER = 42
+
+
+def sample(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+@pytest.fixture
+def replica():
+    load_bot()
+    replica = Replica(fakeredis.FakeServer())
+    yield replica
+    replica.stop()
+
+
+class TestMonitoring:
+
+    def test_handlers_and_searches_are_timed(self, replica):
+        choices = sample("bot_handler_latency_seconds_count",
+                         {"handler": "choice"})
+        searches = sample("bot_search_latency_seconds_count")
+        session_loads = sample("bot_redis_latency_seconds_count",
+                               {"operation": "session_load"})
+
+        replica.send_text(USER, "/start")
+        replica.send_text(USER, "страховка")
+
+        assert sample("bot_handler_latency_seconds_count",
+                      {"handler": "choice"}) == choices + 1
+        assert sample("bot_search_latency_seconds_count") == searches + 1
+        assert sample("bot_redis_latency_seconds_count",
+                      {"operation": "session_load"}) > session_loads
+
+    def test_reload_is_timed(self):
+        reloads = sample("bot_conversation_reload_seconds_count")
+        with open("conversation_tree.textproto", "r") as f:
+            bot.reset_bot_data(f.read())
+        assert sample("bot_conversation_reload_seconds_count") == reloads + 1
+
+    def test_queue_depth_is_read_when_scraped(self):
+        queue = Queue()
+        monitoring.track_queue("test", queue.qsize)
+        queue.put(1)
+        assert sample("bot_queue_depth", {"queue": "test"}) == 1
+
+    def test_metrics_are_served_by_the_webhook_server(self):
+        app = WebhookAppClass("/123:TOKEN", telegram.Bot("123:TOKEN"),
+                              Queue())
+        httpd = WebhookServer("127.0.0.1", 0, app, None)
+        ready = threading.Event()
+        threading.Thread(target=httpd.serve_forever,
+                         kwargs={"ready": ready},
+                         daemon=True).start()
+        assert ready.wait(5)
+        try:
+            monitoring.serve(types.SimpleNamespace(httpd=httpd), "/metrics",
+                             0)
+            port = next(iter(
+                httpd.http_server._sockets.values())).getsockname()[1]
+            body = None
+            for _ in range(100):
+                try:
+                    with urllib.request.urlopen(
+                            f"http://127.0.0.1:{port}/metrics",
+                            timeout=5) as response:
+                        body = response.read().decode()
+                    break
+                except urllib.error.HTTPError:
+                    # The handler is added by the loop of the server.
+                    threading.Event().wait(0.01)
+        finally:
+            httpd.shutdown()
+
+        assert "bot_handler_latency_seconds_bucket" in body
+        assert "bot_redis_latency_seconds" in body
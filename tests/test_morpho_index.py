@@ -0,0 +1,210 @@
+import os
+import re
+
+import google.protobuf.text_format as text_format
+
+import morpho_index
+import proto.conversation_pb2 as conversation_proto
+from morpho_index import MorphoIndex
+from node_util import visit_node_with_branch_parent
+
+QUERIES = [
+    "медицинская страховка",
+    "пермит S",
+    "Цюрих",
+    "ZH",
+    "работа",
+    "житло",
+    "как найти жилье в Берне",
+    "школа для детей",
+    "собака",
+    "дозвіл на роботу",
+]
+
+
+def read_query_log():
+    """Returns logged search queries, lowercased as stored by the stats."""
+    path = os.path.join(os.path.dirname(__file__), "search_queries.txt")
+    with open(path, "r") as f:
+        return [line for line in f.read().split("\n") if line]
+
+
+def add_reference_word_tags(node_counts_by_word_tag, node, text, weight):
+    for word in re.split(morpho_index.SPLIT_REGEX, text):
+        for wt in morpho_index.word_tags(word):
+            node_counts = node_counts_by_word_tag.setdefault(wt, {})
+            node_counts[node.name] = node_counts.get(node.name, 0) + weight
+
+
+def node_texts(node):
+    """Yields (text, weight) of the texts of a node the search indexes."""
+    yield node.name, morpho_index.NODE_NAME_TERM_SCORE
+    for alt_name in node.alt_name:
+        yield alt_name, morpho_index.NODE_NAME_TERM_SCORE
+    for keyword in node.keyword:
+        yield keyword, 1
+    for ans in node.answer:
+        if ans.text:
+            yield ans.text, 1
+        if ans.links and ans.links.text:
+            yield ans.links.text, 1
+            for url in ans.links.url:
+                yield url.label, 1
+
+
+def build_reference_index(conversation):
+    """Returns node name counts by word tag, and parent names by branch
+    name."""
+    node_counts_by_word_tag = {}
+    parent_name_by_branch_name = {}
+
+    def process_node(node, branch_parent):
+        if node.name in morpho_index.IGNORED_NODES:
+            return
+        if branch_parent:
+            parent_name_by_branch_name[node.name] = branch_parent.name
+        for text, weight in node_texts(node):
+            add_reference_word_tags(node_counts_by_word_tag, node, text,
+                                    weight)
+
+    for node in conversation.node:
+        visit_node_with_branch_parent(node, process_node)
+    return node_counts_by_word_tag, parent_name_by_branch_name
+
+
+def reference_scores(node_counts_by_word_tag, text):
+    """Returns the counts of matching words by node name, and how many words
+    of the text each node matched."""
+    counts = {}
+    found_word_count = {}
+    for word in re.split(morpho_index.SPLIT_REGEX, text):
+        for wt in morpho_index.word_tags(word):
+            for node_name, count in node_counts_by_word_tag.get(wt,
+                                                                {}).items():
+                found_word_count[node_name] = found_word_count.get(
+                    node_name, 0) + 1
+                counts[node_name] = counts.get(node_name, 0) + count
+    return counts, found_word_count
+
+
+def reference_search(conversation, text):
+    """The search as implemented before the inverted index, node name sets
+    with per-query accumulation and a full sort."""
+    node_counts_by_word_tag, parent_name_by_branch_name = \
+        build_reference_index(conversation)
+    counts, found_word_count = reference_scores(node_counts_by_word_tag, text)
+    results = []
+    for node_name, count in counts.items():
+        label = node_name
+        if node_name in parent_name_by_branch_name:
+            label = (f"{parent_name_by_branch_name[node_name]}"
+                     f"{morpho_index.BREADCRUMB_SEPARATOR}{node_name}")
+        results.append(
+            (node_name, count * found_word_count[node_name], label))
+    results.sort(key=lambda result: result[1], reverse=True)
+    return results
+
+
+def first_branch(conversation):
+    for node in conversation.node:
+        for link in node.link:
+            if link.HasField("branch"):
+                return link.branch
+
+
+def read_conversation_textproto():
+    with open('conversation_tree.textproto', 'r') as f:
+        return f.read()
+
+
+def parse(textproto):
+    return text_format.Parse(textproto, conversation_proto.Conversation())
+
+
+class TestMorphoIndex:
+
+    def test_snapshot_gives_same_results(self, tmp_path):
+        textproto = read_conversation_textproto()
+        conversation = parse(textproto)
+        built = MorphoIndex.load_or_build(conversation, textproto,
+                                          str(tmp_path))
+        assert len(os.listdir(tmp_path)) == 1
+
+        loaded = MorphoIndex.load_or_build(conversation, textproto,
+                                           str(tmp_path))
+        for query in QUERIES:
+            assert loaded.search(query) == built.search(query)
+
+    def test_snapshot_of_changed_conversation_is_not_used(self, tmp_path):
+        textproto = read_conversation_textproto()
+        MorphoIndex.load_or_build(parse(textproto), textproto, str(tmp_path))
+
+        changed = textproto + 'node { name: "Уникальный узел" answer { ' \
+            'text: "абракадабра" } }'
+        index = MorphoIndex.load_or_build(parse(changed), changed,
+                                          str(tmp_path))
+
+        assert index.search("абракадабра")[0].node_name == "Уникальный узел"
+        assert os.listdir(tmp_path) == [
+            morpho_index.SNAPSHOT_FILE_TEMPLATE.format(
+                morpho_index.snapshot_key(changed))
+        ]
+
+    def test_repeated_query_hits_word_tags_cache(self):
+        index = MorphoIndex(parse(read_conversation_textproto()))
+        index.search("Где найти квартиру в Цюрихе")
+        misses = morpho_index._normalized_word_tags.cache_info().misses
+
+        index.search("Где найти квартиру в Цюрихе")
+
+        assert morpho_index._normalized_word_tags.cache_info().misses == \
+            misses
+        assert "hits" in morpho_index.word_tags_cache_stats()
+
+    def test_rankings_match_reference_search(self):
+        conversation = parse(read_conversation_textproto())
+        index = MorphoIndex(conversation)
+        for query in read_query_log() + QUERIES:
+            expected = reference_search(conversation, query)
+            assert [tuple(r) for r in index.search(query)] == expected, query
+            top, total = index.search_top_k(query, 3)
+            assert [tuple(r) for r in top] == expected[:3], query
+            assert total == len(expected)
+
+    def test_search_many_matches_single_searches(self):
+        index = MorphoIndex(parse(read_conversation_textproto()))
+        queries = read_query_log() + QUERIES[:3]
+        assert index.search_many(queries, 3) == [
+            index.search_top_k(query, 3) for query in queries
+        ]
+
+    def test_incremental_rebuild_matches_full_build(self):
+        conversation = parse(read_conversation_textproto())
+        index = MorphoIndex(conversation)
+        changed = conversation_proto.Conversation()
+        changed.CopyFrom(conversation)
+        node = first_branch(changed)
+        node.answer.add().text = "абракадабра"
+        changed.node.add(name="Уникальный узел").answer.add(text="фьорд")
+
+        rebuilt = MorphoIndex(changed, previous=index)
+
+        assert rebuilt.reindexed_node_count == 2
+        full = MorphoIndex(changed)
+        for query in QUERIES + ["абракадабра", "фьорд"]:
+            assert rebuilt.search(query) == full.search(query), query
+        assert rebuilt.search("абракадабра")[0].node_name == node.name
+
+    def test_unchanged_postings_are_kept(self):
+        conversation = parse(read_conversation_textproto())
+        index = MorphoIndex(conversation)
+        changed = conversation_proto.Conversation()
+        changed.CopyFrom(conversation)
+        first_branch(changed).answer.add().text = "абракадабра"
+
+        rebuilt = MorphoIndex(changed, previous=index)
+
+        kept = [wt for wt in index._postings
+                if rebuilt._postings[wt] is index._postings[wt]]
+        assert len(kept) > len(index._postings) / 2
+        assert rebuilt.search("абракадабра")
@@ -0,0 +1,131 @@
+import os
+
+import fakeredis
+import pytest
+import telegram.error
+from telegram import PhotoSize
+
+import photo_cache
+from photo_cache import PhotoCache
+from runtime import run_sync
+
+CHAT = 42
+
+
+class FakeSentMessage:
+
+    def __init__(self, file_id):
+        self.photo = [
+            PhotoSize(file_id + "-small", "s", 90, 90),
+            PhotoSize(file_id, "u", 800, 800),
+        ]
+
+
+class FakeApi:
+    """Records what is sent, uploads get a new file id."""
+
+    def __init__(self, valid_file_ids=None):
+        self.sent = []
+        self.valid_file_ids = valid_file_ids
+
+    def _send(self, photo):
+        self.sent.append(photo)
+        if isinstance(photo, str):
+            if self.valid_file_ids is not None and \
+                    photo not in self.valid_file_ids:
+                raise telegram.error.BadRequest("Wrong file identifier")
+            return FakeSentMessage(photo)
+        return FakeSentMessage(f"id{len(self.sent)}")
+
+    async def send_photo(self, chat_id, photo, reply_markup=None):
+        return self._send(photo)
+
+    async def send_media_group(self, chat_id, media):
+        for item in media:
+            if not isinstance(item.media, str):
+                continue
+            if self.valid_file_ids is not None and \
+                    item.media not in self.valid_file_ids:
+                raise telegram.error.BadRequest("Wrong file identifier")
+        return [
+            self._send(item.media if isinstance(item.media, str) else
+                       item.media.input_file_content) for item in media
+        ]
+
+
+def send_photo(cache, api, name):
+    return run_sync(cache.send_photo(api, CHAT, name))
+
+
+def send_media_group(cache, api, names):
+    return run_sync(cache.send_media_group(api, CHAT, names))
+
+
+@pytest.fixture
+def photo_dir(tmp_path):
+    (tmp_path / "a.jpg").write_bytes(b"jpeg a")
+    (tmp_path / "b.jpg").write_bytes(b"jpeg b")
+    return tmp_path
+
+
+class TestPhotoCache:
+
+    def test_photo_is_uploaded_once(self, photo_dir):
+        cache = PhotoCache(str(photo_dir))
+        api = FakeApi()
+        send_photo(cache, api, "a.jpg")
+        send_photo(cache, api, "a.jpg")
+        assert api.sent == [b"jpeg a", "id1"]
+
+    def test_file_ids_survive_restart(self, photo_dir):
+        rd = fakeredis.FakeRedis()
+        send_photo(PhotoCache(str(photo_dir), rd), FakeApi(), "a.jpg")
+
+        api = FakeApi()
+        send_photo(PhotoCache(str(photo_dir), rd), api, "a.jpg")
+
+        assert api.sent == ["id1"]
+
+    def test_changed_photo_is_uploaded_again(self, photo_dir):
+        cache = PhotoCache(str(photo_dir))
+        api = FakeApi()
+        send_photo(cache, api, "a.jpg")
+        path = photo_dir / "a.jpg"
+        path.write_bytes(b"jpeg a, edited")
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        send_photo(cache, api, "a.jpg")
+
+        assert api.sent == [b"jpeg a", b"jpeg a, edited"]
+
+    def test_rejected_file_id_is_replaced(self, photo_dir):
+        rd = fakeredis.FakeRedis()
+        send_photo(PhotoCache(str(photo_dir), rd), FakeApi(), "a.jpg")
+
+        api = FakeApi(valid_file_ids=set())
+        send_photo(PhotoCache(str(photo_dir), rd), api, "a.jpg")
+
+        assert api.sent == ["id1", b"jpeg a"]
+        assert list(rd.hvals(photo_cache.REDIS_KEY)) == [b"id2"]
+
+    def test_media_group_reuses_file_ids(self, photo_dir):
+        rd = fakeredis.FakeRedis()
+        cache = PhotoCache(str(photo_dir), rd)
+        api = FakeApi()
+        send_photo(cache, api, "a.jpg")
+
+        send_media_group(cache, api, ["a.jpg", "b.jpg"])
+        send_media_group(cache, api, ["a.jpg", "b.jpg"])
+
+        assert api.sent == [b"jpeg a", "id1", b"jpeg b", "id1", "id3"]
+
+    def test_media_group_with_rejected_file_id_is_uploaded(self, photo_dir):
+        rd = fakeredis.FakeRedis()
+        send_photo(PhotoCache(str(photo_dir), rd), FakeApi(), "a.jpg")
+
+        api = FakeApi(valid_file_ids=set())
+        send_media_group(PhotoCache(str(photo_dir), rd), api,
+                         ["a.jpg", "b.jpg"])
+
+        assert api.sent == [b"jpeg a", b"jpeg b"]
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+from prometheus_client import REGISTRY
+import telegram
+import telegram.error
+
+from rate_limiter import OutboundLimiter, RateLimitedBot, TokenBucket
+
+USER_CHAT = 1
+OTHER_USER_CHAT = 2
+CHANNEL = -1001
+
+
+def acquire_in_thread(limiter, chat_id, admitted):
+
+    def run():
+        limiter.acquire(chat_id)
+        admitted.append(chat_id)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+class TestTokenBucket:
+
+    def test_refills_at_rate_up_to_capacity(self):
+        bucket = TokenBucket(rate=2, capacity=2, now=0)
+        bucket.take(0)
+        bucket.take(0)
+
+        assert bucket.delay(0) == 0.5
+        assert bucket.delay(0.5) == 0
+        assert bucket.is_full(10)
+        assert bucket.tokens == 2
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=1, capacity=5, now=0)
+        bucket.pause(0, 3)
+
+        assert bucket.delay(0) == 3
+        assert bucket.delay(2) == 1
+
+
+class TestOutboundLimiter:
+
+    def test_user_replies_go_before_channel_traffic(self):
+        limiter = OutboundLimiter(global_rate=5, global_burst=1)
+        limiter.acquire(USER_CHAT)
+        admitted = []
+        channel = acquire_in_thread(limiter, CHANNEL, admitted)
+        time.sleep(0.05)
+        user = acquire_in_thread(limiter, OTHER_USER_CHAT, admitted)
+        channel.join()
+        user.join()
+
+        assert admitted == [OTHER_USER_CHAT, CHANNEL]
+        assert limiter.delayed == 2
+        assert limiter.queue_depth(0) == limiter.queue_depth(1) == 0
+
+    def test_chat_limit_does_not_delay_other_chats(self):
+        limiter = OutboundLimiter(private_chat_rate=2, private_chat_burst=1)
+        limiter.acquire(USER_CHAT)
+        admitted = []
+        waiting = acquire_in_thread(limiter, USER_CHAT, admitted)
+        time.sleep(0.05)
+
+        assert limiter.acquire(OTHER_USER_CHAT) == 0
+        assert admitted == []
+        waiting.join()
+        assert admitted == [USER_CHAT]
+
+    def test_async_acquire_waits_without_holding_up_other_chats(self):
+        limiter = OutboundLimiter(private_chat_rate=20, private_chat_burst=1)
+        admitted = []
+
+        async def acquire(chat_id):
+            await limiter.acquire_async(chat_id)
+            admitted.append(chat_id)
+
+        async def run():
+            await acquire(USER_CHAT)
+            waiting = asyncio.ensure_future(acquire(USER_CHAT))
+            await asyncio.sleep(0.01)
+            assert limiter.queue_depth(0) == 1
+            await acquire(OTHER_USER_CHAT)
+            await waiting
+
+        asyncio.run(run())
+        assert admitted == [USER_CHAT, OTHER_USER_CHAT, USER_CHAT]
+        assert limiter.delayed == 1
+        assert limiter.queue_depth(0) == 0
+
+
+class TestRateLimitedBot:
+
+    def test_retries_after_flood_control(self, monkeypatch):
+        requests = []
+
+        def post(bot, endpoint, data=None, timeout=None, api_kwargs=None):
+            requests.append(endpoint)
+            if len(requests) == 1:
+                raise telegram.error.RetryAfter(0)
+            return True
+
+        def api_calls(method):
+            return REGISTRY.get_sample_value(
+                "bot_telegram_api_latency_seconds_count",
+                {"method": method}) or 0
+
+        monkeypatch.setattr(telegram.Bot, "_post", post)
+        bot = RateLimitedBot("123:TOKEN", OutboundLimiter())
+        sends, polls = api_calls("sendMessage"), api_calls("getUpdates")
+
+        assert bot._post("sendMessage", {"chat_id": USER_CHAT})
+        assert requests == ["sendMessage", "sendMessage"]
+        assert bot.limiter.admitted == 2
+        assert bot.limiter.flood_waits == 1
+
+        assert bot._post("getUpdates", {"offset": 1})
+        assert bot.limiter.admitted == 2
+        assert api_calls("sendMessage") == sends + 2
+        assert api_calls("getUpdates") == polls + 1
+
+    def test_background_sends_in_order(self):
+        bot = RateLimitedBot("123:TOKEN", OutboundLimiter())
+        sent = []
+        futures = [
+            bot.send_in_background(sent.append, text) for text in "abc"
+        ]
+        for future in futures:
+            future.result()
+
+        assert sent == ["a", "b", "c"]
+        assert "background 0" in bot.outbound_stats()
@@ -0,0 +1,249 @@
+import asyncio
+import datetime
+import pickle
+import time
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+import redis
+from cryptography.fernet import Fernet
+from telegram import Chat, Message
+
+import bot_redis_persistence
+import proto.session_pb2 as session_proto
+import session_codec
+from bot_redis_persistence import AsyncRedisPersistence, RedisPersistence
+
+CONVERSATION = "main"
+
+
+def new_persistence(rd, key=None):
+    persistence = RedisPersistence(rd, key)
+    persistence.get_user_data()
+    persistence.get_chat_data()
+    persistence.get_bot_data()
+    persistence.get_conversations(CONVERSATION)
+    return persistence
+
+
+def user_state(node):
+    return {"current_node": node, "nav_stack": ["/start", node],
+            "feedback": []}
+
+
+class TestRedisPersistence:
+
+    def test_update_writes_only_changed_user(self):
+        rd = fakeredis.FakeRedis()
+        persistence = new_persistence(rd, Fernet.generate_key())
+        for user_id in range(10):
+            persistence.refresh_user_data(user_id, {})
+            persistence.update_user_data(user_id, user_state("a"))
+        before = dict(rd.hgetall(bot_redis_persistence.USER_DATA_KEY))
+
+        persistence.update_user_data(3, user_state("b"))
+
+        after = rd.hgetall(bot_redis_persistence.USER_DATA_KEY)
+        changed = [f for f in after if after[f] != before[f]]
+        assert len(after) == 10
+        assert len(changed) == 1
+        assert changed[0] != b"3", "user ids must not be stored in clear"
+
+    def test_user_data_is_loaded_lazily(self):
+        rd = fakeredis.FakeRedis()
+        key = Fernet.generate_key()
+        persistence = new_persistence(rd, key)
+        persistence.refresh_user_data(42, {})
+        persistence.update_user_data(42, user_state("a"))
+        persistence.update_conversation(CONVERSATION, (42, 42), 1)
+
+        restored = new_persistence(rd, key)
+        assert restored.get_user_data() == {}
+        assert restored.get_conversations(CONVERSATION).get((42, 42)) == 1
+        user_data = {}
+        restored.refresh_user_data(42, user_data)
+        assert user_data == user_state("a")
+
+    def test_unloaded_empty_user_is_not_written(self):
+        rd = fakeredis.FakeRedis()
+        persistence = new_persistence(rd)
+        persistence.refresh_user_data(1, {})
+        persistence.update_user_data(1, user_state("a"))
+
+        restarted = new_persistence(rd)
+        restarted.update_user_data(1, {})
+
+        user_data = {}
+        new_persistence(rd).refresh_user_data(1, user_data)
+        assert user_data == user_state("a")
+
+    def test_ended_conversation_is_deleted(self):
+        rd = fakeredis.FakeRedis()
+        persistence = new_persistence(rd)
+        persistence.update_conversation(CONVERSATION, (1, 1), 0)
+        persistence.update_conversation(CONVERSATION, (1, 1), None)
+        restored = new_persistence(rd).get_conversations(CONVERSATION)
+        assert (1, 1) not in restored
+
+    def test_legacy_state_is_migrated(self):
+        rd = fakeredis.FakeRedis()
+        key = Fernet.generate_key()
+        legacy = {
+            "conversations": {CONVERSATION: {(7, 7): 0}},
+            "user_data": {7: user_state("a")},
+            "chat_data": {},
+            "bot_data": {},
+        }
+        rd.set(bot_redis_persistence.LEGACY_REDIS_KEY,
+               Fernet(key).encrypt(pickle.dumps(legacy)))
+
+        persistence = new_persistence(rd, key)
+        user_data = {}
+        persistence.refresh_user_data(7, user_data)
+
+        assert user_data == user_state("a")
+        assert persistence.get_conversations(CONVERSATION).get((7, 7)) == 0
+        assert not rd.exists(bot_redis_persistence.LEGACY_REDIS_KEY)
+
+    def test_write_behind_coalesces_until_flush(self):
+        rd = fakeredis.FakeRedis()
+        persistence = RedisPersistence(rd, None, write_behind_interval=3600)
+        persistence.get_user_data()
+        persistence.refresh_user_data(1, {})
+        for node in ["a", "b", "c"]:
+            persistence.update_user_data(1, user_state(node))
+        assert not rd.exists(bot_redis_persistence.USER_DATA_KEY)
+
+        persistence.flush()
+
+        user_data = {}
+        new_persistence(rd).refresh_user_data(1, user_data)
+        assert user_data == user_state("c")
+
+    def test_write_behind_flushes_when_too_many_pending(self):
+        rd = fakeredis.FakeRedis()
+        persistence = RedisPersistence(rd,
+                                       None,
+                                       write_behind_interval=3600,
+                                       max_pending_writes=2)
+        persistence.get_user_data()
+        for user_id in range(2):
+            persistence.refresh_user_data(user_id, {})
+            persistence.update_user_data(user_id, user_state("a"))
+        for _ in range(100):
+            if rd.hlen(bot_redis_persistence.USER_DATA_KEY) == 2:
+                break
+            time.sleep(0.01)
+        assert rd.hlen(bot_redis_persistence.USER_DATA_KEY) == 2
+        persistence.flush()
+
+    def test_failed_write_is_retried(self):
+        server = fakeredis.FakeServer()
+        rd = fakeredis.FakeRedis(server=server)
+        persistence = new_persistence(rd)
+        persistence.refresh_user_data(1, {})
+        server.connected = False
+        with pytest.raises(redis.exceptions.ConnectionError):
+            persistence.update_user_data(1, user_state("a"))
+        server.connected = True
+
+        persistence.flush()
+
+        user_data = {}
+        new_persistence(rd).refresh_user_data(1, user_data)
+        assert user_data == user_state("a")
+
+    def test_conversation_ended_after_restart_is_deleted(self):
+        rd = fakeredis.FakeRedis()
+        new_persistence(rd).update_conversation(CONVERSATION, (1, 1), 0)
+
+        restarted = new_persistence(rd)
+        conversations = restarted.get_conversations(CONVERSATION)
+        assert conversations.get((1, 1)) == 0
+        del conversations[(1, 1)]
+        restarted.update_conversation(CONVERSATION, (1, 1), None)
+
+        assert (1, 1) not in new_persistence(rd).get_conversations(
+            CONVERSATION)
+
+    def test_legacy_feedback_messages_are_kept_as_ids(self):
+        rd = fakeredis.FakeRedis()
+        message = Message(message_id=5,
+                          date=datetime.datetime(2022, 4, 1),
+                          chat=Chat(7, Chat.PRIVATE),
+                          text="feedback")
+        legacy_user_data = dict(user_state("a"), feedback=[message])
+        rd.hset(bot_redis_persistence.USER_DATA_KEY, "7",
+                pickle.dumps(legacy_user_data))
+
+        user_data = {}
+        new_persistence(rd).refresh_user_data(7, user_data)
+
+        assert user_data == dict(user_state("a"), feedback=[(7, 5)])
+
+
+class TestAsyncRedisPersistence:
+
+    def test_state_is_kept_across_the_runtimes(self):
+        server = fakeredis.FakeServer()
+        key = Fernet.generate_key()
+        persistence = new_persistence(fakeredis.FakeRedis(server=server), key)
+        persistence.refresh_user_data(42, {})
+        persistence.update_user_data(42, user_state("a"))
+        persistence.update_conversation(CONVERSATION, (42, 42), 1)
+
+        async def run():
+            persistence = AsyncRedisPersistence(
+                fakeredis.aioredis.FakeRedis(server=server), key)
+            user_data = {}
+            await persistence.load_user_data(42, user_data)
+            assert user_data == user_state("a")
+            assert await persistence.load_conversation(CONVERSATION,
+                                                       (42, 42)) == 1
+            persistence.update_user_data(42, user_state("b"))
+            persistence.update_conversation(CONVERSATION, (42, 42), None)
+            await persistence.commit()
+
+        asyncio.run(run())
+        restored = new_persistence(fakeredis.FakeRedis(server=server), key)
+        user_data = {}
+        restored.refresh_user_data(42, user_data)
+        assert user_data == user_state("b")
+        assert restored.get_conversations(CONVERSATION).get((42, 42)) is None
+
+    def test_writes_behind_until_closed(self):
+        server = fakeredis.FakeServer()
+        rd = fakeredis.FakeRedis(server=server)
+
+        async def run():
+            persistence = AsyncRedisPersistence(
+                fakeredis.aioredis.FakeRedis(server=server),
+                None,
+                write_behind_interval=60)
+            persistence.start()
+            for user_id in range(3):
+                await persistence.load_user_data(user_id, {})
+                persistence.update_user_data(user_id, user_state("a"))
+                await persistence.commit()
+            assert rd.hlen(bot_redis_persistence.USER_DATA_KEY) == 0
+            await persistence.close()
+
+        asyncio.run(run())
+        assert rd.hlen(bot_redis_persistence.USER_DATA_KEY) == 3
+
+
+class TestSessionCodec:
+
+    def test_user_data_round_trip(self):
+        user_data = dict(user_state("a"), feedback=[(1, 2), (1, 3)])
+        encoded = session_codec.encode_user_data(user_data)
+        assert session_codec.decode_user_data(encoded) == user_data
+        assert session_codec.decode_user_data(
+            session_codec.encode_user_data({})) == {}
+
+    def test_newer_version_is_rejected(self):
+        encoded = session_proto.UserSession(
+            version=session_codec.SESSION_VERSION + 1).SerializeToString()
+        with pytest.raises(session_codec.UnsupportedVersionError):
+            session_codec.decode_user_data(encoded)
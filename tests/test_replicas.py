@@ -0,0 +1,191 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from replica_harness import Replica, bot, load_bot, stored_user_data
+from replicas import ChatLocks, ReloadBroadcaster
+import bot_messages
+
+USER = 42
+
+
+def path_with_keyboards(length):
+    """Returns names of nodes, each a button of the one before."""
+    convo_data = bot.conversation_snapshot.convo_data
+    path = [bot.START_NODE]
+    while len(path) <= length:
+        for row in convo_data.keyboard_by_name(path[-1]):
+            button = row[0]
+            if convo_data.keyboard_by_name(button) and button not in path:
+                path.append(button)
+                break
+        else:
+            raise AssertionError(f"No button with keyboard in {path[-1]}")
+    return path
+
+
+def user_state(path):
+    return {"current_node": path[-1], "nav_stack": path, "feedback": []}
+
+
+@pytest.fixture
+def replicas():
+    load_bot()
+    server = fakeredis.FakeServer()
+    replicas = [Replica(server), Replica(server)]
+    yield server, replicas
+    for replica in replicas:
+        replica.stop()
+
+
+class TestReplicas:
+
+    def test_user_moves_between_replicas(self, replicas):
+        server, (a, b) = replicas
+        path = path_with_keyboards(2)
+
+        a.send_text(USER, "/start")
+        b.send_text(USER, path[1])
+        a.send_text(USER, path[2])
+
+        assert stored_user_data(server, USER)["nav_stack"] == path
+        b.send_text(USER, bot_messages.BACK)
+        assert stored_user_data(server, USER)["nav_stack"] == path[:2]
+        assert a.persistence.conflicts == b.persistence.conflicts == 0
+
+    def test_conflicting_write_is_applied_to_the_newer_version(
+            self, replicas):
+        server, (a, b) = replicas
+        path = path_with_keyboards(1)
+        a.persistence.refresh_user_data(USER, {})
+        a.persistence.update_user_data(USER, user_state(path[:1]))
+        b.persistence.refresh_user_data(USER, {})
+
+        a.persistence.update_user_data(
+            USER, dict(user_state(path[:1]), feedback=[(USER, 7)]))
+        b.persistence.update_user_data(USER, user_state(path))
+
+        assert b.persistence.conflicts == 1
+        assert stored_user_data(server, USER) == dict(user_state(path),
+                                                      feedback=[(USER, 7)])
+        assert b.persistence.write_stats() == \
+            "Session write conflicts: 1, dropped: 0"
+        b.persistence.forget(USER, USER)
+        user_data = {"stale": True}
+        b.persistence.refresh_user_data(USER, user_data)
+        assert user_data == stored_user_data(server, USER)
+
+    def test_write_is_dropped_when_it_keeps_conflicting(
+            self, replicas, monkeypatch):
+        server, (a, b) = replicas
+        path = path_with_keyboards(1)
+        a.persistence.refresh_user_data(USER, {})
+        a.persistence.update_user_data(USER, user_state(path[:1]))
+        b.persistence.refresh_user_data(USER, {})
+        monkeypatch.setattr(b.persistence, "_write_version",
+                            lambda *args: False)
+
+        b.persistence.update_user_data(USER, user_state(path))
+
+        assert b.persistence.write_stats() == \
+            "Session write conflicts: 3, dropped: 1"
+        assert stored_user_data(server, USER) == user_state(path[:1])
+
+    def test_updates_of_a_chat_are_handled_one_at_a_time(self, replicas):
+        server, (a, b) = replicas
+        path = path_with_keyboards(1)
+        a.send_text(USER, "/start")
+        updates = [(replica, replica.text_update(USER, text))
+                   for replica in (a, b) for text in (path[1], "/start") * 5]
+
+        for replica, update in updates:
+            replica.dispatcher.process_update(update)
+        for replica in (a, b):
+            replica.dispatcher.chat_executor.wait()
+
+        assert a.persistence.conflicts == b.persistence.conflicts == 0
+
+    def test_older_update_of_a_chat_is_dropped(self, replicas):
+        server, (a, b) = replicas
+        path = path_with_keyboards(1)
+        a.send_text(USER, "/start")
+        earlier = b.text_update(USER, path[1])
+        later = a.text_update(USER, "/start")
+
+        for replica, update in ((a, later), (b, earlier), (a, later)):
+            replica.dispatcher.process_update(update)
+            replica.dispatcher.chat_executor.wait()
+
+        assert stored_user_data(server, USER)["nav_stack"] == path[:1]
+        assert b.bot.sent_texts(USER) == []
+        assert b.dispatcher.out_of_order == 1
+        assert a.dispatcher.out_of_order == 1, "redelivered update"
+        assert "dropped out of order: 1" in b.dispatcher.update_stats()
+
+
+class TestChatLocks:
+
+    def test_lock_is_exclusive(self):
+        rd = fakeredis.FakeRedis()
+        locks = ChatLocks(rd, poll_interval=0.001)
+        inside = []
+        overlaps = []
+
+        def hold():
+            for _ in range(20):
+                with locks.hold(USER):
+                    inside.append(1)
+                    if len(inside) > 1:
+                        overlaps.append(1)
+                    time.sleep(0.0005)
+                    inside.pop()
+
+        threads = [threading.Thread(target=hold) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not overlaps
+        assert rd.keys() == []
+
+    def test_expired_lock_of_another_holder_is_kept(self):
+        rd = fakeredis.FakeRedis()
+        locks = ChatLocks(rd)
+        with locks.hold(USER):
+            key = rd.keys()[0]
+            rd.set(key, b"other")
+        assert rd.get(key) == b"other"
+
+
+class TestReloadBroadcaster:
+
+    def test_other_replicas_are_told_to_reload(self):
+        server = fakeredis.FakeServer()
+        reloads = {"a": [], "b": []}
+        received = threading.Event()
+
+        def on_reload(name):
+
+            def reload(content_hash):
+                reloads[name].append(content_hash)
+                received.set()
+
+            return reload
+
+        a = ReloadBroadcaster(fakeredis.FakeRedis(server=server),
+                              on_reload("a"))
+        b = ReloadBroadcaster(fakeredis.FakeRedis(server=server),
+                              on_reload("b"))
+        for broadcaster in (a, b):
+            broadcaster.start(poll_interval=0.01)
+        try:
+            a.publish("hash")
+            assert received.wait(5)
+        finally:
+            a.stop()
+            b.stop()
+
+        assert reloads == {"a": [], "b": ["hash"]}
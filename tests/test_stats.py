@@ -0,0 +1,371 @@
+import asyncio
+import datetime
+import random
+import threading
+import time
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+import stats
+
+# Keys expire in real time, so metrics are written at about now.
+DAY_START = stats.bucket_start(int(time.time()), stats.DAY_SEC)
+
+
+class CountingRedis(fakeredis.FakeRedis):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipelines = 0
+
+    def pipeline(self, *args, **kwargs):
+        self.pipelines += 1
+        return super().pipeline(*args, **kwargs)
+
+
+@pytest.fixture(params=["redis", "mem"])
+def storage(request):
+    if request.param == "redis":
+        return stats.RedisStorage(fakeredis.FakeRedis())
+    return stats.MemStorage()
+
+
+class TestStorages:
+
+    def test_top_counts_are_kept_per_window(self, storage):
+        now = DAY_START + 10 * stats.HOUR_SEC
+        for hours_ago, node in [(40, "a"), (30, "a"), (20, "b"), (2, "b"),
+                                (0, "c"), (0, "c")]:
+            storage.store_interaction("user", node,
+                                      now - hours_ago * stats.HOUR_SEC)
+
+        def top(window, ts=now):
+            return dict(storage.top_interactions(window, 10, ts))
+
+        assert [w.name for w in storage.windows] == ["1h", "24h", "3d"]
+        assert top("1h") == {"c": 2}
+        assert top("24h") == {"b": 2, "c": 2}
+        assert top("3d") == {"a": 2, "b": 2, "c": 2}
+        assert storage.top_interactions("3d", 1, now) == [("c", 2)]
+
+        later = now + 15 * stats.HOUR_SEC
+        assert top("1h", later) == {}
+        assert top("24h", later) == {"b": 1, "c": 2}
+        assert top("3d", later) == {"a": 1, "b": 2, "c": 2}
+        assert top("3d", later + stats.DAY_SEC) == {"b": 1, "c": 2}
+        assert top("3d", later + 2 * stats.DAY_SEC) == {}
+
+    def test_counts_written_after_the_windows_moved_leave_them(self, storage):
+        day = DAY_START + stats.DAY_SEC
+        # A replica, or a read, moved the windows past these events and
+        # compacted their day before they were written.
+        storage.top_interactions("3d", 10, day + 2 * stats.HOUR_SEC)
+        storage.store_interaction("user", "a", day - 1)
+        storage.store_interaction("user", "b", DAY_START + 1)
+
+        def top(window, ts):
+            return dict(storage.top_interactions(window, 10, ts))
+
+        assert top("24h", day + 2 * stats.HOUR_SEC) == {"a": 1}
+        assert top("3d", day + 2 * stats.HOUR_SEC) == {"a": 1, "b": 1}
+        assert top("24h", day + stats.DAY_SEC) == {}
+        assert top("3d", day + stats.DAY_SEC) == {"a": 1, "b": 1}
+        assert top("3d", day + 2 * stats.DAY_SEC) == {}
+
+    def test_aggregates_across_midnight_leave_the_windows(self, storage):
+        midnight = DAY_START + stats.DAY_SEC
+        aggregate = stats.Aggregate()
+        for node, ts in [("a", midnight - 1), ("b", midnight)]:
+            aggregate.add(stats.MetricEvent(stats.INTERACTION, 1, node, ts))
+        storage.store_aggregate(aggregate)
+
+        def top(ts):
+            return dict(storage.top_interactions("3d", 10, ts))
+
+        assert top(midnight) == {"a": 1, "b": 1}
+        assert top(midnight + stats.DAY_SEC) == {"a": 1, "b": 1}
+        assert top(midnight + 2 * stats.DAY_SEC) == {"b": 1}
+        assert top(midnight + 3 * stats.DAY_SEC) == {}
+
+    def test_unknown_window_is_rejected(self, storage):
+        with pytest.raises(ValueError):
+            storage.top_interactions("2h", 10, DAY_START)
+
+    def test_storages_give_the_same_top_counts(self):
+        redis_storage = stats.RedisStorage(fakeredis.FakeRedis(),
+                                           datetime.timedelta(days=2))
+        mem_storage = stats.MemStorage(datetime.timedelta(days=2))
+        events = random.Random(7)
+        ts = DAY_START
+        for i in range(300):
+            ts += events.randrange(1200)
+            node = f"node{events.randrange(9)}"
+            for storage in (redis_storage, mem_storage):
+                storage.store_interaction(f"user{i % 13}", node, ts)
+                storage.store_search(f"user{i % 13}", "q", i % 4, ts)
+            if i % 20 == 0:
+                for window in ("1h", "24h", "2d"):
+                    assert mem_storage.top_interactions(window, 5, ts) == \
+                        redis_storage.top_interactions(window, 5, ts)
+                    assert mem_storage.top_searches(window, 5, ts) == \
+                        redis_storage.top_searches(window, 5, ts)
+                assert mem_storage.count_users_since([ts - 3600]) == \
+                    redis_storage.count_users_since([ts - 3600])
+
+
+class TestMemStorage:
+
+    def test_memory_is_bounded(self):
+        storage = stats.MemStorage(capacity=10)
+        ts = DAY_START
+        for i in range(10 * 24 * 4):
+            ts += 900
+            storage.store_search(f"user{i}", f"query{i}", 1, ts)
+            storage.store_search("user", "frequent", 1, ts)
+
+        assert len(storage._buckets) == 3 * 24
+        assert all(
+            len(bucket.searches.counts) <= 10 for bucket in storage._buckets)
+        assert len(storage.timestamp_by_user) <= (3 * 24 + 1) * 4 + 1
+        # Two days before the one which just started.
+        assert storage.top_searches("3d", 1,
+                                    ts) == [("frequent#1", 2 * 24 * 4 + 1)]
+        assert ("frequent#1", 1) in storage.top_searches("1h", 10, ts)
+
+
+class TestSpaceSaving:
+
+    def test_counts_are_exact_below_capacity(self):
+        counter = stats.SpaceSaving(3)
+        for member in "abacab":
+            counter.add(member)
+        assert counter.counts == {"a": 3, "b": 2, "c": 1}
+
+    def test_frequent_members_are_kept(self):
+        counter = stats.SpaceSaving(3)
+        for i in range(100):
+            counter.add("frequent")
+            counter.add(f"rare{i}")
+        counter.add("frequent", 5)
+
+        assert len(counter.counts) == 3
+        assert counter.counts["frequent"] == 105
+
+
+class TestRedisStorage:
+
+    def test_writes_of_a_batch_are_sent_together(self):
+        rd = CountingRedis()
+        storage = stats.RedisStorage(rd)
+        bot_stats = stats.Stats(storage)
+
+        with bot_stats.batch():
+            bot_stats.collect_search(1, "Страховка", 2)
+            bot_stats.collect_interaction(1, "Страховка")
+            assert rd.keys("*:h:*") == []
+
+        assert rd.pipelines == 3, \
+            "the batch, and a transaction per metric to roll its windows"
+        assert bot_stats.top_interactions(5) == [("Страховка", 1)]
+        assert bot_stats.top_queries(5) == [("страховка", "2", 1)]
+        assert storage.count_users_since([0]) == [1]
+
+    def test_writes_outside_a_batch_are_sent_right_away(self):
+        rd = CountingRedis()
+        bot_stats = stats.Stats(stats.RedisStorage(rd))
+
+        bot_stats.collect_interaction(1, "a")
+        bot_stats.collect_interaction(1, "b")
+
+        assert rd.pipelines == 3, "the first write rolls the windows"
+        assert bot_stats.top_queries(1) == []
+
+    def test_active_users_are_counted_per_window(self):
+        rd = CountingRedis()
+        storage = stats.RedisStorage(rd)
+        now = 1_650_000_000
+        for user, minutes_ago in enumerate([5000, 2000, 200, 90, 30, 5]):
+            storage.store_interaction(f"user{user}", "a",
+                                      now - minutes_ago * 60)
+
+        assert storage.count_users_since(
+            [now - 3600, now - 3 * 3600, now - 24 * 3600]) == [2, 3, 4]
+        assert rd.zcard(stats.REDIS_USERS_KEY) == 5, \
+            "users not seen for longer than the retention are dropped"
+
+    def test_users_stored_by_older_versions_are_migrated(self):
+        rd = CountingRedis()
+        now = 1_650_000_000
+        rd.set(f"{stats.REDIS_USER_NS}:old", now - 60)
+        rd.set(f"{stats.REDIS_USER_NS}:both", now - 7200)
+        storage = stats.RedisStorage(rd)
+        storage.store_interaction("both", "a", now - 30)
+
+        assert storage.count_users_since([now - 3600]) == [2]
+        assert rd.keys(f"{stats.REDIS_USER_NS}:*") == []
+        assert rd.zscore(stats.REDIS_USERS_KEY, "both") == now - 30
+
+    def test_windows_are_moved_like_they_are_rebuilt(self):
+        rd = fakeredis.FakeRedis()
+        storage = stats.RedisStorage(rd, datetime.timedelta(days=7))
+        ts = DAY_START
+        for i in range(200):
+            ts += 1800
+            storage.store_search("user", f"q{i % 7}", i % 3, ts)
+            if i % 11 == 0:
+                rolled = [
+                    storage.top_searches(w.name, 100, ts)
+                    for w in storage.windows
+                ]
+                rd.delete(*rd.keys("search:w:*"))
+                assert [
+                    storage.top_searches(w.name, 100, ts)
+                    for w in storage.windows
+                ] == rolled
+
+        assert rd.exists(f"search:d:{DAY_START + stats.DAY_SEC}")
+        assert sum(count for _, count in storage.top_searches(
+            "7d", 100, ts)) == 200
+
+    def test_old_counts_leave_windows_after_days_without_metrics(
+            self, monkeypatch):
+        # Keys of the fake Redis expire by this clock.
+        clock = [DAY_START + stats.HOUR_SEC]
+        monkeypatch.setattr(time, "time", lambda: clock[0])
+        storage = stats.RedisStorage(fakeredis.FakeRedis())
+        storage.store_interaction("user", "a", clock[0])
+
+        for days, top in [(2, [("a", 1)]), (3, []), (4, []), (6, [])]:
+            clock[0] = DAY_START + days * stats.DAY_SEC + 2 * stats.HOUR_SEC
+            assert storage.top_interactions("3d", 5, clock[0]) == top, days
+
+
+class TestAsyncRedisStorage:
+
+    def test_metrics_are_stored_like_redis_storage_stores_them(self):
+        redis_storage = stats.RedisStorage(fakeredis.FakeRedis(),
+                                           datetime.timedelta(days=2))
+        server = fakeredis.FakeServer()
+        async_storage = stats.AsyncRedisStorage(
+            fakeredis.aioredis.FakeRedis(server=server),
+            datetime.timedelta(days=2))
+        events = random.Random(7)
+
+        async def run():
+            ts = DAY_START
+            for i in range(300):
+                ts += events.randrange(1200)
+                node = f"node{events.randrange(9)}"
+                redis_storage.store_interaction(f"user{i % 13}", node, ts)
+                redis_storage.store_search(f"user{i % 13}", "q", i % 4, ts)
+                await async_storage.store_interaction(f"user{i % 13}", node,
+                                                      ts)
+                await async_storage.store_search(f"user{i % 13}", "q", i % 4,
+                                                 ts)
+                if i % 20 == 0:
+                    for window in ("1h", "24h", "2d"):
+                        assert redis_storage.top_interactions(
+                            window, 5, ts) == \
+                            await async_storage.top_interactions(window, 5, ts)
+                        assert redis_storage.top_searches(window, 5, ts) == \
+                            await async_storage.top_searches(window, 5, ts)
+                    assert redis_storage.count_users_since([ts - 3600]) == \
+                        await async_storage.count_users_since([ts - 3600])
+            return ts
+
+        ts = asyncio.run(run())
+        # The threaded runtime reads what the asyncio one stored.
+        assert stats.RedisStorage(
+            fakeredis.FakeRedis(server=server),
+            datetime.timedelta(days=2)).top_searches("2d", 5, ts) == \
+            redis_storage.top_searches("2d", 5, ts)
+
+    def test_aggregator_stores_the_events_on_the_loop(self):
+
+        async def run():
+            storage = stats.AsyncRedisStorage(fakeredis.aioredis.FakeRedis())
+            aggregator = stats.AsyncMetricsAggregator(storage,
+                                                      flush_interval=60)
+            bot_stats = stats.Stats(storage, aggregator)
+            for user in range(50):
+                bot_stats.collect_interaction(user % 5, "a")
+                bot_stats.collect_search(user % 5, "Страховка", 2)
+            await bot_stats.stop()
+
+            now = int(time.time())
+            assert await storage.count_users_since([0]) == [5]
+            assert await storage.top_interactions("3d", 5, now) == [("a", 50)]
+            assert aggregator.stats() == \
+                "Metric events: 100 stored, 0 queued, 0 dropped"
+            assert "страховка' (2)" in await bot_stats.compute()
+
+        asyncio.run(run())
+
+
+class BlockingStorage(stats.MemStorage):
+
+    def __init__(self):
+        super().__init__()
+        self.stores = []
+        self.unblocked = threading.Event()
+
+    def store_aggregate(self, aggregate):
+        self.unblocked.wait(5)
+        self.stores.append(aggregate.events)
+        super().store_aggregate(aggregate)
+
+
+class TestMetricsAggregator:
+
+    def test_events_are_summed_up_before_they_are_stored(self):
+        rd = CountingRedis()
+        storage = stats.RedisStorage(rd)
+        aggregator = stats.MetricsAggregator(storage, flush_interval=60)
+        bot_stats = stats.Stats(storage, aggregator)
+
+        for user in range(50):
+            bot_stats.collect_interaction(user % 5, "a")
+            bot_stats.collect_search(user % 5, "Страховка", 2)
+        bot_stats.stop()
+        assert rd.pipelines == 3, \
+            "one write, and a transaction per metric to roll its windows"
+
+        assert storage.count_users_since([0]) == [5]
+        assert bot_stats.top_interactions(5) == [("a", 50)]
+        assert bot_stats.top_queries(5) == [("страховка", "2", 50)]
+        assert aggregator.stats() == \
+            "Metric events: 100 stored, 0 queued, 0 dropped"
+
+    def test_events_are_stored_every_flush_events(self):
+        storage = BlockingStorage()
+        storage.unblocked.set()
+        aggregator = stats.MetricsAggregator(storage,
+                                             flush_interval=60,
+                                             flush_events=4)
+        for _ in range(10):
+            aggregator.push(stats.MetricEvent(stats.INTERACTION, 1, "a", 0))
+        aggregator.stop()
+
+        assert storage.stores == [4, 4, 2]
+
+    def test_events_are_dropped_while_the_queue_is_full(self):
+        storage = BlockingStorage()
+        aggregator = stats.MetricsAggregator(storage,
+                                             flush_events=1,
+                                             max_pending=2)
+        bot_stats = stats.Stats(storage, aggregator)
+        bot_stats.collect_interaction(1, "a")
+        while aggregator.stats().find("0 queued") < 0:
+            time.sleep(0.001)
+
+        for _ in range(5):
+            bot_stats.collect_interaction(1, "b")
+        storage.unblocked.set()
+        bot_stats.stop()
+
+        assert aggregator.dropped == 3
+        assert dict(storage.top_interactions("3d", 5, int(time.time()))) == \
+            {"a": 1, "b": 2}
+        assert aggregator.stats().endswith("3 dropped")